@@ -2,8 +2,6 @@ import enum
 import smtplib
 from email.mime.text import MIMEText
 
-from email_validator import validate_email
-
 from alerts.alert_sender import AlertSender
 
 SMTP_CONNECTION_TIMEOUT = 2
@@ -18,6 +16,7 @@ class SecurityValues(enum.Enum):
 class EmailAlertSender(AlertSender):
 
     def __init__(self, tunnel_manager_id, host, login, password, to_address, logger, security=None, port=25, from_address = None):
+        from email_validator import validate_email
         self.tunnel_manager_id = tunnel_manager_id
         logger.info("Creating email sender with parameters" + str((tunnel_manager_id, host, login, password, to_address, security, port, from_address)))
         if from_address is None:
@@ -2,8 +2,6 @@ import json
 
 from alerts.alert_sender import AlertSender
 
-import requests
-
 class HTTPPostAlertSender(AlertSender):
     def __init__(self, tunnel_manager_id, post_url, user, password, logger):
         self.tunnel_manager_id = tunnel_manager_id
@@ -14,6 +12,7 @@ class HTTPPostAlertSender(AlertSender):
 
     def send_alert(self, tunnel_name, message=None, exception_on_failure=False):
         try:
+            import requests
             message = message or "Connector Down!"
             data = {'tunnel_name': tunnel_name, 'message':message, 'tunnel_manager_id': self.tunnel_manager_id}
             auth_data = (self.user, self.password)
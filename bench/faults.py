@@ -0,0 +1,466 @@
+import argparse
+import json
+import os
+import queue
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+from bench.runner import BenchEnvironment, free_port, percentile, recv_exactly, FORWARD_TIMEOUT, SOCKET_TIMEOUT
+from bench.services import echo_service
+from bench.ssh_server import LocalSSHServer, BUFFER_SIZE
+from configure_logger import LogManager
+
+PYTUN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'pytun.py')
+
+DEFAULT_FAULT_DURATION = 10
+DEFAULT_CONNECTIONS = 8
+DEFAULT_RECOVERY_TIMEOUT = 120
+DEFAULT_KEEP_ALIVE_TIME = 30
+DEFAULT_LATENCY = 0.2
+PROBE_INTERVAL = 0.2
+PROBE_TIMEOUT = 2
+# Consecutive successful probes, after the fault is healed, for the connector to count as recovered
+RECOVERED_PROBES = 3
+STOP_TIMEOUT = 30
+
+# Scenario: (proxy the fault is injected in, fault). ssh sits between the connector and the SSH server, upstream
+# between the connector and the service it forwards to
+SCENARIOS = {
+    'ssh_reset': ('ssh', 'reset'),
+    'ssh_drop': ('ssh', 'drop'),
+    'ssh_blackhole': ('ssh', 'stall'),
+    'ssh_latency': ('ssh', 'latency'),
+    'server_restart': ('ssh', 'restart'),
+    'upstream_reset': ('upstream', 'reset'),
+    'upstream_stall': ('upstream', 'stall'),
+    'upstream_latency': ('upstream', 'latency'),
+}
+
+# Faults that end the SSH session: the connector must notice them by its next keep-alive check, give or take
+# DETECTION_MARGIN seconds for the check itself and the polling of its stats
+KEEP_ALIVE_SCENARIOS = ('ssh_reset', 'ssh_drop', 'server_restart')
+DETECTION_MARGIN = 5
+
+SUPERVISOR_TEMPLATE = """[pytun]
+tunnel_dirs=%(tunnel_dirs)s
+log_path=%(log_path)s
+log_level=%(log_level)s
+inspection_port=%(inspection_port)d
+inspection_cache_ttl=0
+%(extra)s
+"""
+
+
+class ProxiedConnection(object):
+    def __init__(self, client, upstream):
+        self.client = client
+        self.upstream = upstream
+        self.closed = False
+        # Directions that ended with an EOF
+        self.finished = 0
+
+    def close(self, reset=False):
+        self.closed = True
+        for sock in (self.client, self.upstream):
+            try:
+                if reset:
+                    # Closing with a zero linger time sends RST instead of FIN
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+                else:
+                    sock.shutdown(socket.SHUT_RDWR)
+                sock.close()
+            except OSError:
+                pass
+
+
+class FaultProxy(object):
+    """TCP proxy to target that injects faults in the connections going through it.
+
+    reset() closes the open connections with RST, drop() closes them with FIN and refuses new ones, stall()
+    stops moving data like a blackholed link, set_latency() delays every chunk by that many seconds in both
+    directions and heal() ends the fault. Each direction of a connection has a reader and a writer thread, so
+    latency does not limit the throughput.
+    """
+
+    def __init__(self, target, address=("127.0.0.1", 0)):
+        self.target = target
+        self.listener = socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(address)
+        self.listener.listen(128)
+        self.address = self.listener.getsockname()
+        self.lock = threading.Lock()
+        self.connections = set()
+        self.latency = 0
+        self.refusing = False
+        # Cleared while stalled
+        self.flowing = threading.Event()
+        self.flowing.set()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._accept_loop)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def _accept_loop(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                return
+            if self.refusing:
+                ProxiedConnection(client, socket.socket()).close(reset=True)
+                continue
+            try:
+                upstream = socket.create_connection(self.target, SOCKET_TIMEOUT)
+                upstream.settimeout(None)
+            except OSError:
+                ProxiedConnection(client, socket.socket()).close(reset=True)
+                continue
+            connection = ProxiedConnection(client, upstream)
+            with self.lock:
+                self.connections.add(connection)
+            for source, destination in ((client, upstream), (upstream, client)):
+                chunks = queue.Queue()
+                for target, args in ((self._read, (connection, source, chunks)),
+                                     (self._write, (connection, destination, chunks))):
+                    thr = threading.Thread(target=target, args=args)
+                    thr.daemon = True
+                    thr.start()
+
+    def _read(self, connection, source, chunks):
+        try:
+            while True:
+                self.flowing.wait()
+                data = source.recv(BUFFER_SIZE)
+                chunks.put((time.monotonic() + self.latency, data))
+                if not data:
+                    return
+        except OSError:
+            chunks.put((0, None))
+
+    def _write(self, connection, destination, chunks):
+        try:
+            while True:
+                due, data = chunks.get()
+                delay = due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                self.flowing.wait()
+                if data is None:
+                    # The other side failed, pass the failure on
+                    connection.close(reset=True)
+                    break
+                if not data:
+                    destination.shutdown(socket.SHUT_WR)
+                    with self.lock:
+                        connection.finished += 1
+                        if connection.finished < 2:
+                            return
+                    connection.close()
+                    break
+                destination.sendall(data)
+        except OSError:
+            connection.close(reset=True)
+        with self.lock:
+            self.connections.discard(connection)
+
+    def _close_all(self, reset):
+        with self.lock:
+            connections, self.connections = list(self.connections), set()
+        for each in connections:
+            each.close(reset=reset)
+
+    def reset(self):
+        self._close_all(reset=True)
+
+    def drop(self):
+        self.refusing = True
+        self._close_all(reset=False)
+
+    def stall(self):
+        self.flowing.clear()
+
+    def set_latency(self, seconds):
+        self.latency = seconds
+
+    def heal(self):
+        self.latency = 0
+        self.refusing = False
+        self.flowing.set()
+
+    def close(self):
+        try:
+            self.listener.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.listener.close()
+        self.heal()
+        self._close_all(reset=True)
+
+
+class FaultEnvironment(BenchEnvironment):
+    """An echo service forwarded by one connector run by a pytun supervisor process, with a FaultProxy in front of
+    the SSH server and another one in front of the echo service"""
+
+    def __init__(self, logger, log_level='INFO'):
+        super().__init__(logger, log_level=log_level)
+        self.echo = echo_service()
+        self.proxies = {'ssh': FaultProxy(self.ssh_server.address).start(),
+                        'upstream': FaultProxy(self.echo.address).start()}
+        self.key_file, self.known_hosts = self.ssh_server.write_client_files(self.directory,
+                                                                             self.proxies['ssh'].address)
+        self.tunnel_name = 'faults-echo'
+        self.port = None
+        self.inspection_port = free_port()
+        self.supervisor = None
+
+    def start(self, keep_alive_time=DEFAULT_KEEP_ALIVE_TIME, connector_settings='', supervisor_settings=''):
+        connectors = os.path.join(self.directory, 'connectors')
+        os.makedirs(connectors)
+        _, self.port = self.write_connector_ini(self.tunnel_name, self.proxies['upstream'].address,
+                                                server_address=self.proxies['ssh'].address,
+                                                keep_alive_time=keep_alive_time, extra=connector_settings,
+                                                directory=connectors)
+        config_ini = os.path.join(self.directory, 'pytun.ini')
+        with open(config_ini, 'w') as f:
+            f.write(SUPERVISOR_TEMPLATE % {'tunnel_dirs': connectors, 'log_path': self.log_path,
+                                           'log_level': self.log_level, 'inspection_port': self.inspection_port,
+                                           'extra': supervisor_settings})
+        with open(os.path.join(self.log_path, 'supervisor.out'), 'w') as output:
+            self.supervisor = subprocess.Popen([sys.executable, PYTUN, '--config_ini', config_ini],
+                                               cwd=self.directory, stdout=output, stderr=subprocess.STDOUT)
+        deadline = time.monotonic() + FORWARD_TIMEOUT
+        while not self.probe():
+            if time.monotonic() > deadline or self.supervisor.poll() is not None:
+                raise RuntimeError("The connector did not start forwarding, check %s" % (self.log_path,))
+            time.sleep(PROBE_INTERVAL)
+        # The supervisor starts its inspection server after the connectors, the baseline stats need both
+        while self.connector_stats().get('pid') is None:
+            if time.monotonic() > deadline or self.supervisor.poll() is not None:
+                raise RuntimeError("The supervisor did not report the connector stats, check %s" % (self.log_path,))
+            time.sleep(PROBE_INTERVAL)
+
+    def probe(self):
+        """Seconds for a new connection through the connector to echo a message, None if it fails"""
+        started = time.perf_counter()
+        try:
+            with socket.create_connection(("127.0.0.1", self.port), timeout=PROBE_TIMEOUT) as sock:
+                sock.sendall(b'probe')
+                recv_exactly(sock, 5)
+        except (OSError, EOFError):
+            return None
+        return time.perf_counter() - started
+
+    def connector_stats(self):
+        """get-stats of the connector through the supervisor, {'error': ...} while it does not answer"""
+        url = "http://127.0.0.1:%d/stats" % (self.inspection_port,)
+        try:
+            with urllib.request.urlopen(url, timeout=PROBE_TIMEOUT) as response:
+                return json.load(response)['connectors'].get(self.tunnel_name, {'error': 'missing'})
+        except Exception as e:
+            return {'error': str(e)}
+
+    def restart_ssh_server(self, downtime):
+        address = self.ssh_server.address
+        host_key, client_key = self.ssh_server.host_key, self.ssh_server.client_key
+        self.ssh_server.stop()
+        time.sleep(downtime)
+        self.ssh_server = LocalSSHServer(host_key, client_key, address).start()
+
+    def close(self):
+        if self.supervisor and self.supervisor.poll() is None:
+            self.supervisor.send_signal(signal.SIGTERM)
+            try:
+                self.supervisor.wait(STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self.supervisor.kill()
+                self.supervisor.wait()
+        for each in self.proxies.values():
+            each.close()
+        self.echo.stop()
+        super().close()
+
+
+def open_connections(port, count):
+    connections = []
+    for _ in range(count):
+        sock = socket.create_connection(("127.0.0.1", port), timeout=SOCKET_TIMEOUT)
+        sock.sendall(b'held')
+        recv_exactly(sock, 4)
+        connections.append(sock)
+    return connections
+
+
+def count_lost(connections):
+    """Connections opened before the fault that no longer echo"""
+    lost = 0
+    for sock in connections:
+        try:
+            sock.settimeout(PROBE_TIMEOUT)
+            sock.sendall(b'held')
+            recv_exactly(sock, 4)
+        except (OSError, EOFError):
+            lost += 1
+        finally:
+            sock.close()
+    return lost
+
+
+class Observer(object):
+    """Probes the connector and polls its stats from the injection of a fault until it recovered"""
+
+    def __init__(self, environment, baseline):
+        self.environment = environment
+        self.identity = (baseline.get('pid'), baseline.get('started_at'))
+        self.injected = time.monotonic()
+        self.healed = False
+        self.detected = None
+        self.restarted = False
+        self.failures = 0
+        self.streak_start = None
+        self.streak = 0
+        self.latencies = []
+        self.recovered = False
+
+    def run(self, timeout):
+        deadline = self.injected + timeout
+        while time.monotonic() < deadline:
+            stats = self.environment.connector_stats()
+            now = time.monotonic()
+            changed = (stats.get('pid'), stats.get('started_at')) != self.identity
+            if self.detected is None and ('error' in stats or changed or not stats.get('forwarding')):
+                self.detected = now
+            self.restarted = self.restarted or ('error' not in stats and changed)
+            started = time.monotonic()
+            latency = self.environment.probe()
+            if latency is None:
+                self.failures += 1
+                self.streak = 0
+            else:
+                if not self.healed:
+                    self.latencies.append(latency)
+                if self.streak == 0:
+                    self.streak_start = started
+                self.streak += 1
+                if self.healed and self.streak >= RECOVERED_PROBES:
+                    self.recovered = True
+                    return
+            time.sleep(max(0.0, PROBE_INTERVAL - (time.monotonic() - started)))
+
+    def result(self):
+        self.latencies.sort()
+        recovery = None
+        if self.recovered:
+            recovery = self.streak_start - self.injected if self.failures else 0.0
+        return {'detection_time': None if self.detected is None else self.detected - self.injected,
+                'recovery_time': recovery,
+                'restarted': self.restarted,
+                'probe_failures': self.failures,
+                'probe_latency_p50': percentile(self.latencies, 0.50)}
+
+
+def inject(environment, scenario, latency):
+    proxy_name, fault = SCENARIOS[scenario]
+    proxy = environment.proxies[proxy_name]
+    if fault == 'latency':
+        proxy.set_latency(latency)
+    elif fault != 'restart':
+        getattr(proxy, fault)()
+
+
+def run_scenario(logger, scenario, fault_duration=DEFAULT_FAULT_DURATION, connections=DEFAULT_CONNECTIONS,
+                 recovery_timeout=DEFAULT_RECOVERY_TIMEOUT, keep_alive_time=DEFAULT_KEEP_ALIVE_TIME,
+                 latency=DEFAULT_LATENCY, connector_settings='', supervisor_settings='', log_level='INFO'):
+    environment = FaultEnvironment(logger, log_level=log_level)
+    try:
+        environment.start(keep_alive_time, connector_settings, supervisor_settings)
+        held = open_connections(environment.port, connections)
+        observer = Observer(environment, environment.connector_stats())
+        logger.info("Injecting %s for %ss", scenario, fault_duration)
+        if SCENARIOS[scenario][1] == 'restart':
+            fault = threading.Thread(target=environment.restart_ssh_server, args=(fault_duration,))
+        else:
+            inject(environment, scenario, latency)
+            fault = threading.Thread(target=time.sleep, args=(fault_duration,))
+        fault.start()
+        observing = threading.Thread(target=observer.run, args=(recovery_timeout,))
+        observing.start()
+        fault.join()
+        for each in environment.proxies.values():
+            each.heal()
+        observer.healed = True
+        observing.join()
+        result = observer.result()
+        result['connections_lost'] = count_lost(held) if observer.recovered else None
+        result['connections'] = connections
+        if scenario in KEEP_ALIVE_SCENARIOS:
+            result['detection_bound'] = keep_alive_time + DETECTION_MARGIN
+        return result
+    finally:
+        environment.close()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='pytun faults',
+                                     description='Measures how pytun detects and recovers from network failures')
+    parser.add_argument("--scenarios", default=','.join(SCENARIOS),
+                        help="Comma separated scenarios to run: " + ", ".join(SCENARIOS))
+    parser.add_argument("--fault-duration", dest="fault_duration", type=float, default=DEFAULT_FAULT_DURATION,
+                        help="Seconds each fault lasts")
+    parser.add_argument("--connections", type=int, default=DEFAULT_CONNECTIONS,
+                        help="Connections open before the fault, the ones that do not survive it are lost")
+    parser.add_argument("--recovery-timeout", dest="recovery_timeout", type=float, default=DEFAULT_RECOVERY_TIMEOUT,
+                        help="Seconds after the injection to give up waiting for the connector to recover")
+    parser.add_argument("--keep-alive-time", dest="keep_alive_time", type=int, default=DEFAULT_KEEP_ALIVE_TIME,
+                        help="Seconds between the checks of its SSH session by the connector")
+    parser.add_argument("--latency", type=float, default=DEFAULT_LATENCY,
+                        help="Seconds added in each direction by the latency scenarios")
+    parser.add_argument("--connector-settings", dest="connector_settings", default='',
+                        help="Extra ini lines for the connector, separated by ';'")
+    parser.add_argument("--supervisor-settings", dest="supervisor_settings", default='',
+                        help="Extra lines for the [pytun] section, separated by ';'")
+    parser.add_argument("--output", help="Also write the report to this file")
+    parser.add_argument("--log_level", default='INFO')
+    args = parser.parse_args(argv)
+    scenarios = args.scenarios.split(',')
+    unknown = [each for each in scenarios if each not in SCENARIOS]
+    if unknown:
+        parser.error("Unknown scenarios: %s" % (", ".join(unknown),))
+    log_path = tempfile.mkdtemp(prefix='pytun-faults-logs-')
+    logger = LogManager.configure_logger('faults.log', args.log_level, True, name="pytun-faults", path=log_path)
+    results = {}
+    for scenario in scenarios:
+        logger.info("Running scenario %s", scenario)
+        results[scenario] = run_scenario(logger, scenario, args.fault_duration, args.connections,
+                                         args.recovery_timeout, args.keep_alive_time, args.latency,
+                                         args.connector_settings.replace(';', '\n'),
+                                         args.supervisor_settings.replace(';', '\n'), args.log_level)
+        logger.info("%s: %s", scenario, results[scenario])
+    report = {'parameters': {'fault_duration': args.fault_duration, 'connections': args.connections,
+                             'keep_alive_time': args.keep_alive_time, 'latency': args.latency,
+                             'connector_settings': args.connector_settings,
+                             'supervisor_settings': args.supervisor_settings},
+              'created_at': time.time(),
+              'scenarios': results}
+    exit_code = 0
+    report['late_detections'] = [name for name, result in results.items() if 'detection_bound' in result and
+                                 (result['detection_time'] is None or
+                                  result['detection_time'] > result['detection_bound'])]
+    if report['late_detections']:
+        logger.error("Not detected within keep_alive_time: %s", ', '.join(report['late_detections']))
+        exit_code = 1
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+    return exit_code
@@ -0,0 +1,330 @@
+import argparse
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from bench.services import echo_service, sink_service, stream_service, SINK_HEADER
+from bench.ssh_server import LocalSSHServer
+from configure_logger import LogManager
+from tunnel_infra.TunnelProcess import TunnelProcess
+
+DEFAULT_CONNECTIONS = 16
+DEFAULT_DURATION = 10
+DEFAULT_PAYLOAD = 1024
+DEFAULT_BULK = 8 * 1024 * 1024
+DEFAULT_TOLERANCE = 0.15
+FORWARD_TIMEOUT = 30
+SOCKET_TIMEOUT = 10
+
+CONNECTOR_TEMPLATE = """[tunnel]
+tunnel_name=%(name)s
+server_host=%(server_host)s
+server_port=%(server_port)d
+port=%(port)d
+remote_host=%(remote_host)s
+remote_port=%(remote_port)d
+keyfile=%(keyfile)s
+username=bench
+server_key=%(server_key)s
+keep_alive_time=%(keep_alive_time)d
+log_level=%(log_level)s
+%(extra)s
+"""
+
+HIGHER_IS_BETTER = ('operations_per_second', 'throughput_bytes_per_second')
+LOWER_IS_BETTER = ('latency_p50', 'latency_p99', 'cpu_percent', 'rss_bytes')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class BenchEnvironment(object):
+    """Local SSH server plus connectors forwarding through it, all under a temporary directory"""
+
+    def __init__(self, logger, directory=None, log_level='INFO'):
+        self.logger = logger
+        self.log_level = log_level
+        self.directory = directory or tempfile.mkdtemp(prefix='pytun-bench-')
+        self.log_path = os.path.join(self.directory, 'logs')
+        os.makedirs(self.log_path, exist_ok=True)
+        self.ssh_server = LocalSSHServer().start()
+        self.key_file, self.known_hosts = self.ssh_server.write_client_files(self.directory)
+        self.connectors = []
+
+    def write_connector_ini(self, name, upstream_address, server_address=None, port=None, keep_alive_time=30,
+                            extra='', directory=None):
+        server_address = server_address or self.ssh_server.address
+        ini_file = os.path.join(directory or self.directory, name + '.ini')
+        port = port or free_port()
+        with open(ini_file, 'w') as f:
+            f.write(CONNECTOR_TEMPLATE % {'name': name, 'server_host': server_address[0],
+                                          'server_port': server_address[1], 'port': port,
+                                          'remote_host': upstream_address[0], 'remote_port': upstream_address[1],
+                                          'keyfile': self.key_file, 'server_key': self.known_hosts,
+                                          'keep_alive_time': keep_alive_time, 'log_level': self.log_level,
+                                          'extra': extra})
+        return ini_file, port
+
+    def start_connector(self, ini_file):
+        TunnelProcess.default_log_path = self.log_path
+        tunnel_process = TunnelProcess.from_config_file(ini_file, [])
+        tunnel_process.start()
+        if not tunnel_process.forwarding_event.wait(FORWARD_TIMEOUT):
+            tunnel_process.terminate()
+            raise RuntimeError("Connector %s did not start forwarding, check %s" % (ini_file, self.log_path))
+        self.connectors.append(tunnel_process)
+        return tunnel_process
+
+    def add_connector(self, name, upstream_address, **kwargs):
+        ini_file, port = self.write_connector_ini(name, upstream_address, **kwargs)
+        return self.start_connector(ini_file), port
+
+    def close(self):
+        for each in self.connectors:
+            each.terminate()
+        for each in self.connectors:
+            each.join()
+        self.ssh_server.stop()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def run_workers(connections, duration, work):
+    """Calls work(deadline, samples) on connections threads and merges what they append to samples"""
+    deadline = time.monotonic() + duration
+    per_thread = [{'latencies': [], 'operations': 0, 'bytes': 0, 'errors': 0} for _ in range(connections)]
+    threads = [threading.Thread(target=work, args=(deadline, samples)) for samples in per_thread]
+    started = time.monotonic()
+    for each in threads:
+        each.daemon = True
+        each.start()
+    for each in threads:
+        each.join(duration + SOCKET_TIMEOUT * 2)
+    elapsed = time.monotonic() - started
+    merged = {'latencies': [], 'operations': 0, 'bytes': 0, 'errors': 0, 'elapsed': elapsed}
+    for samples in per_thread:
+        merged['latencies'].extend(samples['latencies'])
+        for key in ('operations', 'bytes', 'errors'):
+            merged[key] += samples[key]
+    merged['latencies'].sort()
+    return merged
+
+
+def recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError("Connection closed after %d of %d bytes" % (len(data), size))
+        data += chunk
+    return data
+
+
+def latency_phase(port, connections, duration, payload_size):
+    payload = b'p' * payload_size
+
+    def work(deadline, samples):
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=SOCKET_TIMEOUT) as sock:
+                while time.monotonic() < deadline:
+                    started = time.perf_counter()
+                    sock.sendall(payload)
+                    recv_exactly(sock, payload_size)
+                    samples['latencies'].append(time.perf_counter() - started)
+                    samples['operations'] += 1
+                    samples['bytes'] += payload_size
+        except (OSError, EOFError):
+            samples['errors'] += 1
+
+    return run_workers(connections, duration, work)
+
+
+def connect_phase(port, connections, duration):
+    def work(deadline, samples):
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                with socket.create_connection(("127.0.0.1", port), timeout=SOCKET_TIMEOUT) as sock:
+                    sock.sendall(b'ping')
+                    recv_exactly(sock, 4)
+            except (OSError, EOFError):
+                samples['errors'] += 1
+                continue
+            samples['latencies'].append(time.perf_counter() - started)
+            samples['operations'] += 1
+
+    return run_workers(connections, duration, work)
+
+
+def throughput_phase(port, connections, duration, bulk_size):
+    chunk = b'b' * 65536
+
+    def work(deadline, samples):
+        while time.monotonic() < deadline:
+            try:
+                with socket.create_connection(("127.0.0.1", port), timeout=SOCKET_TIMEOUT) as sock:
+                    sock.sendall(SINK_HEADER.pack(bulk_size))
+                    sent = 0
+                    while sent < bulk_size:
+                        sent += sock.send(chunk[:bulk_size - sent])
+                    received, = SINK_HEADER.unpack(recv_exactly(sock, SINK_HEADER.size))
+            except (OSError, EOFError):
+                samples['errors'] += 1
+                continue
+            samples['bytes'] += received
+            samples['operations'] += 1
+
+    return run_workers(connections, duration, work)
+
+
+def half_close_phase(port, connections, duration, request_size, response_size):
+    """Sends a request, shuts down the sending side and reads a much larger response until EOF. A response that
+    is cut short or a wrong request size counts as an error"""
+    request = b'r' * request_size
+
+    def work(deadline, samples):
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                with socket.create_connection(("127.0.0.1", port), timeout=SOCKET_TIMEOUT) as sock:
+                    sock.sendall(SINK_HEADER.pack(response_size) + request)
+                    sock.shutdown(socket.SHUT_WR)
+                    received, = SINK_HEADER.unpack(recv_exactly(sock, SINK_HEADER.size))
+                    size = 0
+                    while True:
+                        data = sock.recv(65536)
+                        if not data:
+                            break
+                        size += len(data)
+            except (OSError, EOFError):
+                samples['errors'] += 1
+                continue
+            if received != request_size or size != response_size:
+                samples['errors'] += 1
+                continue
+            samples['latencies'].append(time.perf_counter() - started)
+            samples['bytes'] += size
+            samples['operations'] += 1
+
+    return run_workers(connections, duration, work)
+
+
+def measure(tunnel_process, phase, *args):
+    import psutil
+    process = psutil.Process(tunnel_process.pid)
+    cpu_before = process.cpu_times()
+    result = phase(*args)
+    cpu_after = process.cpu_times()
+    cpu_seconds = (cpu_after.user - cpu_before.user) + (cpu_after.system - cpu_before.system)
+    latencies = result['latencies']
+    return {'operations': result['operations'],
+            'errors': result['errors'],
+            'elapsed': result['elapsed'],
+            'operations_per_second': result['operations'] / result['elapsed'],
+            'throughput_bytes_per_second': result['bytes'] / result['elapsed'],
+            'latency_p50': percentile(latencies, 0.50),
+            'latency_p99': percentile(latencies, 0.99),
+            'cpu_percent': 100.0 * cpu_seconds / result['elapsed'],
+            'rss_bytes': process.memory_info().rss}
+
+
+def run_bench(logger, connections=DEFAULT_CONNECTIONS, duration=DEFAULT_DURATION, payload=DEFAULT_PAYLOAD,
+              bulk=DEFAULT_BULK, phases=('latency', 'connect', 'throughput', 'half_close')):
+    environment = BenchEnvironment(logger)
+    echo = sink = stream = None
+    try:
+        echo = echo_service()
+        sink = sink_service()
+        stream = stream_service()
+        echo_connector, echo_port = environment.add_connector('bench-echo', echo.address)
+        sink_connector, sink_port = environment.add_connector('bench-sink', sink.address)
+        stream_connector, stream_port = environment.add_connector('bench-stream', stream.address)
+        results = {}
+        if 'latency' in phases:
+            logger.info("Running latency phase with %d connections for %ss", connections, duration)
+            results['latency'] = measure(echo_connector, latency_phase, echo_port, connections, duration, payload)
+        if 'connect' in phases:
+            logger.info("Running connect phase with %d connections for %ss", connections, duration)
+            results['connect'] = measure(echo_connector, connect_phase, echo_port, connections, duration)
+        if 'throughput' in phases:
+            logger.info("Running throughput phase with %d connections for %ss", connections, duration)
+            results['throughput'] = measure(sink_connector, throughput_phase, sink_port, connections, duration,
+                                            bulk)
+        if 'half_close' in phases:
+            logger.info("Running half_close phase with %d connections for %ss", connections, duration)
+            results['half_close'] = measure(stream_connector, half_close_phase, stream_port, connections, duration,
+                                            payload, bulk)
+        return {'parameters': {'connections': connections, 'duration': duration, 'payload': payload,
+                               'bulk': bulk},
+                'created_at': time.time(),
+                'results': results}
+    finally:
+        environment.close()
+        for each in (echo, sink, stream):
+            if each:
+                each.stop()
+
+
+def compare(report, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Returns the relative change of every metric and the ones that got worse by more than tolerance"""
+    changes = {}
+    regressions = []
+    for phase, metrics in report['results'].items():
+        for metric in HIGHER_IS_BETTER + LOWER_IS_BETTER:
+            value = metrics.get(metric)
+            previous = baseline.get('results', {}).get(phase, {}).get(metric)
+            if value is None or not previous:
+                continue
+            change = (value - previous) / previous
+            changes['%s.%s' % (phase, metric)] = change
+            worse = change > tolerance if metric in LOWER_IS_BETTER else change < -tolerance
+            if worse:
+                regressions.append('%s.%s' % (phase, metric))
+    return changes, regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='pytun bench',
+                                     description='Measures the forwarding path against a local SSH server')
+    parser.add_argument("--connections", type=int, default=DEFAULT_CONNECTIONS, help="Concurrent connections")
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION, help="Seconds per phase")
+    parser.add_argument("--payload", type=int, default=DEFAULT_PAYLOAD, help="Bytes per echo round trip")
+    parser.add_argument("--bulk", type=int, default=DEFAULT_BULK, help="Bytes per throughput transfer")
+    parser.add_argument("--phases", default='latency,connect,throughput,half_close',
+                        help="Comma separated phases to run: latency, connect, throughput, half_close")
+    parser.add_argument("--save-baseline", dest="save_baseline", help="Write the results to this file")
+    parser.add_argument("--baseline", help="Compare the results with a file written by --save-baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="Relative change accepted before a metric counts as a regression")
+    parser.add_argument("--log_level", default='INFO')
+    args = parser.parse_args(argv)
+    log_path = tempfile.mkdtemp(prefix='pytun-bench-logs-')
+    logger = LogManager.configure_logger('bench.log', args.log_level, True, name="pytun-bench", path=log_path)
+    report = run_bench(logger, args.connections, args.duration, args.payload, args.bulk,
+                       phases=args.phases.split(','))
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        report['changes'], report['regressions'] = compare(report, baseline, args.tolerance)
+        if report['regressions']:
+            logger.error("Regressions against %s: %s", args.baseline, ', '.join(report['regressions']))
+            exit_code = 1
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+    return exit_code
@@ -0,0 +1,99 @@
+import socketserver
+import struct
+import threading
+
+BUFFER_SIZE = 65536
+# Sink requests start with the amount of bytes the client is going to send
+SINK_HEADER = struct.Struct("!Q")
+
+
+class _ThreadingServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 256
+
+
+class EchoHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        while True:
+            data = self.request.recv(BUFFER_SIZE)
+            if not data:
+                return
+            self.request.sendall(data)
+
+
+class SinkHandler(socketserver.BaseRequestHandler):
+    """Reads a SINK_HEADER and that many bytes, then answers with the amount of bytes it read"""
+
+    def handle(self):
+        header = b''
+        while len(header) < SINK_HEADER.size:
+            data = self.request.recv(SINK_HEADER.size - len(header))
+            if not data:
+                return
+            header += data
+        expected, = SINK_HEADER.unpack(header)
+        received = 0
+        while received < expected:
+            data = self.request.recv(min(BUFFER_SIZE, expected - received))
+            if not data:
+                break
+            received += len(data)
+        self.request.sendall(SINK_HEADER.pack(received))
+
+
+class StreamHandler(socketserver.BaseRequestHandler):
+    """Reads a SINK_HEADER and the request until the client shuts down its sending side, then answers with the
+    amount of bytes of the request and as many bytes as the header asked for. Needs half-close to work end to end"""
+
+    def handle(self):
+        header = b''
+        while len(header) < SINK_HEADER.size:
+            data = self.request.recv(SINK_HEADER.size - len(header))
+            if not data:
+                return
+            header += data
+        response_size, = SINK_HEADER.unpack(header)
+        received = 0
+        while True:
+            data = self.request.recv(BUFFER_SIZE)
+            if not data:
+                break
+            received += len(data)
+        self.request.sendall(SINK_HEADER.pack(received))
+        chunk = b's' * BUFFER_SIZE
+        sent = 0
+        while sent < response_size:
+            size = min(BUFFER_SIZE, response_size - sent)
+            self.request.sendall(chunk[:size])
+            sent += size
+
+
+class LocalService(object):
+
+    def __init__(self, handler_class, address=("127.0.0.1", 0)):
+        self.server = _ThreadingServer(address, handler_class)
+        self.address = self.server.server_address
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def echo_service():
+    return LocalService(EchoHandler).start()
+
+
+def sink_service():
+    return LocalService(SinkHandler).start()
+
+
+def stream_service():
+    return LocalService(StreamHandler).start()
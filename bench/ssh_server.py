@@ -0,0 +1,214 @@
+import os
+import select
+import socket
+import threading
+
+import paramiko
+
+BIND_ADDRESS = "127.0.0.1"
+BUFFER_SIZE = 32768
+
+
+def relay(sock, chan):
+    """Copies data both ways between a socket and a channel until both directions are closed"""
+    open_directions = 2
+    readers = [sock, chan]
+    try:
+        while open_directions:
+            r, w, x = select.select(readers, [], [])
+            if sock in r:
+                data = sock.recv(BUFFER_SIZE)
+                if data:
+                    chan.sendall(data)
+                else:
+                    chan.shutdown_write()
+                    readers.remove(sock)
+                    open_directions -= 1
+            if chan in r:
+                data = chan.recv(BUFFER_SIZE)
+                if data:
+                    sock.sendall(data)
+                else:
+                    try:
+                        sock.shutdown(socket.SHUT_WR)
+                    except OSError:
+                        pass
+                    readers.remove(chan)
+                    open_directions -= 1
+    except (OSError, EOFError, paramiko.SSHException):
+        pass
+    finally:
+        chan.close()
+        sock.close()
+
+
+class ForwardedPort(object):
+    """Listening socket opened on behalf of a tcpip-forward request"""
+
+    def __init__(self, transport, address, port):
+        self.transport = transport
+        self.address = address or BIND_ADDRESS
+        self.listener = socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((self.address, port))
+        self.listener.listen(128)
+        self.port = self.listener.getsockname()[1]
+        self.thread = threading.Thread(target=self._accept_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                sock, origin = self.listener.accept()
+            except OSError:
+                return
+            try:
+                chan = self.transport.open_forwarded_tcpip_channel(origin, (self.address, self.port))
+            except Exception:
+                sock.close()
+                continue
+            thr = threading.Thread(target=relay, args=(sock, chan))
+            thr.daemon = True
+            thr.start()
+
+    def close(self):
+        try:
+            # Wakes up the thread blocked in accept(), close() alone does not
+            self.listener.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.listener.close()
+
+
+class BenchServerInterface(paramiko.ServerInterface):
+
+    def __init__(self, server, transport):
+        self.server = server
+        self.transport = transport
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        if key == self.server.client_key:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        try:
+            sock = socket.create_connection(destination, timeout=5)
+        except OSError:
+            return paramiko.OPEN_FAILED_CONNECT_FAILED
+        self.server.pending_direct[(self.transport, chanid)] = sock
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_port_forward_request(self, address, port):
+        try:
+            forwarded = ForwardedPort(self.transport, address, port)
+        except OSError:
+            return False
+        with self.server.lock:
+            self.server.forwards[(self.transport, forwarded.port)] = forwarded
+        return forwarded.port
+
+    def cancel_port_forward_request(self, address, port):
+        with self.server.lock:
+            forwarded = self.server.forwards.pop((self.transport, port), None)
+        if forwarded:
+            forwarded.close()
+
+
+class LocalSSHServer(object):
+    """Minimal in-process SSH server that accepts public key logins, tcpip-forward and direct-tcpip requests.
+
+    It stands in for the cloud endpoint in benchmarks, so the forwarding path can be measured without a real sshd.
+    """
+
+    def __init__(self, host_key=None, client_key=None, address=(BIND_ADDRESS, 0)):
+        self.host_key = host_key or paramiko.RSAKey.generate(2048)
+        self.client_key = client_key or paramiko.RSAKey.generate(2048)
+        self.lock = threading.Lock()
+        self.forwards = {}
+        self.pending_direct = {}
+        self.transports = []
+        self.listener = socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(address)
+        self.listener.listen(128)
+        self.address = self.listener.getsockname()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._accept_loop)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def _accept_loop(self):
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            thr = threading.Thread(target=self._serve, args=(sock,))
+            thr.daemon = True
+            thr.start()
+
+    def _serve(self, sock):
+        transport = paramiko.Transport(sock)
+        transport.add_server_key(self.host_key)
+        with self.lock:
+            self.transports.append(transport)
+        try:
+            transport.start_server(server=BenchServerInterface(self, transport))
+        except (paramiko.SSHException, EOFError, OSError):
+            return
+        while transport.is_active():
+            chan = transport.accept(1)
+            if chan is None:
+                continue
+            sock = self.pending_direct.pop((transport, chan.get_id()), None)
+            if sock is None:
+                continue
+            thr = threading.Thread(target=relay, args=(sock, chan))
+            thr.daemon = True
+            thr.start()
+        with self.lock:
+            stale = [self.forwards.pop(key) for key in list(self.forwards) if key[0] is transport]
+        for each in stale:
+            each.close()
+
+    def write_client_files(self, directory, address=None):
+        """Writes the client private key and a known_hosts file for this server, or for a proxy to it at address.
+        Returns their paths"""
+        address = address or self.address
+        key_file = os.path.join(directory, 'bench_client_key')
+        self.client_key.write_private_key_file(key_file)
+        known_hosts = os.path.join(directory, 'bench_known_hosts')
+        with open(known_hosts, 'w') as f:
+            f.write("[%s]:%d %s %s\n" % (address[0], address[1], self.host_key.get_name(),
+                                         self.host_key.get_base64()))
+        return key_file, known_hosts
+
+    def disconnect_all(self):
+        with self.lock:
+            transports, self.transports = self.transports, []
+            forwards, self.forwards = list(self.forwards.values()), {}
+        for each in forwards:
+            each.close()
+        for each in transports:
+            each.close()
+
+    def stop(self):
+        try:
+            self.listener.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.listener.close()
+        self.disconnect_all()
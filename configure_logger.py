@@ -9,12 +9,12 @@ class LogManager:
     path = "./logs"
 
     @staticmethod
-    def configure_logger(filename, level=None, log_to_console=False, name="pytun", path=None):
+    def configure_logger(filename, level=None, log_to_console=False, name="pytun", path=None, with_paramiko=True):
         path = path if path is not None else LogManager.path
         level = level or logging.INFO
         logger = logging.getLogger(name)
         loggers = [logger]
-        if name != "pytun":
+        if name != "pytun" and with_paramiko:
             paramiko_log = logging.getLogger("paramiko")
             loggers.append(paramiko_log)
         try:
@@ -39,3 +39,11 @@ class LogManager:
             if console_handler:
                 each.addHandler(console_handler)
         return logger
+
+    @staticmethod
+    def set_level(level, names):
+        for name in names:
+            logger = logging.getLogger(name)
+            logger.setLevel(level)
+            for handler in logger.handlers:
+                handler.setLevel(level)
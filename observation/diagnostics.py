@@ -0,0 +1,143 @@
+import queue
+import socket
+import threading
+import time
+
+DEFAULT_PARALLELISM = 16
+DEFAULT_DEADLINE = 120
+CONNECTION_TIMEOUT = 2
+
+
+class Diagnostics(object):
+    """Runs independent checks on a bounded number of daemon threads and stops waiting for them at the deadline"""
+
+    def __init__(self, logger, parallelism=DEFAULT_PARALLELISM, deadline=DEFAULT_DEADLINE):
+        self.logger = logger
+        self.parallelism = max(1, int(parallelism))
+        self.deadline = deadline
+
+    def run(self, checks):
+        """checks is a list of (check, connector, callable). Returns the report as a dict"""
+        started_at = time.time()
+        started = time.monotonic()
+        results = [{'check': check, 'connector': connector, 'ok': False, 'error': 'deadline exceeded',
+                    'result': None, 'duration': None} for check, connector, _ in checks]
+        jobs = queue.Queue()
+        for index, (_, _, function) in enumerate(checks):
+            jobs.put((index, function))
+        done = threading.Semaphore(0)
+        for _ in range(min(self.parallelism, len(checks))):
+            worker = threading.Thread(target=self._worker, args=(jobs, results, done))
+            worker.daemon = True
+            worker.start()
+        for _ in checks:
+            remaining = self.deadline - (time.monotonic() - started)
+            if remaining <= 0 or not done.acquire(timeout=remaining):
+                self.logger.error("Diagnostics deadline of %s seconds exceeded", self.deadline)
+                break
+        return {'started_at': started_at,
+                'duration': time.monotonic() - started,
+                'parallelism': self.parallelism,
+                'deadline': self.deadline,
+                'ok': all(each['ok'] for each in results),
+                'checks': results}
+
+    def _worker(self, jobs, results, done):
+        while True:
+            try:
+                index, function = jobs.get_nowait()
+            except queue.Empty:
+                return
+            started = time.monotonic()
+            result = None
+            try:
+                result = function()
+                error = None
+            except Exception as e:
+                error = repr(e)
+            results[index] = dict(results[index], ok=error is None, error=error, result=result,
+                                  duration=time.monotonic() - started)
+            done.release()
+
+
+def check_internet_access(logger, host="8.8.8.8", port=53):
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.settimeout(3)
+            sock.connect((host, port))
+        logger.info("It seems that we are able to access internet")
+        return True
+    except socket.error:
+        logger.error("It seems that the server DOES NOT have internet access")
+        return False
+
+
+def check_connection(tunnel_process, logger):
+    if tunnel_process.mode == 'socks5':
+        logger.info("%s serves SOCKS5, its destinations are checked on each request", tunnel_process.tunnel_name)
+        return
+    for remote_host, remote_port in tunnel_process.upstreams:
+        with socket.socket() as sock:
+            try:
+                sock.settimeout(CONNECTION_TIMEOUT)
+                sock.connect((remote_host, remote_port))
+                logger.info("Connection to %s:%s was successful", remote_host, remote_port)
+            except Exception as e:
+                logger.exception(
+                    "Failed to connect with service %s:%s. Please check that you have internet access, that there is not a firewall blocking the connection or that remote_host and remote_port in your config are correct. Error %r" %
+                    (remote_host, remote_port, e))
+                raise e
+
+
+def check_connector(tunnel_process, logger, test_reverse_forward=True):
+    from paramiko import BadHostKeyException, PasswordRequiredException, AuthenticationException, SSHException
+    tunnel_process.logger = logger
+    try:
+        try:
+            client = tunnel_process.ssh_connect(exit_on_failure=False)
+            transport = client.get_transport()
+        except socket.timeout as e:
+            message = """Failed to connect with  %s:%s. We received a connection timeout. Please check that you have internet access, that you can access to %s using telnet. Error %r"""
+            logger.exception(message % (tunnel_process.server_host, tunnel_process.server_port,
+                                        (tunnel_process.server_host, tunnel_process.server_port), e))
+            raise e
+        try:
+            if test_reverse_forward:
+                try:
+                    transport.request_port_forward("", tunnel_process.remote_port_to_forward)
+                except SSHException as e:
+                    message = """Failed to connect with service %s:%s. We received a Port binding rejected error. That means that we could not open our connector completely.
+                                            Please check server_host, server_port and port in your config.
+                                            Error %r"""
+                    logger.exception(message % (tunnel_process.remote_host, tunnel_process.remote_port, e))
+                    raise e
+        finally:
+            client.close()
+    except BadHostKeyException as e:
+        message = """Failed to connect with service %s:%s. The host key given by the SSH server did not match what
+        we were expecting.
+        The hostname was %s,
+        the expected key was %s,
+        the key that we got was %s
+        Please check server_key in your config.
+        Detailed Error %r"""
+        logger.exception(message % (tunnel_process.remote_host, tunnel_process.remote_port, e.hostname,
+                                    e.expected_key.get_base64(), e.key.get_base64(), e))
+        raise e
+    except PasswordRequiredException as e:
+        message = """Failed to connect with service %s:%s. The private key file is encrypted.
+                    Please check keyfile and username in your config
+                    Error %r"""
+        logger.exception(message % (tunnel_process.remote_host, tunnel_process.remote_port, e))
+        raise e
+    except AuthenticationException as e:
+        message = """Failed to connect with service %s:%s. The private key file was rejected.
+                                Please check keyfile in your config
+                                Error %r"""
+        logger.exception(message % (tunnel_process.remote_host, tunnel_process.remote_port, e))
+        raise e
+    except (socket.timeout, SSHException) as e:
+        raise e
+    except Exception as e:
+        logger.exception("Failed to establish connector %s with error %r" % (tunnel_process.tunnel_name, e))
+        raise e
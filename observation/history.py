@@ -0,0 +1,182 @@
+import mmap
+import os
+import struct
+import time
+from array import array
+
+MAGIC = b'PYTH'
+VERSION = 1
+HEADER = struct.Struct('<4sIIIIqqdd')
+
+DEFAULT_INTERVALS = 1024
+DEFAULT_EVENTS = 1024
+DEFAULT_MINUTES = 1440
+
+# start: the connector is forwarding, exit: its process died, drain: it exited after a drain request,
+# replace: a make-before-break restart, stop: pytun stopped it, lost: pytun itself stopped without recording it,
+# failed: a started process died or timed out before forwarding. New events go last, the files store their index
+EVENTS = ('start', 'exit', 'drain', 'replace', 'stop', 'lost', 'failed')
+DOWN_EVENTS = ('exit', 'drain', 'stop', 'lost', 'failed')
+TRAFFIC_FIELDS = ('connections', 'bytes_up', 'bytes_down', 'errors')
+MINUTE_FIELDS = 1 + len(TRAFFIC_FIELDS)
+
+
+class ConnectorHistory(object):
+    """Uptime intervals, events and per minute traffic of one connector in fixed size ring buffers"""
+    # The caller serializes the calls
+
+    def __init__(self, path=None, intervals=DEFAULT_INTERVALS, events=DEFAULT_EVENTS, minutes=DEFAULT_MINUTES):
+        self.path = path
+        self.interval_capacity = intervals
+        self.event_capacity = events
+        self.minute_capacity = minutes
+        # (start, end) pairs, end is 0 while the interval is open
+        self.intervals = array('d', bytes(8 * 2 * intervals))
+        # (time, index in EVENTS) pairs
+        self.events = array('d', bytes(8 * 2 * events))
+        # (minute since the epoch, *TRAFFIC_FIELDS) per slot, the slot of a minute is minute % minutes
+        self.minutes = array('q', bytes(8 * MINUTE_FIELDS * minutes))
+        self.interval_count = 0
+        self.event_count = 0
+        self.first_seen = time.time()
+        self.saved_at = 0.0
+        self.mmap = None
+        if path:
+            self.open(path)
+
+    def size(self):
+        return HEADER.size + (len(self.intervals) + len(self.events) + len(self.minutes)) * 8
+
+    def open(self, path):
+        exists = os.path.isfile(path) and os.path.getsize(path) == self.size()
+        with open(path, 'r+b' if exists else 'w+b') as f:
+            if not exists:
+                f.truncate(self.size())
+            self.mmap = mmap.mmap(f.fileno(), self.size())
+        if exists:
+            self.load()
+
+    def load(self):
+        magic, version, intervals, events, minutes, interval_count, event_count, first_seen, saved_at = \
+            HEADER.unpack_from(self.mmap, 0)
+        if (magic, version, intervals, events, minutes) != (MAGIC, VERSION, self.interval_capacity,
+                                                             self.event_capacity, self.minute_capacity):
+            return
+        offset = HEADER.size
+        for buffer in (self.intervals, self.events, self.minutes):
+            size = len(buffer) * buffer.itemsize
+            buffer[:] = array(buffer.typecode, self.mmap[offset:offset + size])
+            offset += size
+        self.interval_count, self.event_count = interval_count, event_count
+        self.first_seen, self.saved_at = first_seen, saved_at
+        if self.is_up():
+            # We do not know when it went down, only that it was up at the last snapshot
+            self.close_interval(saved_at)
+            self.add_event('lost', saved_at)
+
+    def snapshot(self):
+        if self.mmap is None:
+            return
+        self.saved_at = time.time()
+        HEADER.pack_into(self.mmap, 0, MAGIC, VERSION, self.interval_capacity, self.event_capacity,
+                         self.minute_capacity, self.interval_count, self.event_count, self.first_seen, self.saved_at)
+        offset = HEADER.size
+        for buffer in (self.intervals, self.events, self.minutes):
+            data = buffer.tobytes()
+            self.mmap[offset:offset + len(data)] = data
+            offset += len(data)
+        self.mmap.flush()
+
+    def close(self):
+        if self.mmap is not None:
+            self.snapshot()
+            self.mmap.close()
+            self.mmap = None
+
+    def is_up(self):
+        if self.interval_count == 0:
+            return False
+        last = (self.interval_count - 1) % self.interval_capacity
+        return self.intervals[2 * last + 1] == 0
+
+    def started(self, event='start', now=None):
+        now = now or time.time()
+        self.add_event(event, now)
+        if not self.is_up():
+            slot = self.interval_count % self.interval_capacity
+            self.intervals[2 * slot] = now
+            self.intervals[2 * slot + 1] = 0
+            self.interval_count += 1
+
+    def stopped(self, event, now=None):
+        now = now or time.time()
+        self.add_event(event, now)
+        self.close_interval(now)
+
+    def close_interval(self, now):
+        if self.is_up():
+            last = (self.interval_count - 1) % self.interval_capacity
+            self.intervals[2 * last + 1] = now
+
+    def add_event(self, event, now):
+        slot = self.event_count % self.event_capacity
+        self.events[2 * slot] = now
+        self.events[2 * slot + 1] = EVENTS.index(event)
+        self.event_count += 1
+
+    def add_traffic(self, connections, bytes_up, bytes_down, errors, now=None):
+        minute = int((now or time.time()) // 60)
+        offset = (minute % self.minute_capacity) * MINUTE_FIELDS
+        if self.minutes[offset] > minute:
+            # Older than what the ring keeps
+            return
+        if self.minutes[offset] != minute:
+            self.minutes[offset:offset + MINUTE_FIELDS] = array('q', (minute, 0, 0, 0, 0))
+        for field, value in enumerate((connections, bytes_up, bytes_down, errors), 1):
+            self.minutes[offset + field] += value
+
+    def query(self, window, series=False, now=None):
+        """Uptime, events and traffic of the last window seconds, or since the oldest data kept if it is shorter"""
+        now = now or time.time()
+        since = max(now - window, self.first_seen)
+        if self.interval_count > self.interval_capacity:
+            oldest = self.interval_count % self.interval_capacity
+            since = max(since, self.intervals[2 * oldest])
+        intervals = []
+        up = 0.0
+        for index in range(max(0, self.interval_count - self.interval_capacity), self.interval_count):
+            slot = index % self.interval_capacity
+            start, end = self.intervals[2 * slot], self.intervals[2 * slot + 1]
+            if end and end < since:
+                continue
+            intervals.append({'start': start, 'end': end or None})
+            up += max(0.0, min(end or now, now) - max(start, since))
+        events = []
+        for index in range(max(0, self.event_count - self.event_capacity), self.event_count):
+            slot = index % self.event_capacity
+            if self.events[2 * slot] >= since:
+                events.append({'at': self.events[2 * slot], 'event': EVENTS[int(self.events[2 * slot + 1])]})
+        first_minute = int(max(since, now - self.minute_capacity * 60) // 60)
+        points = []
+        totals = dict.fromkeys(TRAFFIC_FIELDS, 0)
+        for slot in range(self.minute_capacity):
+            offset = slot * MINUTE_FIELDS
+            if self.minutes[offset] < first_minute:
+                continue
+            values = self.minutes[offset + 1:offset + MINUTE_FIELDS]
+            for name, value in zip(TRAFFIC_FIELDS, values):
+                totals[name] += value
+            points.append([self.minutes[offset] * 60] + values.tolist())
+        res = {'since': since,
+               'up': self.is_up(),
+               'uptime': up,
+               'uptime_ratio': up / (now - since) if now > since else None,
+               'starts': sum(1 for each in events if each['event'] in ('start', 'replace')),
+               'downs': sum(1 for each in events if each['event'] in DOWN_EVENTS),
+               'intervals': intervals,
+               'events': events,
+               'traffic': totals}
+        if series:
+            points.sort()
+            res['series'] = {'fields': ['minute'] + list(TRAFFIC_FIELDS), 'points': points}
+        return res
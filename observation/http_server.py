@@ -1,29 +1,238 @@
-import configparser
+import gzip
+import hashlib
 import os
+import selectors
+import socket
 import tempfile
+import threading
+import time
 import zipfile
 from concurrent.futures.thread import ThreadPoolExecutor
+from functools import partial
 from http import HTTPStatus
-from os.path import realpath
+from urllib.parse import urlparse, parse_qs
 
 from observation.connection_check import ConnectionCheck
+from observation.resource_usage import ResourceUsage
+from tunnel_infra.ControlChannel import call_all
+from tunnel_infra.SamplingProfiler import FORMATS as PROFILE_FORMATS
+from tunnel_infra.TunnelProcess import TunnelProcess
 
-try:
-    from http.server import ThreadingHTTPServer as HttpServer
-except ImportError:
-    from http.server import HTTPServer as HttpServer
-from http.server import SimpleHTTPRequestHandler
+from http.server import HTTPServer, SimpleHTTPRequestHandler
 import json
 
+DEFAULT_PROFILE_SECONDS = 10
+STATS_TIMEOUT = 2
+DEFAULT_HISTORY_WINDOW = 24 * 60 * 60
+# Threads serving requests, a kept alive connection only holds one while it has a request to answer
+DEFAULT_WORKERS = 8
+# Connections waiting for a thread, more are answered with 503
+DEFAULT_QUEUE_SIZE = 32
+# Kept alive connections waiting for their next request, and the seconds each one may wait
+DEFAULT_MAX_IDLE = 64
+KEEP_ALIVE_TIMEOUT = 10
+IDLE_CHECK_INTERVAL = 1
+SERVICE_UNAVAILABLE = (b"HTTP/1.1 503 Service Unavailable\r\nContent-Type: application/json\r\n"
+                       b"Content-Length: 27\r\nConnection: close\r\n\r\n{\"error\": \"server is busy\"}")
+# Seconds a GET response is served to every poller before it is computed again
+DEFAULT_CACHE_TTL = 1
+GZIP_MIN_SIZE = 1024
+
+
+class CachedResponse(object):
+    def __init__(self, body, expires=0):
+        self.body = body
+        self.expires = expires
+        self.etag = '"%s"' % (hashlib.sha1(body).hexdigest(),)
+        self._gzipped = None
+
+    def gzipped(self):
+        if self._gzipped is None:
+            self._gzipped = gzip.compress(self.body)
+        return self._gzipped
+
+
+class ResponseCache(object):
+    """Serialized JSON responses by request path. Concurrent requests for the same path wait for one computation"""
+
+    def __init__(self, ttl=DEFAULT_CACHE_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.path_locks = {}
+
+    def get(self, path, compute):
+        with self.lock:
+            path_lock = self.path_locks.setdefault(path, threading.Lock())
+        try:
+            with path_lock:
+                entry = self.entries.get(path)
+                now = time.monotonic()
+                if entry is None or entry.expires <= now:
+                    entry = CachedResponse(compute(), now + self.ttl)
+                    with self.lock:
+                        # Drop the expired ones, the paths include query strings chosen by the clients
+                        for each in [key for key, value in self.entries.items() if value.expires <= now]:
+                            del self.entries[each]
+                            self.path_locks.pop(each, None)
+                        self.entries[path] = entry
+                return entry
+        finally:
+            with self.lock:
+                # compute() raised, nothing was stored that would drop the lock once expired
+                if path not in self.entries and self.path_locks.get(path) is path_lock:
+                    del self.path_locks[path]
+
+
+class IntrospectionHTTPServer(HTTPServer):
+    """HTTPServer that handles the connections in a bounded pool of threads instead of a thread per request"""
+
+    def __init__(self, address, handler_class, workers=DEFAULT_WORKERS, queue_size=DEFAULT_QUEUE_SIZE,
+                 max_idle=DEFAULT_MAX_IDLE):
+        super().__init__(address, handler_class)
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="introspection")
+        self.max_pending = workers + queue_size
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.idle = selectors.DefaultSelector()
+        self.closed = False
+        # Written to wake up the idle thread when a connection is parked
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.idle.register(self.wakeup_reader, selectors.EVENT_READ)
+        self.idle_thread = threading.Thread(target=self.serve_idle, name="introspection-idle")
+        self.idle_thread.daemon = True
+        self.idle_thread.start()
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            accepted = self.pending < self.max_pending
+            if accepted:
+                self.pending += 1
+        if accepted:
+            self.pool.submit(self.process_request_thread, request, client_address)
+        else:
+            self.reject(request)
+
+    def process_request_thread(self, request, client_address):
+        keep_alive = False
+        try:
+            handler = self.finish_request(request, client_address)
+            keep_alive = not handler.close_connection
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            with self.lock:
+                self.pending -= 1
+            if not (keep_alive and self.park(request, client_address)):
+                self.shutdown_request(request)
+
+    def finish_request(self, request, client_address):
+        return self.RequestHandlerClass(request, client_address, self)
+
+    def reject(self, request):
+        try:
+            request.sendall(SERVICE_UNAVAILABLE)
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def park(self, request, client_address):
+        """Waits in the selector for the next request of a kept alive connection, False if there is no room"""
+        with self.lock:
+            if self.closed or len(self.idle.get_map()) > self.max_idle:
+                return False
+            self.idle.register(request, selectors.EVENT_READ, (client_address, time.monotonic()))
+        try:
+            self.wakeup_writer.send(b'\0')
+        except OSError:
+            pass
+        return True
+
+    def serve_idle(self):
+        while not self.closed:
+            try:
+                ready = self.idle.select(IDLE_CHECK_INTERVAL)
+            except (OSError, ValueError):
+                # The server closed the selector
+                return
+            expired = time.monotonic() - KEEP_ALIVE_TIMEOUT
+            with self.lock:
+                if self.closed:
+                    return
+                readable = [key for key, events in ready if key.fileobj is not self.wakeup_reader]
+                stale = [key for key in self.idle.get_map().values()
+                         if key.fileobj is not self.wakeup_reader and key not in readable and key.data[1] < expired]
+                for key in readable + stale:
+                    self.idle.unregister(key.fileobj)
+            try:
+                while self.wakeup_reader.recv(64):
+                    pass
+            except OSError:
+                pass
+            for key in stale:
+                self.shutdown_request(key.fileobj)
+            for key in readable:
+                self.process_request(key.fileobj, key.data[0])
+
+    def server_close(self):
+        super().server_close()
+        with self.lock:
+            self.closed = True
+            parked = [key.fileobj for key in self.idle.get_map().values() if key.fileobj is not self.wakeup_reader]
+            for each in parked:
+                self.idle.unregister(each)
+        try:
+            self.wakeup_writer.send(b'\0')
+        except OSError:
+            pass
+        self.idle_thread.join()
+        for each in parked:
+            self.shutdown_request(each)
+        self.idle.close()
+        self.wakeup_reader.close()
+        self.wakeup_writer.close()
+        self.pool.shutdown(wait=False)
+
 
 class RequestHandlerClassFactory:
 
-    def get_handler(self, config_path, tunnel_manager_id, log_path, status, version_string, logger):
+    def get_handler(self, config_path, tunnel_manager_id, log_path, status, version_string, logger, processes=None,
+                    restart_requests=None, cache=None, worker_pool=None):
+        cache = cache or ResponseCache()
+        usage = ResourceUsage()
+
         class TunnelRequestHandler(SimpleHTTPRequestHandler):
 
             server_version = "Pytun Introspection web server/" + version_string
             sys_version = "Python/3"
             pytun_Version = version_string
+            protocol_version = "HTTP/1.1"
+            timeout = KEEP_ALIVE_TIMEOUT
+
+            def handle(self):
+                """Answers the requests the client has sent, the server waits for the next ones without a thread"""
+                self.close_connection = True
+                self.responded = False
+                self.handle_one_request()
+                while not self.close_connection and self.has_buffered_request():
+                    self.responded = False
+                    self.handle_one_request()
+
+            def send_response(self, code, message=None):
+                self.responded = True
+                super().send_response(code, message)
+
+            def has_buffered_request(self):
+                # A pipelined request may be in the read buffer already, where the selector would not see it
+                self.connection.settimeout(0)
+                try:
+                    return bool(self.rfile.peek(1))
+                except OSError:
+                    return False
+                finally:
+                    self.connection.settimeout(self.timeout)
 
             def _zipdir(self, path, ziph, filter_callable=None):
                 # ziph is zipfile handle
@@ -39,30 +248,81 @@ class RequestHandlerClassFactory:
 
             def do_GET(self):
                 try:
-                    if self.path == '/configs':
+                    url = urlparse(self.path)
+                    query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                    if url.path == '/configs':
                         return self.handle_configs()
-                    elif self.path == '/status':
-                        res = self.handle_status()
-                    elif self.path == '/logs':
+                    elif url.path == '/status':
+                        compute = self.handle_status
+                    elif url.path == '/status/history':
+                        compute = partial(self.handle_history, query)
+                    elif url.path == '/logs':
                         return self.handle_logs()
+                    elif url.path == '/connections':
+                        compute = partial(self.handle_connections, query)
+                    elif url.path == '/profile':
+                        return self.handle_profile(query)
+                    elif url.path == '/stats':
+                        compute = lambda: {'connectors': self.collect_stats()}
                     else:
-                        res = self.handle_ping()
-                    res['tunnel_manager_id'] = tunnel_manager_id
-                    json_str = json.dumps(res)
-                    self.send_response(200)
-                    self.send_header('Content-Type', 'application/json')
-                    self.end_headers()
-                    self.wfile.write(json_str.encode(encoding='utf_8'))
+                        compute = self.handle_ping
+                    self.send_response_body(cache.get(self.path, lambda: self.to_json(compute())))
                 except Exception as e:
                     logger.exception("Error processing HTTP Request %s: %s" % (self.path, e))
                     self.return_error(e)
 
-            def return_error(self, e):
+            def do_POST(self):
+                try:
+                    # The parameters are in the query string, a body would be read as the next request
+                    self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                    url = urlparse(self.path)
+                    query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                    if url.path == '/control':
+                        res = self.handle_control(query)
+                    elif url.path == '/restart':
+                        res = self.handle_restart(query)
+                    else:
+                        raise ValueError("Unknown path %s" % (url.path,))
+                    self.send_json(res)
+                except Exception as e:
+                    logger.exception("Error processing HTTP Request %s: %s" % (self.path, e))
+                    self.return_error(e)
+
+            def to_json(self, res):
+                res['tunnel_manager_id'] = tunnel_manager_id
+                return json.dumps(res).encode(encoding='utf_8')
+
+            def send_json(self, res):
+                self.send_response_body(CachedResponse(self.to_json(res)))
+
+            def send_response_body(self, response):
+                """Sends a JSON response, 304 if the client has it already and gzipped if it is large and accepted"""
+                if response.etag in [each.strip() for each in self.headers.get('If-None-Match', '').split(',')]:
+                    self.send_response(HTTPStatus.NOT_MODIFIED)
+                    self.send_header('ETag', response.etag)
+                    self.end_headers()
+                    return
+                body = response.body
+                compress = len(body) >= GZIP_MIN_SIZE and 'gzip' in self.headers.get('Accept-Encoding', '')
+                if compress:
+                    body = response.gzipped()
                 self.send_response(200)
                 self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('ETag', response.etag)
+                self.send_header('Cache-Control', 'no-cache')
+                self.send_header('Vary', 'Accept-Encoding')
+                if compress:
+                    self.send_header('Content-Encoding', 'gzip')
                 self.end_headers()
-                self.wfile.write(
-                    json.dumps({"error": str(e), "tunnel_manager_id": tunnel_manager_id}).encode(encoding='utf_8'))
+                self.wfile.write(body)
+
+            def return_error(self, e):
+                if self.responded:
+                    # Part of a response was sent already, the client can only tell it failed by the closed connection
+                    self.close_connection = True
+                    return
+                self.send_json({"error": str(e)})
 
             def handle_configs(self):
                 try:
@@ -84,8 +344,92 @@ class RequestHandlerClassFactory:
             def handle_status(self):
                 res = status.to_dict()
                 res.update(self.add_services_status())
+                res['connectors'] = self.collect_stats()
+                res['degraded'] = sorted(name for name, stats in res['connectors'].items()
+                                         if stats.get('probes', {}).get('degraded'))
+                res['usage'] = usage.measure(processes, worker_pool)
                 return res
 
+            def handle_history(self, query):
+                """Uptime, start and stop events and traffic of the last window seconds"""
+                window = float(query.get('window', DEFAULT_HISTORY_WINDOW))
+                series = query.get('series', 'false').lower() in ('1', 'true', 'yes')
+                return {'window': window,
+                        'connectors': status.history_to_dict(window, series, query.get('connector'))}
+
+            def collect_stats(self):
+                res = {}
+                for tunnel_process, stats, error in call_all(list((processes or {}).values()), 'get-stats',
+                                                             timeout=STATS_TIMEOUT):
+                    res[tunnel_process.tunnel_name] = stats if error is None else {'error': str(error)}
+                return res
+
+            def handle_control(self, query):
+                """Runs query['command'] on query['connector'], the other parameters are the command arguments"""
+                arguments = dict(query)
+                tunnel_process = self.get_process(arguments.pop('connector', None))
+                command = arguments.pop('command', None)
+                if command == 'drain':
+                    result = tunnel_process.drain(float(arguments['timeout']) if 'timeout' in arguments else None)
+                else:
+                    result = tunnel_process.call(command, **arguments)
+                return {'connector': tunnel_process.tunnel_name, 'command': command, 'result': result}
+
+            def handle_connections(self, query):
+                """Live and recent connections of each connector"""
+                min_duration = float(query.get('min_duration', 0))
+                min_connect_time = float(query.get('min_connect_time', 0))
+                limit = int(query.get('limit', 0))
+                res = {}
+                for tunnel_process in list((processes or {}).values()):
+                    if query.get('connector') not in (None, tunnel_process.tunnel_name):
+                        continue
+                    connections = [each for each in tunnel_process.connection_trace.snapshot()
+                                   if query.get('state') in (None, each['state']) and
+                                   each['duration'] >= min_duration and
+                                   (each['connect_time'] or 0) >= min_connect_time]
+                    res[tunnel_process.tunnel_name] = connections[-limit:] if limit else connections
+                return {'connections': res}
+
+            def handle_restart(self, query):
+                """Queues a make-before-break restart of query['connector'], or of every connector with 'all'"""
+                if restart_requests is None:
+                    raise RuntimeError("Restarts are not available")
+                tunnel_name = query.get('connector')
+                restarting = []
+                for key, tunnel_process in list(processes.items()):
+                    if tunnel_name in ('all', tunnel_process.tunnel_name):
+                        restart_requests.put(key)
+                        restarting.append(tunnel_process.tunnel_name)
+                if not restarting:
+                    raise KeyError("Unknown connector %s" % (tunnel_name,))
+                return {'restarting': restarting}
+
+            def get_process(self, tunnel_name):
+                for tunnel_process in list((processes or {}).values()):
+                    if tunnel_process.tunnel_name == tunnel_name:
+                        return tunnel_process
+                raise KeyError("Unknown connector %s" % (tunnel_name,))
+
+            def handle_profile(self, query):
+                output_format = query.get('format', 'collapsed')
+                if output_format not in PROFILE_FORMATS:
+                    raise ValueError("format must be one of %s" % (', '.join(PROFILE_FORMATS),))
+                tunnel_process = self.get_process(query.get('connector'))
+                result = tunnel_process.profile(float(query.get('seconds', DEFAULT_PROFILE_SECONDS)), output_format)
+                if result is None:
+                    raise RuntimeError("Connector %s failed to profile, check its log" % (tunnel_process.tunnel_name,))
+                if output_format == 'pstats':
+                    content_type = 'application/octet-stream'
+                else:
+                    content_type = 'text/plain; charset=utf-8'
+                    result = result.encode(encoding='utf_8')
+                self.send_response(HTTPStatus.OK)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(result)))
+                self.end_headers()
+                self.wfile.write(result)
+
             def handle_logs(self):
                 try:
                     temp_dir = tempfile.gettempdir()
@@ -115,19 +459,26 @@ class RequestHandlerClassFactory:
                     for file in files:
                         if file[-4:] == ".ini":
                             try:
-                                config = configparser.ConfigParser()
-                                config.read(os.path.join(path, file))
-                                defaults = config['tunnel']
-                                remote_host = defaults['remote_host']
-                                remote_port = int(defaults.get('remote_port'))
-                                tunnel_name = defaults.get('tunnel_name', realpath(file))
-                                res[tunnel_name] = {'remote_host':remote_host, 'remote_port':remote_port}
-                                jobs[tunnel_name] = pool.submit(connection_checker.test_connection, tunnel_name, remote_host, remote_port)
+                                config = TunnelProcess.read_config(os.path.join(path, file))
+                                if config['mode'] == 'socks5':
+                                    # It has no service of its own to check
+                                    continue
+                                tunnel_name = config['tunnel_name']
+                                res[tunnel_name] = {'remote_host': config['remote_host'],
+                                                    'remote_port': config['remote_port'],
+                                                    'upstreams': [{'remote_host': host, 'remote_port': port}
+                                                                  for host, port in config['upstreams']]}
+                                jobs[tunnel_name] = [pool.submit(connection_checker.test_connection, tunnel_name,
+                                                                 host, port)
+                                                     for host, port in config['upstreams']]
                             except Exception as e:
                                 logger.exception("Error getting status for %s" % (file,))
                                 continue
-                    for name, job_future in jobs.items():
-                        res[name]['status'] = job_future.result()
+                    for name, job_futures in jobs.items():
+                        for upstream, job_future in zip(res[name]['upstreams'], job_futures):
+                            upstream['status'] = job_future.result()
+                        # Up if any of its upstreams answers
+                        res[name]['status'] = any(each['status'] for each in res[name]['upstreams'])
                 pool.shutdown()
                 return res
 
@@ -138,9 +489,12 @@ class RequestHandlerClassFactory:
         return TunnelRequestHandler
 
 
-def inspection_http_server(config_path, tunnel_manager_id, log_path, status, version_string, address, logger):
+def inspection_http_server(config_path, tunnel_manager_id, log_path, status, version_string, address, logger,
+                           processes=None, restart_requests=None, workers=DEFAULT_WORKERS, cache_ttl=DEFAULT_CACHE_TTL,
+                           worker_pool=None, queue_size=DEFAULT_QUEUE_SIZE, max_idle=DEFAULT_MAX_IDLE):
     handler_class = RequestHandlerClassFactory().get_handler(config_path, tunnel_manager_id, log_path, status,
-                                                             version_string, logger)
+                                                             version_string, logger, processes, restart_requests,
+                                                             ResponseCache(cache_ttl), worker_pool)
 
-    http_server = HttpServer(address, handler_class)
+    http_server = IntrospectionHTTPServer(address, handler_class, workers, queue_size, max_idle)
     return http_server
@@ -0,0 +1,79 @@
+import os
+import threading
+import time
+
+import psutil
+
+USAGE_TIMEOUT = 2
+
+
+class ResourceUsage(object):
+    """RSS and CPU of pytun, its connector processes and its workers, measured with psutil"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (monotonic time, cpu seconds) of the previous measure by key
+        self.samples = {}
+
+    def measure(self, processes, worker_pool=None):
+        with self.lock:
+            now = time.monotonic()
+            samples, self.samples = self.samples, {}
+            res = {'supervisor': self.process_usage(os.getpid(), now, samples), 'workers': {}, 'connectors': {}}
+            connectors = [each for each in list((processes or {}).values()) if each.is_alive()]
+            if worker_pool:
+                for worker in worker_pool.live_workers():
+                    res['workers'][worker.name] = self.worker_usage(worker, connectors, now, samples, res)
+            else:
+                for each in connectors:
+                    usage = self.process_usage(each.pid, now, samples)
+                    usage['worker'] = None
+                    res['connectors'][each.tunnel_name] = usage
+            res['total_rss'] = sum(each.get('rss', 0) for each in [res['supervisor']] + list(res['workers'].values())) \
+                + (0 if worker_pool else sum(each.get('rss', 0) for each in res['connectors'].values()))
+            return res
+
+    def worker_usage(self, worker, connectors, now, samples, res):
+        usage = self.process_usage(worker.pid, now, samples)
+        names = [each.tunnel_name for each in connectors if each.worker is worker]
+        usage['connectors'] = names
+        try:
+            cpu = worker.call('get-usage', timeout=USAGE_TIMEOUT)['connectors']
+        except Exception as e:
+            usage['error'] = str(e)
+            cpu = {}
+        for name in names:
+            cpu_seconds = cpu.get(name)
+            res['connectors'][name] = {'pid': worker.pid,
+                                       'worker': worker.name,
+                                       'rss': usage['rss'] // len(names) if 'rss' in usage else None,
+                                       'cpu_seconds': cpu_seconds,
+                                       'cpu_percent': self.cpu_percent(('connector', name), cpu_seconds, now,
+                                                                       samples)}
+        return usage
+
+    def process_usage(self, pid, now, samples):
+        try:
+            process = psutil.Process(pid)
+            with process.oneshot():
+                memory = process.memory_info()
+                times = process.cpu_times()
+                threads = process.num_threads()
+        except psutil.Error as e:
+            return {'pid': pid, 'error': str(e)}
+        cpu_seconds = times.user + times.system
+        return {'pid': pid,
+                'rss': memory.rss,
+                'threads': threads,
+                'cpu_seconds': cpu_seconds,
+                'cpu_percent': self.cpu_percent(('process', pid), cpu_seconds, now, samples)}
+
+    def cpu_percent(self, key, cpu_seconds, now, samples):
+        if cpu_seconds is None:
+            return None
+        self.samples[key] = (now, cpu_seconds)
+        previous = samples.get(key)
+        # A restarted connector counts from zero again
+        if previous is None or now <= previous[0] or cpu_seconds < previous[1]:
+            return None
+        return 100.0 * (cpu_seconds - previous[1]) / (now - previous[0])
@@ -0,0 +1,47 @@
+import importlib
+import sys
+import time
+from contextlib import contextmanager
+
+# Modules that pytun only imports on some code paths, in the order a full start would import them
+PROFILED_MODULES = ['configparser', 'multiprocessing', 'logging.handlers', 'paramiko', 'cryptography', 'psutil',
+                    'coloredlogs', 'requests', 'email_validator', 'alerts.email_alert', 'alerts.http_post_alert',
+                    'observation.http_server', 'tunnel_infra.TunnelProcess']
+
+
+class StartupProfile(object):
+
+    def __init__(self):
+        self.created_at = time.perf_counter()
+        self.imports = {}
+        self.phases = {}
+
+    def profile_imports(self, modules=None):
+        for name in modules or PROFILED_MODULES:
+            already_loaded = name in sys.modules
+            started = time.perf_counter()
+            try:
+                importlib.import_module(name)
+                error = None
+            except ImportError as e:
+                error = str(e)
+            self.imports[name] = {'seconds': time.perf_counter() - started, 'already_loaded': already_loaded,
+                                  'error': error}
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - started
+
+    def to_dict(self, startup_report=None):
+        res = {'imports': self.imports,
+               'phases': self.phases,
+               'total_seconds': time.perf_counter() - self.created_at}
+        if startup_report is not None:
+            res['time_to_first_forward'] = {name: data['time_to_forward']
+                                            for name, data in startup_report['connectors'].items()}
+            res['time_to_all_forwarding'] = startup_report['time_to_all_forwarding']
+        return res
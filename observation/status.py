@@ -1,23 +1,88 @@
+import copy
 import datetime
+import os
 from threading import RLock
 
+from observation.history import ConnectorHistory, DEFAULT_MINUTES
+
 
 class Status:
 
-    def __init__(self):
+    def __init__(self, history_path=None, history_minutes=DEFAULT_MINUTES):
         self.rlock = RLock()
         self.status_data = {}
+        self.startup = None
         self.created_at = datetime.datetime.now()
+        self.history_path = history_path
+        self.history_minutes = history_minutes
+        self.histories = {}
+        # Last cumulative counters received from each connector process, to turn them into per minute traffic
+        self.last_stats = {}
+
+    def history(self, tunnel_name):
+        if tunnel_name not in self.histories:
+            path = None
+            if self.history_path:
+                name = os.path.splitext(os.path.basename(tunnel_name))[0]
+                path = os.path.join(self.history_path, name + ".history")
+            self.histories[tunnel_name] = ConnectorHistory(path, minutes=self.history_minutes)
+        return self.histories[tunnel_name]
 
-    def start_tunnel(self, tunnel_name):
+    def start_tunnel(self, tunnel_name, event='start'):
         with self.rlock:
             if tunnel_name in self.status_data:
                 self.status_data[tunnel_name]['started_times'] += 1
             else:
                 self.status_data[tunnel_name] = {'started_times': 1}
             self.status_data[tunnel_name]['last_start'] = datetime.datetime.now().timestamp()
+            self.history(tunnel_name).started(event)
+
+    def resume_tunnel(self, tunnel_name):
+        """start_tunnel() unless its uptime interval is open already"""
+        with self.rlock:
+            if not self.history(tunnel_name).is_up():
+                self.start_tunnel(tunnel_name)
+
+    def stop_tunnel(self, tunnel_name, event):
+        with self.rlock:
+            self.history(tunnel_name).stopped(event)
+
+    def stop_all(self, event):
+        with self.rlock:
+            for each in self.histories.values():
+                if each.is_up():
+                    each.stopped(event)
+
+    def record_stats(self, tunnel_name, stats):
+        """Adds the traffic since the previous get-stats of the connector to its history"""
+        # A connector hosted by a worker restarts in the same process, its start time tells the runs apart
+        current = ((stats.get('pid'), stats.get('started_at')), stats.get('connections_total', 0),
+                   stats.get('bytes_up', 0), stats.get('bytes_down', 0), stats.get('connection_errors', 0))
+        with self.rlock:
+            last = self.last_stats.get(tunnel_name)
+            self.last_stats[tunnel_name] = current
+            if last is None or last[0] != current[0]:
+                # A new run counts from zero
+                last = (None, 0, 0, 0, 0)
+            self.history(tunnel_name).add_traffic(*[max(0, now - before) for now, before in zip(current[1:], last[1:])])
+
+    def snapshot(self):
+        with self.rlock:
+            for each in self.histories.values():
+                each.snapshot()
+
+    def record_startup(self, report):
+        with self.rlock:
+            self.startup = report
+
+    def history_to_dict(self, window, series=False, tunnel_name=None):
+        with self.rlock:
+            return {name: each.query(window, series) for name, each in self.histories.items()
+                    if tunnel_name in (None, name, os.path.splitext(os.path.basename(name))[0])}
 
     def to_dict(self):
         with self.rlock:
+            # A copy, the caller serializes it without the lock
             return {'created_at': self.created_at.timestamp(),
-                    'status_data': self.status_data}
+                    'status_data': copy.deepcopy(self.status_data),
+                    'startup': copy.deepcopy(self.startup)}
@@ -1,37 +1,53 @@
 import argparse
 import configparser
+import json
+import multiprocessing
 import os
+import queue
 import signal
-import socket
 import sys
 import threading
 import time
 from concurrent.futures.thread import ThreadPoolExecutor
+from functools import partial
 from multiprocessing import freeze_support
 from os import listdir
 from os.path import isabs, dirname, realpath
 from os.path import isfile, join
-import coloredlogs
-from paramiko import BadHostKeyException, PasswordRequiredException, AuthenticationException, SSHException
-import psutil
 
-from alerts.email_alert import EmailAlertSender
-from alerts.http_post_alert import HTTPPostAlertSender
 from alerts.pooled_alerter import DifferentThreadAlert
 from configure_logger import LogManager
-from observation.connection_check import ConnectionCheck
-from observation.http_server import inspection_http_server
+from observation.diagnostics import Diagnostics, DEFAULT_PARALLELISM, DEFAULT_DEADLINE, check_connection, \
+    check_connector, check_internet_access
+from observation.history import DEFAULT_MINUTES as DEFAULT_HISTORY_MINUTES
+from observation.startup_profile import StartupProfile
 from observation.status import Status
-from tunnel_infra.TunnelProcess import TunnelProcess
+from tunnel_infra.StartupScheduler import StartupScheduler, DEFAULT_MAX_CONCURRENT, DEFAULT_START_RATE, \
+    DEFAULT_HANDSHAKE_TIMEOUT
+from tunnel_infra.ControlChannel import call_all
+from tunnel_infra.TunnelProcess import TunnelProcess, HANDOFF_TIMEOUT
+from tunnel_infra.WorkerPool import WorkerPool
 from tunnel_infra.pathtype import PathType
 from version import __version__
 
 freeze_support()
 
 INI_FILENAME = 'connector.ini'
+CHECK_INTERVAL = 30
+
+DEFAULT_START_METHOD = 'forkserver'
+# Imported once in the forkserver template so each connector is forked with them already loaded
+FORKSERVER_PRELOAD = ['paramiko', 'cryptography', 'configure_logger', 'tunnel_infra.TunnelProcess',
+                      'tunnel_infra.WorkerProcess']
 
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        from bench.runner import main as bench_main
+        sys.exit(bench_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'faults':
+        from bench.faults import main as faults_main
+        sys.exit(faults_main(sys.argv[2:]))
     parser = argparse.ArgumentParser(description='Tunnel')
     parser.add_argument("--config_ini", dest="config_ini", help="Configuration file to use", default=INI_FILENAME,
                         type=PathType(dash_ok=False))
@@ -49,8 +65,21 @@ def main():
                         help="Test to establish each one of the connectors", action='store_true',
                         default=False)
     parser.add_argument("--test_all", dest="test_all", help="Test connections", action="store_true", default=False)
+    parser.add_argument("--parallelism", dest="parallelism", help="Checks run at the same time by the --test_* modes",
+                        type=int, default=DEFAULT_PARALLELISM)
+    parser.add_argument("--deadline", dest="deadline", help="Seconds to wait for all the checks of the --test_* modes",
+                        type=float, default=DEFAULT_DEADLINE)
+    parser.add_argument("--report_json", dest="report_json",
+                        help="Write the result of the --test_* modes as JSON to this file ('-' for stdout)",
+                        default=None)
+    parser.add_argument("--profile-startup", dest="profile_startup",
+                        help="Start every connector, print import, config parse and time-to-first-forward timings "
+                             "as JSON and exit", action="store_true", default=False)
     parser.add_argument('-v', '--version', action='version', version='%(prog)s ' + __version__)
     args = parser.parse_args()
+    profile = StartupProfile()
+    if args.profile_startup:
+        profile.profile_imports()
     config = configparser.ConfigParser()
     if not isabs(args.config_ini):
         ini_path = join(dirname(realpath(__file__)), args.config_ini)
@@ -59,15 +88,17 @@ def main():
     pytun_ini_path = join(dirname(realpath(__file__)), 'pytun.ini')
     if os.path.isfile(pytun_ini_path) and not os.path.isfile(join(dirname(realpath(__file__)), INI_FILENAME)):
         os.rename(pytun_ini_path, join(dirname(realpath(__file__)), INI_FILENAME))
-    if os.path.isfile(ini_path):
-        config.read(ini_path)
-        if 'config-connector' in config:
-            params = config['config-connector']
+    with profile.phase('config_parse'):
+        if os.path.isfile(ini_path):
+            config.read(ini_path)
+            if 'config-connector' in config:
+                params = config['config-connector']
+            else:
+                params = config['pytun']
         else:
-            params = config['pytun']
-    else:
-        params = {}
-    test_something = args.test_mail or args.test_http or args.test_connections or args.test_connectors
+            params = {}
+    test_something = args.test_mail or args.test_http or args.test_connections or args.test_connectors or \
+        args.profile_startup
     tunnel_manager_id = params.get("tunnel_manager_id", '')
     log_path = params.get("log_path", './logs')
     if not isabs(log_path):
@@ -83,6 +114,7 @@ def main():
     if tunnel_manager_id is None:
         logger.error("tunnel_manager_id not set in the config file")
         sys.exit(1)
+    configure_start_method(logger, params)
     smtp_sender = get_smtp_alert_sender(logger, tunnel_manager_id, params)
 
     if args.test_mail:
@@ -104,13 +136,20 @@ def main():
     files = [join(tunnel_path, f) for f in listdir(tunnel_path) if isfile(join(tunnel_path, f)) and f[-4:] == '.ini']
     processes = {}
 
+    diagnostics = Diagnostics(logger, parallelism=args.parallelism, deadline=args.deadline)
+
     if args.test_connections:
-        test_connections_and_exit(files, logger, processes)
+        test_connections_and_exit(files, logger, diagnostics, args.report_json)
 
     if args.test_connectors:
-        test_tunnels_and_exit(files, logger, processes)
+        test_tunnels_and_exit(files, logger, diagnostics, args.report_json)
+
+    if args.profile_startup:
+        profile_startup_and_exit(files, logger, processes, params, profile)
 
     if args.test_all:
+        import coloredlogs
+        from observation.http_server import inspection_http_server
         coloredlogs.install(level='DEBUG', logger=logger)
         http_inspection_thread = None
 
@@ -130,7 +169,8 @@ def main():
                 logger.exception(
                     f"Couldn't start inspection HTTP server. Address {address[0]}:{address[1]} already in use. "
                     f"Exception: {e}")
-        test_everything(files, logger, processes, introspection_thread=http_inspection_thread)
+        test_everything(files, logger, diagnostics, introspection_thread=http_inspection_thread,
+                        report_path=args.report_json)
         logger.info("Press Enter to continue...")
         input()
         sys.exit(0)
@@ -140,18 +180,34 @@ def main():
     pool = ThreadPoolExecutor(1)
     main_sender = DifferentThreadAlert(senders, pool)
 
-    status = Status()
+    status = get_status(log_path, params)
+    scheduler = get_startup_scheduler(logger, params)
+    worker_pool = get_worker_pool(logger, params, files)
+    factory = worker_pool.from_config_file if worker_pool else TunnelProcess.from_config_file
 
-    start_tunnels(files, logger, processes, senders, status)
+    start_tunnels(files, logger, processes, senders, status, scheduler, factory)
 
     if len(processes) == 0:
         logger.exception("No config files found")
         sys.exit(1)
 
-    register_signal_handlers(processes, pool)
+    restart_requests = queue.Queue()
+    retiring = []
+    register_signal_handlers(processes, pool, restart_requests, retiring, status, worker_pool, scheduler)
+    config_mtimes = get_config_mtimes(files)
 
+    from observation.http_server import inspection_http_server, DEFAULT_WORKERS as DEFAULT_INSPECTION_WORKERS, \
+        DEFAULT_CACHE_TTL, DEFAULT_QUEUE_SIZE as DEFAULT_INSPECTION_QUEUE_SIZE, \
+        DEFAULT_MAX_IDLE as DEFAULT_INSPECTION_MAX_IDLE
     http_inspection = inspection_http_server(tunnel_path, tunnel_manager_id, LogManager.path, status, __version__,
-                                             get_inspection_address(params), logger)
+                                             get_inspection_address(params), logger, processes, restart_requests,
+                                             workers=params.getint('inspection_workers', DEFAULT_INSPECTION_WORKERS),
+                                             cache_ttl=params.getfloat('inspection_cache_ttl', DEFAULT_CACHE_TTL),
+                                             worker_pool=worker_pool,
+                                             queue_size=params.getint('inspection_queue_size',
+                                                                      DEFAULT_INSPECTION_QUEUE_SIZE),
+                                             max_idle=params.getint('inspection_max_idle',
+                                                                    DEFAULT_INSPECTION_MAX_IDLE))
     http_inspection_thread = threading.Thread(target=lambda: http_inspection.serve_forever())
     http_inspection_thread.daemon = True
     http_inspection_thread.start()
@@ -159,14 +215,55 @@ def main():
     while True:
         items = list(processes.items())
         to_restart = []
-        check_tunnels(files, items, logger, processes, to_restart, pool, main_sender)
-        restart_tunnels(files, logger, processes, to_restart, senders, status)
+        check_tunnels(files, items, logger, processes, to_restart, pool, main_sender, status)
+        record_history(files, logger, processes, status)
+        restart_tunnels(files, logger, processes, to_restart, senders, status, scheduler, factory)
         if not http_inspection_thread.is_alive():
             http_inspection_thread.join()
             http_inspection_thread = threading.Thread(target=lambda: http_inspection.serve_forever())
             http_inspection_thread.daemon = True
             http_inspection_thread.start()
-        time.sleep(30)
+        detect_config_changes(files, config_mtimes, logger, processes, restart_requests)
+        handle_restart_requests(files, logger, processes, restart_requests, senders, status, retiring,
+                                CHECK_INTERVAL, factory)
+
+
+def configure_start_method(logger, params):
+    start_method = params.get('process_start_method', DEFAULT_START_METHOD)
+    if start_method not in multiprocessing.get_all_start_methods():
+        logger.debug("Start method %s is not available, using %s", start_method, multiprocessing.get_start_method())
+        return
+    if start_method == 'forkserver':
+        multiprocessing.set_forkserver_preload(FORKSERVER_PRELOAD)
+    multiprocessing.set_start_method(start_method, force=True)
+
+
+def get_status(log_path, params):
+    history_path = params.get('history_path', join(log_path, 'history'))
+    if not isabs(history_path):
+        history_path = join(dirname(realpath(__file__)), history_path)
+    if not os.path.isdir(history_path):
+        os.makedirs(history_path)
+    return Status(history_path, history_minutes=int(params.get('history_minutes', DEFAULT_HISTORY_MINUTES)))
+
+
+def get_startup_scheduler(logger, params):
+    return StartupScheduler(logger,
+                            max_concurrent=int(params.get('startup_concurrency', DEFAULT_MAX_CONCURRENT)),
+                            # startup_handshake_rate is its former name
+                            start_rate=float(params.get('startup_rate', params.get('startup_handshake_rate',
+                                                                                   DEFAULT_START_RATE))),
+                            handshake_timeout=float(params.get('startup_handshake_timeout',
+                                                               DEFAULT_HANDSHAKE_TIMEOUT)))
+
+
+def get_worker_pool(logger, params, files):
+    """None unless connector_workers asks to run the connectors in that many worker processes"""
+    count = int(params.get('connector_workers', 0))
+    if count <= 0:
+        return None
+    logger.info("Running %d connectors in %d worker processes", len(files), count)
+    return WorkerPool(count, files, params.get("log_level", "INFO"))
 
 
 def get_inspection_address(params):
@@ -174,7 +271,7 @@ def get_inspection_address(params):
     return "127.0.0.1" if only_local else "0.0.0.0", params.getint('inspection_port', 9999)
 
 
-def test_everything(files, logger, processes, introspection_thread=None):
+def test_everything(files, logger, diagnostics, introspection_thread=None, report_path=None):
     logger.info("We will check your installation and configuration")
     service_up = test_service_is_running(logger)
     if not service_up:
@@ -183,25 +280,27 @@ def test_everything(files, logger, processes, introspection_thread=None):
         logger.info("The service is not running! You won't be able to access your services from the cloud")
         if introspection_thread:
             introspection_thread.start()
-    failed_connection = test_connections(files, logger, processes)
-    if not failed_connection:
-        logger.info("All the services are reachable!")
-    else:
-        logger.info("Not all the services were reachable, please check the output")
     if service_up:
         logger.info(
             "We will partially test the tunnels because the service is up. If you need further testing, please stop the service and repeat the test")
-    failed_tunnels = test_tunnels(files, logger, test_reverse_forward=not service_up)
-    if not failed_tunnels:
+    report = diagnostics.run(get_connection_checks(files, logger) +
+                             get_tunnel_checks(files, logger, test_reverse_forward=not service_up))
+    if not has_failed(report, 'connection'):
+        logger.info("All the services are reachable!")
+    else:
+        logger.info("Not all the services were reachable, please check the output")
+    if not has_failed(report, 'connector'):
         logger.info("All the connectors seem to work!")
     else:
         logger.info("Not all the connectors are working, check the output!")
+    write_report(report, report_path)
 
 
 def test_service_is_running(logger, service_name='InvGateTunnel'):
     logger.info("Going to check the status of the service")
     if os.name == 'nt':
         try:
+            import psutil
             service = psutil.win_service_get(service_name)
             service = service.as_dict()
         except Exception as e:
@@ -213,9 +312,10 @@ def test_service_is_running(logger, service_name='InvGateTunnel'):
     return False
 
 
-def test_tunnels_and_exit(files, logger, processes):
-    failed = test_tunnels(files, logger)
-    if failed:
+def test_tunnels_and_exit(files, logger, diagnostics, report_path=None):
+    report = diagnostics.run(get_tunnel_checks(files, logger))
+    write_report(report, report_path)
+    if has_failed(report, 'connector'):
         logger.error("Some connectors failed!")
         sys.exit(4)
     else:
@@ -223,89 +323,25 @@ def test_tunnels_and_exit(files, logger, processes):
         sys.exit(0)
 
 
-def test_tunnels(files, logger, test_reverse_forward=True):
-    failed = False
-    for each in range(len(files)):
+def get_tunnel_checks(files, logger, test_reverse_forward=True):
+    def check(config_file):
+        logger.info("Going to start connector from file %s", config_file)
         try:
-            config_file = files[each]
-            logger.info("Going to start connector from file %s", config_file)
-            try:
-                tunnel_process = TunnelProcess.from_config_file(config_file, [])
-            except Exception as e:
-                logger.exception(
-                    "Failed to create connector from file %s. Configuration file may be incorrect. Error detail %s",
-                    config_file, e)
-                failed = True
-                continue
-            tunnel_process.logger = logger
-            try:
-                client = tunnel_process.ssh_connect(exit_on_failure=False)
-                transport = client.get_transport()
-            except socket.timeout as e:
-                message = """Failed to connect with  %s:%s. We received a connection timeout. Please check that you have internet access, that you can access to %s using telnet. Error %r"""
-                logger.exception(message % (tunnel_process.server_host, tunnel_process.server_port,
-                                            (tunnel_process.server_host, tunnel_process.server_port), e))
-                failed = True
-                continue
-            if test_reverse_forward:
-                try:
-                    transport.request_port_forward("", tunnel_process.remote_port_to_forward)
-                    transport.close()
-                except SSHException as e:
-                    message = """Failed to connect with service %s:%s. We received a Port binding rejected error. That means that we could not open our connector completely.
-                                            Please check server_host, server_port and port in your config.
-                                            Error %r"""
-                    logger.exception(message % (tunnel_process.remote_host, tunnel_process.remote_port, e))
-                    failed = True
-                    continue
-            client.close()
-        except BadHostKeyException as e:
-            message = """Failed to connect with service %s:%s. The host key given by the SSH server did not match what 
-            we were expecting.
-            The hostname was %s, 
-            the expected key was %s, 
-            the key that we got was %s
-            Please check server_key in your config.
-            Detailed Error %r"""
-            logger.exception(message % (tunnel_process.remote_host, tunnel_process.remote_port, e.hostname,
-                                        e.expected_key.get_base64(), e.key.get_base64(), e))
-            failed = True
-        except AuthenticationException as e:
-            message = """Failed to connect with service %s:%s. The private key file was rejected. 
-                                    Please check keyfile in your config
-                                    Error %r"""
-            logger.exception(message % (tunnel_process.remote_host, tunnel_process.remote_port, e))
-            failed = True
-        except PasswordRequiredException as e:
-            message = """Failed to connect with service %s:%s. The private key file is encrypted. 
-                        Please check keyfile and username in your config
-                        Error %r"""
-            logger.exception(message % (tunnel_process.remote_host, tunnel_process.remote_port, e))
-            failed = True
-
+            tunnel_process = TunnelProcess.from_config_file(config_file, [])
         except Exception as e:
-            failed = True
-            logger.exception("Failed to establish connector %s with error %r" %
-                             (tunnel_process.tunnel_name, e))
-    return failed
+            logger.exception(
+                "Failed to create connector from file %s. Configuration file may be incorrect. Error detail %s",
+                config_file, e)
+            raise e
+        check_connector(tunnel_process, logger, test_reverse_forward=test_reverse_forward)
 
+    return [('connector', config_file, partial(check, config_file)) for config_file in files]
 
-def test_internet_access(logger):
-    host = "8.8.8.8"
-    port = 53
-    try:
-        socket.setdefaulttimeout(3)
-        socket.socket(socket.AF_INET, socket.SOCK_STREAM).connect((host, port))
-        logger.info("It seems that we are able to access internet")
-        return True
-    except socket.error as ex:
-        logger.error("It seems that the server DOES NOT have internet access")
-        return False
-
-
-def test_connections_and_exit(files, logger, processes):
-    failed = test_connections(files, logger, processes)
-    if failed:
+
+def test_connections_and_exit(files, logger, diagnostics, report_path=None):
+    report = diagnostics.run(get_connection_checks(files, logger))
+    write_report(report, report_path)
+    if has_failed(report, 'connection'):
         logger.error("Some connections failed!")
         sys.exit(3)
     else:
@@ -313,22 +349,43 @@ def test_connections_and_exit(files, logger, processes):
         sys.exit(0)
 
 
-def test_connections(files, logger, processes):
-    create_tunnels_from_config([], files, logger, processes)
-    failed = False
-    test_internet_access(logger)
-    for key, tunnel_proc in processes.items():
-        with socket.socket() as sock:
-            try:
-                sock.settimeout(2)
-                sock.connect((tunnel_proc.remote_host, tunnel_proc.remote_port))
-                logger.info("Connection to %s:%s was successful", tunnel_proc.remote_host, tunnel_proc.remote_port)
-            except Exception as e:
-                logger.exception(
-                    "Failed to connect with service %s:%s. Please check that you have internet access, that there is not a firewall blocking the connection or that remote_host and remote_port in your config are correct. Error %r" %
-                    (tunnel_proc.remote_host, tunnel_proc.remote_port, e))
-                failed = True
-    return failed
+def get_connection_checks(files, logger):
+    def check(config_file):
+        try:
+            tunnel_process = TunnelProcess.from_config_file(config_file, [])
+        except Exception as e:
+            logger.exception("Failed to create connector from file %s: %s", config_file, e)
+            raise e
+        check_connection(tunnel_process, logger)
+
+    return [('internet', None, partial(check_internet_access, logger))] + \
+           [('connection', config_file, partial(check, config_file)) for config_file in files]
+
+
+def has_failed(report, *checks):
+    return any(not each['ok'] for each in report['checks'] if each['check'] in checks)
+
+
+def write_report(report, report_path):
+    if report_path is None:
+        return
+    if report_path == '-':
+        print(json.dumps(report, indent=2))
+    else:
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+def profile_startup_and_exit(files, logger, processes, params, profile):
+    with profile.phase('connector_config_parse'):
+        create_tunnels_from_config([], files, logger, processes)
+    report = get_startup_scheduler(logger, params).start(processes)
+    for each in processes.values():
+        each.terminate()
+    for each in processes.values():
+        each.join()
+    print(json.dumps(profile.to_dict(report), indent=2))
+    sys.exit(0)
 
 
 def test_mail_and_exit(logger, smtp_sender):
@@ -357,62 +414,190 @@ def test_http_and_exit(logger, post_sender):
     sys.exit(0)
 
 
-def check_tunnels(files, items, logger, processes, to_restart, pool, pooled_sender):
+def check_tunnels(files, items, logger, processes, to_restart, pool, pooled_sender, status):
     for key, proc in items:
-        """
-        pool.submit(ConnectionCheck(logger, pooled_sender).test_connection, proc.tunnel_name,
-                    processes[key].remote_host,
-                    processes[key].remote_port)
-        """
         if (not proc.is_alive()) and proc.exitcode is not None:
             proc.terminate()
             del processes[key]
             to_restart.append(key)
-            logger.info("Connector %s is down", files[key])
-            pooled_sender.send_alert(proc.tunnel_name)
+            # One that never forwarded had its failed start recorded when the scheduler reaped it
+            forwarded = proc.forwarding_event.is_set()
+            if proc.drain_requested:
+                logger.info("Connector %s finished draining", files[key])
+                if forwarded:
+                    status.stop_tunnel(files[key], 'drain')
+            else:
+                logger.info("Connector %s is down", files[key])
+                if forwarded:
+                    status.stop_tunnel(files[key], 'exit')
+                pooled_sender.send_alert(proc.tunnel_name)
         else:
             logger.debug("Connector %s is up", files[key])
 
 
-def restart_tunnels(files, logger, processes, to_restart, alert_senders, status):
+def record_history(files, logger, processes, status):
+    """Adds the traffic of every forwarding connector to its history and saves the histories"""
+    forwarding = {proc: key for key, proc in list(processes.items()) if proc.forwarding_event.is_set()}
+    for proc, key in forwarding.items():
+        # It may have started forwarding after the scheduler gave up on it
+        status.resume_tunnel(files[key])
+    for proc, stats, error in call_all(list(forwarding), 'get-stats'):
+        if error is None:
+            status.record_stats(files[forwarding[proc]], stats)
+        else:
+            logger.debug("Failed to get the stats of %s: %r", files[forwarding[proc]], error)
+    status.snapshot()
+
+
+def restart_tunnels(files, logger, processes, to_restart, alert_senders, status, scheduler,
+                    factory=TunnelProcess.from_config_file):
     for each in to_restart:
         logger.info("Going to restart connector from file %s", files[each])
-        tunnel_process = TunnelProcess.from_config_file(files[each], alert_senders)
-        processes[each] = tunnel_process
-        tunnel_process.start()
-        status.start_tunnel(files[each])
-        logger.info("Connector %s has pid %s", tunnel_process.tunnel_name, tunnel_process.pid)
+        processes[each] = factory(files[each], alert_senders)
+    if to_restart:
+        # In the background, a fleet that can not connect would hold the main loop for handshake_timeout each
+        scheduler.submit(processes, to_restart, on_started=get_on_started(logger),
+                         on_result=get_on_result(files, status))
 
 
-def register_signal_handlers(processes, pool):
+def get_config_mtimes(files):
+    return {key: os.path.getmtime(config_file) for key, config_file in enumerate(files)}
+
+
+def detect_config_changes(files, config_mtimes, logger, processes, restart_requests):
+    """Applies what reload-config can apply to a running connector and queues a restart for the rest"""
+    for key, config_file in enumerate(files):
+        try:
+            mtime = os.path.getmtime(config_file)
+        except OSError:
+            continue
+        if mtime == config_mtimes.get(key):
+            continue
+        config_mtimes[key] = mtime
+        logger.info("Configuration file %s changed", config_file)
+        try:
+            result = processes[key].call('reload-config')
+        except Exception as e:
+            logger.warning("Failed to reload %s, restarting it: %r", config_file, e)
+            restart_requests.put(key)
+            continue
+        if result['requires_restart']:
+            restart_requests.put(key)
+
+
+def handle_restart_requests(files, logger, processes, restart_requests, alert_senders, status, retiring, wait,
+                            factory=TunnelProcess.from_config_file):
+    """Waits up to wait seconds replacing the connectors whose keys arrive at restart_requests"""
+    deadline = time.monotonic() + wait
+    while True:
+        retiring[:] = [each for each in retiring if each.is_alive()]
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        try:
+            key = restart_requests.get(timeout=remaining)
+        except queue.Empty:
+            return
+        if key in processes:
+            replace_tunnel(files, key, logger, processes, alert_senders, status, retiring, factory)
+
+
+def replace_tunnel(files, key, logger, processes, alert_senders, status, retiring,
+                   factory=TunnelProcess.from_config_file):
+    """Restarts the connector of key make-before-break, the old process drains while the replacement forwards"""
+    old = processes[key]
+    logger.info("Going to replace connector from file %s", files[key])
+    try:
+        new = factory(files[key], alert_senders)
+    except Exception as e:
+        logger.exception("Failed to create connector from file %s, keeping the running one: %s", files[key], e)
+        return
+    new.handoff = old.is_alive()
+    new.start()
+    if new.handoff:
+        if not new.transport_ready_event.wait(HANDOFF_TIMEOUT):
+            logger.error("Replacement of %s could not connect, keeping the running one", new.tunnel_name)
+            new.terminate()
+            new.join()
+            return
+        try:
+            old.drain()
+        except Exception as e:
+            logger.warning("Failed to drain connector %s, terminating it: %r", old.tunnel_name, e)
+            old.terminate()
+        new.bind_event.set()
+        retiring.append(old)
+    processes[key] = new
+    if new.forwarding_event.wait(HANDOFF_TIMEOUT):
+        status.start_tunnel(files[key], 'replace' if new.handoff else 'start')
+        logger.info("Connector %s replaced, it has pid %s", new.tunnel_name, new.pid)
+    else:
+        status.stop_tunnel(files[key], 'failed')
+        logger.error("Replacement of connector %s is not forwarding", new.tunnel_name)
+
+
+def register_signal_handlers(processes, pool, restart_requests=None, retiring=(), status=None, worker_pool=None,
+                             scheduler=None):
     def exit_gracefully(*args, **kwargs):
         if pool:
             pool.shutdown()
-        for each in processes.values():
+        if scheduler:
+            scheduler.stop()
+        # A restarted connector may still be waiting for the scheduler to start it
+        children = [each for each in list(processes.values()) + list(retiring) if each.pid is not None]
+        # Children drain their connections on SIGTERM, so they are all signaled before waiting for any of them
+        for each in children:
             each.terminate()
-        for each in processes.values():
+        for each in children:
             each.join()
+        if worker_pool:
+            worker_pool.stop()
+        if status:
+            status.stop_all('stop')
+            status.snapshot()
 
         sys.exit(0)
 
+    def restart_all(*args, **kwargs):
+        for key in list(processes.keys()):
+            restart_requests.put(key)
+
     signal.signal(signal.SIGINT, exit_gracefully)
     signal.signal(signal.SIGTERM, exit_gracefully)
+    if restart_requests is not None and hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, restart_all)
+
 
+def start_tunnels(files, logger, processes, alert_senders, status, scheduler, factory=TunnelProcess.from_config_file):
+    create_tunnels_from_config(alert_senders, files, logger, processes, factory)
+    report = scheduler.start(processes, on_started=get_on_started(logger), on_result=get_on_result(files, status))
+    status.record_startup(report)
 
-def start_tunnels(files, logger, processes, alert_senders, status):
-    create_tunnels_from_config(alert_senders, files, logger, processes)
-    for key, tunnel_process in processes.items():
-        tunnel_process.start()
-        status.start_tunnel(files[key])
+
+def get_on_started(logger):
+    def on_started(key, tunnel_process):
         logger.info("Connector %s has pid %s", tunnel_process.tunnel_name, tunnel_process.pid)
 
+    return on_started
+
+
+def get_on_result(files, status):
+    """Opens the uptime interval of a connector once it forwards, a start that failed or timed out is down time"""
+    def on_result(key, tunnel_process, result):
+        if result == 'forwarding':
+            status.start_tunnel(files[key])
+        else:
+            status.stop_tunnel(files[key], 'failed')
+
+    return on_result
+
 
-def create_tunnels_from_config(alert_senders, files, logger, processes):
+def create_tunnels_from_config(alert_senders, files, logger, processes, factory=TunnelProcess.from_config_file):
     for each in range(len(files)):
         config_file = files[each]
         logger.info("Going to start connector from file %s", config_file)
         try:
-            tunnel_process = TunnelProcess.from_config_file(config_file, alert_senders)
+            tunnel_process = factory(config_file, alert_senders)
         except Exception as e:
             logger.exception("Failed to create connector from file %s: %s", config_file, e)
             for pr in processes.values():
@@ -423,6 +608,7 @@ def create_tunnels_from_config(alert_senders, files, logger, processes):
 
 def get_post_alert_sender(logger, tunnel_manager_id, params):
     if params.get("http_url"):
+        from alerts.http_post_alert import HTTPPostAlertSender
         try:
             post_sender = HTTPPostAlertSender(tunnel_manager_id, params['http_url'], params['http_user'],
                                               params['http_password'], logger)
@@ -436,6 +622,7 @@ def get_post_alert_sender(logger, tunnel_manager_id, params):
 
 def get_smtp_alert_sender(logger, tunnel_manager_id, params):
     if params.get("smtp_hostname"):
+        from alerts.email_alert import EmailAlertSender
         try:
             smtp_sender = EmailAlertSender(tunnel_manager_id, params['smtp_hostname'], params.get('smtp_login', None),
                                            params.get('smtp_password', None),
@@ -0,0 +1,131 @@
+import ipaddress
+import re
+import socket
+
+PORTS = re.compile(r'^(\*|\d+(-\d+)?)$')
+
+
+class AllowlistError(ValueError):
+    pass
+
+
+class Allowlist(object):
+    """Destinations a dynamic (SOCKS5) connector may connect to"""
+
+    def __init__(self, spec=''):
+        self.spec = spec
+        # {version: {prefix length: {network bits: [port ranges]}}}, None as port ranges means any port. A lookup is
+        # one dict access per distinct prefix length whatever the number of entries
+        self.networks = {4: {}, 6: {}}
+        self.hosts = {}
+        self.domains = {}
+        for entry in re.split(r'[,\s]+', spec.strip()):
+            if entry:
+                self.add(entry)
+        self.prefix_lengths = {version: sorted(tables, reverse=True) for version, tables in self.networks.items()}
+
+    def add(self, entry):
+        target, ports = split_entry(entry)
+        try:
+            network = ipaddress.ip_network(target, strict=False)
+        except ValueError:
+            network = None
+        if network is not None:
+            table = self.networks[network.version].setdefault(network.prefixlen, {})
+            key = int(network.network_address) >> (network.max_prefixlen - network.prefixlen)
+            merge_ports(table, key, ports)
+        elif target.startswith('*.'):
+            merge_ports(self.domains, target[2:].lower().rstrip('.'), ports)
+        elif '*' in target or '/' in target:
+            raise AllowlistError("Invalid allowlist entry %r" % (entry,))
+        else:
+            merge_ports(self.hosts, target.lower().rstrip('.'), ports)
+
+    def __bool__(self):
+        return bool(self.hosts or self.domains or any(self.networks.values()))
+
+    def allows_address(self, address, port):
+        address = ipaddress.ip_address(address)
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        value = int(address)
+        tables = self.networks[address.version]
+        for prefix_length in self.prefix_lengths[address.version]:
+            ranges = tables[prefix_length].get(value >> (address.max_prefixlen - prefix_length), False)
+            if ranges is not False and port_in(ranges, port):
+                return True
+        return False
+
+    def allows_host(self, host, port):
+        host = host.lower().rstrip('.')
+        if host in self.hosts and port_in(self.hosts[host], port):
+            return True
+        labels = host.split('.')
+        for start in range(1, len(labels)):
+            ranges = self.domains.get('.'.join(labels[start:]), False)
+            if ranges is not False and port_in(ranges, port):
+                return True
+        return False
+
+    def resolve(self, host, port):
+        """Returns the address to connect to for host:port, or None when the allowlist does not permit it"""
+        try:
+            ipaddress.ip_address(host)
+        except ValueError:
+            pass
+        else:
+            return host if self.allows_address(host, port) else None
+        if self.allows_host(host, port):
+            return host
+        if not any(self.networks.values()):
+            return None
+        try:
+            addresses = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        except socket.gaierror:
+            return None
+        for _, _, _, _, sockaddr in addresses:
+            if self.allows_address(sockaddr[0], port):
+                return sockaddr[0]
+        return None
+
+
+def split_entry(entry):
+    """Returns the target and the port ranges of an allowlist entry"""
+    if entry.startswith('['):
+        target, bracket, ports = entry[1:].partition(']')
+        if not bracket or ports and not ports.startswith(':'):
+            raise AllowlistError("Invalid allowlist entry %r" % (entry,))
+        ports = ports[1:]
+    elif entry.count(':') > 1:
+        # An IPv6 address or network without port
+        target, ports = entry, ''
+    else:
+        target, _, ports = entry.partition(':')
+    if not target:
+        raise AllowlistError("Invalid allowlist entry %r" % (entry,))
+    return target, parse_ports(ports, entry)
+
+
+def parse_ports(ports, entry):
+    if not ports or ports == '*':
+        return None
+    if not PORTS.match(ports):
+        raise AllowlistError("Invalid port in allowlist entry %r" % (entry,))
+    first, _, last = ports.partition('-')
+    first, last = int(first), int(last or first)
+    if not 0 < first <= last <= 65535:
+        raise AllowlistError("Invalid port range in allowlist entry %r" % (entry,))
+    return [(first, last)]
+
+
+def merge_ports(table, key, ports):
+    if key in table and table[key] is None:
+        return
+    if ports is None:
+        table[key] = None
+    else:
+        table.setdefault(key, []).extend(ports)
+
+
+def port_in(ranges, port):
+    return ranges is None or any(first <= port <= last for first, last in ranges)
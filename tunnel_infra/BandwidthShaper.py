@@ -0,0 +1,145 @@
+import threading
+import time
+
+from .TokenBucket import TokenBucket
+
+DIRECTIONS = ('up', 'down')
+# Bytes per second, 0 is unlimited
+LIMIT_SETTINGS = ('rate_limit_up', 'rate_limit_down', 'connection_rate_limit_up', 'connection_rate_limit_down')
+SHAPING_SETTINGS = LIMIT_SETTINGS + ('fair_share',)
+# Seconds between two computations of the fair shares, from the rates measured over that interval
+FAIR_INTERVAL = 0.25
+
+
+class ShapedConnection(object):
+    def __init__(self, rates):
+        self.buckets = {direction: TokenBucket(rates[direction]) for direction in DIRECTIONS}
+        # Only written by the relay thread of the connection
+        self.bytes = dict.fromkeys(DIRECTIONS, 0)
+        self.measured_bytes = dict.fromkeys(DIRECTIONS, 0)
+
+
+class BandwidthShaper(object):
+    """Token bucket rate limits of a connector and of each of its connections, for each direction"""
+
+    def __init__(self, rate_limit_up=0, rate_limit_down=0, connection_rate_limit_up=0, connection_rate_limit_down=0,
+                 fair_share=False):
+        self.lock = threading.Lock()
+        self.connections = set()
+        self.buckets = {direction: TokenBucket(0) for direction in DIRECTIONS}
+        self.rate_limit = dict.fromkeys(DIRECTIONS, 0.0)
+        self.connection_rate_limit = dict.fromkeys(DIRECTIONS, 0.0)
+        self.fair_share = False
+        self.enabled = False
+        # Current rate of each connection bucket
+        self.shares = dict.fromkeys(DIRECTIONS, 0.0)
+        self.next_share_update = 0
+        self.last_share_update = time.monotonic()
+        self.throttled_seconds = dict.fromkeys(DIRECTIONS, 0.0)
+        self.set_limits(rate_limit_up, rate_limit_down, connection_rate_limit_up, connection_rate_limit_down,
+                        fair_share)
+
+    def set_limits(self, rate_limit_up=None, rate_limit_down=None, connection_rate_limit_up=None,
+                   connection_rate_limit_down=None, fair_share=None):
+        """Changes the limits that are not None, the connections already open included"""
+        with self.lock:
+            for limits, values in ((self.rate_limit, (rate_limit_up, rate_limit_down)),
+                                   (self.connection_rate_limit, (connection_rate_limit_up, connection_rate_limit_down))):
+                for direction, value in zip(DIRECTIONS, values):
+                    if value is not None:
+                        limits[direction] = float(value)
+            if fair_share is not None:
+                self.fair_share = bool(fair_share)
+            for direction in DIRECTIONS:
+                self.buckets[direction].set_rate(self.rate_limit[direction])
+            self.enabled = any(self.rate_limit.values()) or any(self.connection_rate_limit.values())
+            self._update_shares(time.monotonic())
+        return self.limits()
+
+    def open(self):
+        with self.lock:
+            connection = ShapedConnection(self.shares)
+            self.connections.add(connection)
+        return connection
+
+    def close(self, connection):
+        with self.lock:
+            self.connections.discard(connection)
+
+    def throttle(self, connection, direction, size):
+        """Called before forwarding size bytes, sleeps as long as the limits require"""
+        if not self.enabled:
+            return
+        connection.bytes[direction] += size
+        now = time.monotonic()
+        if self.fair_share and now >= self.next_share_update:
+            with self.lock:
+                if now >= self.next_share_update:
+                    self._update_shares(now)
+        delay = max(connection.buckets[direction].reserve(size), self.buckets[direction].reserve(size))
+        if delay > 0:
+            with self.lock:
+                self.throttled_seconds[direction] += delay
+            time.sleep(delay)
+
+    def _update_shares(self, now):
+        elapsed = max(now - self.last_share_update, 0.001)
+        self.last_share_update = now
+        self.next_share_update = now + FAIR_INTERVAL
+        for direction in DIRECTIONS:
+            rates = []
+            for each in self.connections:
+                total = each.bytes[direction]
+                rates.append((total - each.measured_bytes[direction]) / elapsed)
+                each.measured_bytes[direction] = total
+            rate = self.connection_rate_limit[direction]
+            if self.fair_share and self.rate_limit[direction] > 0:
+                share = self.fair_level(self.rate_limit[direction], rates)
+                rate = min(rate, share) if rate > 0 else share
+            self.shares[direction] = rate
+            for each in self.connections:
+                if each.buckets[direction].rate != rate:
+                    each.buckets[direction].set_rate(rate)
+
+    @staticmethod
+    def fair_level(rate, measured):
+        """Max-min fair share of rate: what is left once the connections below an even split have what they use"""
+        remaining = rate
+        left = len(measured)
+        for each in sorted(measured):
+            if each >= remaining / left:
+                break
+            remaining -= each
+            left -= 1
+        return remaining / left if left else rate
+
+    def limits(self):
+        return {'rate_limit_up': self.rate_limit['up'],
+                'rate_limit_down': self.rate_limit['down'],
+                'connection_rate_limit_up': self.connection_rate_limit['up'],
+                'connection_rate_limit_down': self.connection_rate_limit['down'],
+                'fair_share': self.fair_share}
+
+    def stats(self):
+        with self.lock:
+            stats = self.limits()
+            stats.update({'connection_rate_up': self.shares['up'],
+                          'connection_rate_down': self.shares['down'],
+                          'throttled_seconds_up': self.throttled_seconds['up'],
+                          'throttled_seconds_down': self.throttled_seconds['down']})
+            return stats
+
+
+def parse_limits(values):
+    """Converts the text values of SHAPING_SETTINGS, from an ini file or a control request"""
+    limits = {}
+    for key, value in values.items():
+        if key not in SHAPING_SETTINGS:
+            raise ValueError("Unknown shaping setting %s, expected one of %s" % (key, ", ".join(SHAPING_SETTINGS)))
+        if key == 'fair_share':
+            limits[key] = value if isinstance(value, bool) else str(value).lower() in ('1', 'true', 'yes', 'on')
+        else:
+            limits[key] = float(value)
+            if limits[key] < 0:
+                raise ValueError("%s must not be negative" % (key,))
+    return limits
@@ -0,0 +1,72 @@
+import time
+from collections import deque
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+# 0 disables the breaker
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 10
+TRANSITIONS_KEPT = 20
+
+
+class CircuitBreaker(object):
+    """Stops sending connections to an upstream after failure_threshold consecutive connect failures"""
+    # No lock of its own, UpstreamPool calls it under its lock
+
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD, reset_timeout=DEFAULT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.rejected = 0
+        self.transitions = deque(maxlen=TRANSITIONS_KEPT)
+
+    def available(self):
+        """True if a connection may be sent now, an open breaker whose timeout passed lets one through"""
+        if self.state == OPEN:
+            return time.monotonic() >= self.opened_at + self.reset_timeout
+        return self.state == CLOSED or not self.probing
+
+    def acquire(self):
+        """Called for the connection sent after available() returned True. Moves an open breaker to half open"""
+        if self.state == OPEN:
+            self._move(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            self.probing = True
+
+    def reject(self):
+        self.rejected += 1
+
+    def success(self):
+        """Returns the previous state when the breaker closes"""
+        self.consecutive_failures = 0
+        self.probing = False
+        if self.state != CLOSED:
+            return self._move(CLOSED)
+        return None
+
+    def failure(self):
+        """Returns the previous state when the breaker opens"""
+        self.consecutive_failures += 1
+        self.probing = False
+        if self.state == HALF_OPEN or (self.state == CLOSED and 0 < self.failure_threshold <= self.consecutive_failures):
+            self.opened_at = time.monotonic()
+            return self._move(OPEN)
+        if self.state == OPEN:
+            self.opened_at = time.monotonic()
+        return None
+
+    def _move(self, state):
+        previous, self.state = self.state, state
+        self.transitions.append({'at': time.time(), 'from': previous, 'to': state,
+                                 'consecutive_failures': self.consecutive_failures})
+        return previous
+
+    def to_dict(self):
+        return {'state': self.state,
+                'consecutive_failures': self.consecutive_failures,
+                'failure_threshold': self.failure_threshold,
+                'reset_timeout': self.reset_timeout,
+                'rejected': self.rejected,
+                'transitions': list(self.transitions)}
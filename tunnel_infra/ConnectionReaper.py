@@ -0,0 +1,182 @@
+import heapq
+import itertools
+import socket
+import threading
+import time
+from collections import Counter
+
+# 0 disables a timeout. Idle connections are legitimate for many services (database pools, LDAP) so only writes
+# blocked on the upstream are limited by default
+DEFAULT_IDLE_TIMEOUT = 0
+DEFAULT_MAX_CONNECTION_LIFETIME = 0
+DEFAULT_UPSTREAM_READ_TIMEOUT = 0
+DEFAULT_UPSTREAM_WRITE_TIMEOUT = 30
+
+
+class WatchedConnection(object):
+    """Activity timestamps of one relayed connection. The relay thread updates them with plain stores"""
+    __slots__ = ('chan', 'sock', 'record', 'started', 'last_activity', 'awaiting_since', 'write_started', 'done',
+                 'reaped', 'upstream_eof')
+
+    def __init__(self, chan, sock, record, started):
+        self.chan = chan
+        self.sock = sock
+        self.record = record
+        self.started = started
+        self.last_activity = time.monotonic()
+        # Since when data sent upstream has no answer and since when a write to the upstream is blocked
+        self.awaiting_since = None
+        self.write_started = None
+        self.done = False
+        self.reaped = None
+        self.upstream_eof = False
+
+    def writing_up(self):
+        now = time.monotonic()
+        self.last_activity = now
+        self.write_started = now
+
+    def sent_up(self):
+        now = time.monotonic()
+        self.last_activity = now
+        self.write_started = None
+        # An upstream that sent EOF answers nothing more, what the client still sends is not waiting for a reply
+        if self.awaiting_since is None and not self.upstream_eof:
+            self.awaiting_since = now
+
+    def received_down(self):
+        self.last_activity = time.monotonic()
+        self.awaiting_since = None
+
+    def upstream_finished(self):
+        self.upstream_eof = True
+        self.awaiting_since = None
+
+
+class ConnectionReaper(object):
+    """Closes the connections of a Tunnel that are idle, too old or stalled on their upstream"""
+
+    def __init__(self, logger, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 max_connection_lifetime=DEFAULT_MAX_CONNECTION_LIFETIME,
+                 upstream_read_timeout=DEFAULT_UPSTREAM_READ_TIMEOUT,
+                 upstream_write_timeout=DEFAULT_UPSTREAM_WRITE_TIMEOUT):
+        self.logger = logger
+        self.idle_timeout = idle_timeout
+        self.max_connection_lifetime = max_connection_lifetime
+        self.upstream_read_timeout = upstream_read_timeout
+        self.upstream_write_timeout = upstream_write_timeout
+        self.condition = threading.Condition()
+        self.heap = []
+        self.sequence = itertools.count()
+        self.connections = set()
+        self.reaped = Counter()
+        self.thread = None
+        self.stopped = False
+
+    def set_timeouts(self, idle_timeout, max_connection_lifetime, upstream_read_timeout, upstream_write_timeout):
+        with self.condition:
+            self.idle_timeout = idle_timeout
+            self.max_connection_lifetime = max_connection_lifetime
+            self.upstream_read_timeout = upstream_read_timeout
+            self.upstream_write_timeout = upstream_write_timeout
+            # Connections without any timeout have no entry, and shorter timeouts move the deadlines earlier
+            self.heap = []
+            for connection in self.connections:
+                self._schedule(connection)
+            self.condition.notify()
+
+    def watch(self, chan, sock, record, started):
+        connection = WatchedConnection(chan, sock, record, started)
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="connection-reaper")
+                self.thread.daemon = True
+                self.thread.start()
+            self.connections.add(connection)
+            self._schedule(connection)
+            self.condition.notify()
+        return connection
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def forget(self, connection):
+        with self.condition:
+            connection.done = True
+            self.connections.discard(connection)
+            # Finished connections leave the heap when their deadline comes, unless they become most of it
+            if len(self.heap) > 2 * len(self.connections) + 64:
+                self.heap = [each for each in self.heap if not each[2].done]
+                heapq.heapify(self.heap)
+
+    def counts(self):
+        with self.condition:
+            return dict(self.reaped)
+
+    def deadline(self, connection):
+        """Returns the earliest (monotonic time, reason) at which connection should be reaped, None without timeouts"""
+        candidates = []
+        if self.idle_timeout > 0:
+            candidates.append((connection.last_activity + self.idle_timeout, 'idle_timeout'))
+        if self.max_connection_lifetime > 0:
+            candidates.append((connection.started + self.max_connection_lifetime, 'max_lifetime'))
+        awaiting_since = connection.awaiting_since
+        if self.upstream_read_timeout > 0 and awaiting_since is not None:
+            candidates.append((awaiting_since + self.upstream_read_timeout, 'upstream_read_stall'))
+        write_started = connection.write_started
+        if self.upstream_write_timeout > 0 and write_started is not None:
+            candidates.append((write_started + self.upstream_write_timeout, 'upstream_write_stall'))
+        return min(candidates) if candidates else None
+
+    def _schedule(self, connection):
+        deadline = self.deadline(connection)
+        candidates = [deadline[0]] if deadline else []
+        # A stall that has not started yet can not expire before its timeout from now, look again then
+        now = time.monotonic()
+        if self.upstream_read_timeout > 0 and connection.awaiting_since is None:
+            candidates.append(now + self.upstream_read_timeout)
+        if self.upstream_write_timeout > 0 and connection.write_started is None:
+            candidates.append(now + self.upstream_write_timeout)
+        if candidates:
+            heapq.heappush(self.heap, (min(candidates), next(self.sequence), connection))
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.heap and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                when, _, connection = self.heap[0]
+                if connection.done:
+                    heapq.heappop(self.heap)
+                    continue
+                now = time.monotonic()
+                if when > now:
+                    self.condition.wait(when - now)
+                    continue
+                heapq.heappop(self.heap)
+                # Entries are not moved on activity, push it back if its deadline moved since
+                deadline = self.deadline(connection)
+                if deadline is None or deadline[0] > now:
+                    self._schedule(connection)
+                    continue
+                reason = deadline[1]
+                connection.reaped = reason
+                self.reaped[reason] += 1
+            self.reap(connection, reason)
+
+    def reap(self, connection, reason):
+        self.logger.info("Closing connection from %r: %s", connection.chan.origin_addr, reason)
+        connection.record.close(reason)
+        # Shutting the socket down wakes the relay thread from select and from a blocked send
+        try:
+            connection.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            connection.chan.close()
+        except Exception as e:
+            self.logger.debug("Failed to close channel: %r", e)
@@ -0,0 +1,109 @@
+import multiprocessing
+import time
+
+FIELDS = ('id', 'accepted', 'upstream_connected', 'first_byte_up', 'first_byte_down', 'closed', 'bytes_up',
+          'bytes_down', 'close_reason')
+FIELD_COUNT = len(FIELDS)
+ID, ACCEPTED, UPSTREAM_CONNECTED, FIRST_BYTE_UP, FIRST_BYTE_DOWN, CLOSED, BYTES_UP, BYTES_DOWN, CLOSE_REASON = \
+    range(FIELD_COUNT)
+
+CLOSE_REASONS = ('', 'client_eof', 'upstream_eof', 'upstream_connect_failed', 'reset', 'error', 'idle_timeout',
+                 'max_lifetime', 'upstream_read_stall', 'upstream_write_stall', 'not_allowed', 'socks_error',
+                 'circuit_open')
+# Close reasons counted as connection errors in the stats
+ERROR_REASONS = ('upstream_connect_failed', 'reset', 'error', 'upstream_read_stall', 'upstream_write_stall',
+                 'socks_error', 'circuit_open')
+
+DEFAULT_CAPACITY = 256
+
+
+class ConnectionTrace(object):
+    """Shared memory ring buffer with the lifecycle of the last connections of a connector"""
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.records = multiprocessing.RawArray('d', capacity * FIELD_COUNT)
+        self.next_id = multiprocessing.RawValue('q', 0)
+        self.lock = multiprocessing.Lock()
+
+    def begin(self):
+        with self.lock:
+            self.next_id.value += 1
+            connection_id = self.next_id.value
+        offset = (connection_id % self.capacity) * FIELD_COUNT
+        # Readers skip the slot while its id is 0
+        self.records[offset + ID] = 0
+        for field in range(1, FIELD_COUNT):
+            self.records[offset + field] = 0
+        self.records[offset + ACCEPTED] = time.time()
+        self.records[offset + ID] = connection_id
+        return TraceRecord(self.records, offset, connection_id)
+
+    def snapshot(self):
+        now = time.time()
+        res = []
+        records = self.records[:]
+        for offset in range(0, len(records), FIELD_COUNT):
+            record = records[offset:offset + FIELD_COUNT]
+            if record[ID] == 0 or record[ACCEPTED] == 0:
+                continue
+            res.append(to_dict(record, now))
+        res.sort(key=lambda each: each['id'])
+        return res
+
+
+def to_dict(record, now):
+    accepted, closed = record[ACCEPTED], record[CLOSED]
+    res = {'id': int(record[ID]),
+           'state': 'closed' if closed else 'live',
+           'accepted': accepted,
+           'duration': (closed or now) - accepted,
+           'bytes_up': int(record[BYTES_UP]),
+           'bytes_down': int(record[BYTES_DOWN]),
+           'close_reason': CLOSE_REASONS[int(record[CLOSE_REASON])] or None}
+    for name, field in (('upstream_connected', UPSTREAM_CONNECTED), ('first_byte_up', FIRST_BYTE_UP),
+                        ('first_byte_down', FIRST_BYTE_DOWN), ('closed', CLOSED)):
+        res[name] = record[field] or None
+    res['connect_time'] = record[UPSTREAM_CONNECTED] - accepted if record[UPSTREAM_CONNECTED] else None
+    return res
+
+
+class TraceRecord(object):
+    __slots__ = ('records', 'offset', 'connection_id', 'bytes_up', 'bytes_down', 'reason')
+
+    def __init__(self, records, offset, connection_id):
+        self.records = records
+        self.offset = offset
+        self.connection_id = connection_id
+        self.bytes_up = 0
+        self.bytes_down = 0
+        self.reason = None
+
+    def _owned(self):
+        # The slot is reused once capacity newer connections were accepted
+        return self.records[self.offset + ID] == self.connection_id
+
+    def upstream_connected(self):
+        if self._owned():
+            self.records[self.offset + UPSTREAM_CONNECTED] = time.time()
+
+    def sent_up(self, size):
+        self.bytes_up += size
+        if self._owned():
+            if not self.records[self.offset + FIRST_BYTE_UP]:
+                self.records[self.offset + FIRST_BYTE_UP] = time.time()
+            self.records[self.offset + BYTES_UP] = self.bytes_up
+
+    def sent_down(self, size):
+        self.bytes_down += size
+        if self._owned():
+            if not self.records[self.offset + FIRST_BYTE_DOWN]:
+                self.records[self.offset + FIRST_BYTE_DOWN] = time.time()
+            self.records[self.offset + BYTES_DOWN] = self.bytes_down
+
+    def close(self, reason):
+        if self.reason is None:
+            self.reason = reason
+        if self._owned() and not self.records[self.offset + CLOSED]:
+            self.records[self.offset + CLOSE_REASON] = CLOSE_REASONS.index(reason)
+            self.records[self.offset + CLOSED] = time.time()
@@ -0,0 +1,122 @@
+import multiprocessing
+import threading
+import time
+
+DEFAULT_TIMEOUT = 5
+
+
+class ControlError(Exception):
+    pass
+
+
+class ControlChannel(object):
+    """Request/reply channel over a multiprocessing.Pipe between the supervisor and one TunnelProcess child"""
+
+    def __init__(self):
+        self.supervisor_end, self.child_end = multiprocessing.Pipe()
+        self._init_local_state()
+
+    def _init_local_state(self):
+        self.condition = threading.Condition()
+        self.next_request_id = 0
+        self.replies = {}
+        self.abandoned = set()
+        self.receiving = False
+
+    def __getstate__(self):
+        return {'supervisor_end': self.supervisor_end, 'child_end': self.child_end}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_local_state()
+
+    def call(self, command, timeout=DEFAULT_TIMEOUT, **kwargs):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            self.next_request_id += 1
+            request_id = self.next_request_id
+            try:
+                self.supervisor_end.send((request_id, command, kwargs))
+            except (OSError, ValueError) as e:
+                raise ControlError("Connector is not running: %r" % (e,))
+            while request_id not in self.replies:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.abandoned.add(request_id)
+                    raise TimeoutError("No answer to %s after %s seconds" % (command, timeout))
+                if self.receiving:
+                    self.condition.wait(remaining)
+                else:
+                    self._receive(remaining)
+            _, ok, result = self.replies.pop(request_id)
+        if not ok:
+            raise ControlError(result)
+        return result
+
+    def _receive(self, timeout):
+        # Only one caller reads the pipe at a time, the others wait for it to store their reply
+        self.receiving = True
+        self.condition.release()
+        try:
+            reply = self.supervisor_end.recv() if self.supervisor_end.poll(timeout) else None
+        except (EOFError, OSError) as e:
+            reply = e
+        finally:
+            self.condition.acquire()
+            self.receiving = False
+            self.condition.notify_all()
+        if isinstance(reply, Exception):
+            raise ControlError("Connector is not running: %r" % (reply,))
+        if reply is not None:
+            if reply[0] in self.abandoned:
+                self.abandoned.discard(reply[0])
+            else:
+                self.replies[reply[0]] = reply
+
+    def serve(self, handlers, logger):
+        """Child side loop. handlers maps command names to callables receiving the request kwargs"""
+        send_lock = threading.Lock()
+        while True:
+            try:
+                request_id, command, kwargs = self.child_end.recv()
+            except (EOFError, OSError):
+                return
+            # A slow command (e.g. profile) must not delay a get-stats
+            worker = threading.Thread(target=self._dispatch,
+                                      args=(handlers, logger, send_lock, request_id, command, kwargs),
+                                      name="control-" + command)
+            worker.daemon = True
+            worker.start()
+
+    def _dispatch(self, handlers, logger, send_lock, request_id, command, kwargs):
+        try:
+            if command not in handlers:
+                raise ValueError("Unknown command %s" % (command,))
+            reply = (request_id, True, handlers[command](**kwargs))
+        except Exception as e:
+            logger.exception("Control command %s failed: %r", command, e)
+            reply = (request_id, False, repr(e))
+        with send_lock:
+            self.child_end.send(reply)
+
+
+def call_all(targets, command, timeout=DEFAULT_TIMEOUT, **kwargs):
+    """Runs command on every target at once and returns [(target, result, error)] within a shared timeout"""
+    results = [(each, None, TimeoutError("No answer to %s after %s seconds" % (command, timeout)))
+               for each in targets]
+
+    def call(index, target):
+        try:
+            results[index] = (target, target.call(command, timeout=timeout, **kwargs), None)
+        except Exception as e:
+            results[index] = (target, None, e)
+
+    threads = [threading.Thread(target=call, args=(index, target), name="control-" + command)
+               for index, target in enumerate(targets)]
+    deadline = time.monotonic() + timeout
+    for each in threads:
+        each.daemon = True
+        each.start()
+    for each in threads:
+        each.join(max(0.0, deadline - time.monotonic()))
+    return list(results)
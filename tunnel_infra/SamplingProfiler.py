@@ -0,0 +1,71 @@
+import marshal
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+DEFAULT_INTERVAL = 0.005
+MAX_SECONDS = 300
+FORMATS = ('collapsed', 'pstats')
+
+
+class SamplingProfiler(object):
+    """Samples the stacks of every other thread of the process at a fixed interval"""
+
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+
+    def run(self, seconds):
+        seconds = min(float(seconds), MAX_SECONDS)
+        me = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+                stack.reverse()
+                self.stacks[(names.get(ident, str(ident)), tuple(stack))] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+        return self
+
+    def collapsed(self):
+        """One "thread;outer;...;inner count" line per distinct stack, the input of flamegraph.pl and speedscope"""
+        lines = []
+        for (thread_name, stack), count in self.stacks.most_common():
+            frames = ["%s (%s:%d)" % (name, os.path.basename(filename), line) for filename, line, name in stack]
+            lines.append("%s %d" % (";".join([thread_name] + frames), count))
+        return "\n".join(lines) + "\n"
+
+    def pstats(self):
+        """Marshalled stats loadable with pstats.Stats(path). Sample counts stand in for call counts"""
+        stats = {}
+        for (_, stack), count in self.stacks.items():
+            seconds = count * self.interval
+            for depth, function in enumerate(stack):
+                if function in stack[:depth]:
+                    # Recursive frames only count once towards the cumulative time
+                    continue
+                cc, nc, tt, ct, callers = stats.get(function, (0, 0, 0.0, 0.0, {}))
+                if depth == len(stack) - 1:
+                    tt += seconds
+                if depth > 0:
+                    caller = stack[depth - 1]
+                    c_cc, c_nc, c_tt, c_ct = callers.get(caller, (0, 0, 0.0, 0.0))
+                    callers[caller] = (c_cc + count, c_nc + count, c_tt, c_ct + seconds)
+                stats[function] = (cc + count, nc + count, tt, ct + seconds, callers)
+        return marshal.dumps(stats)
+
+    def output(self, output_format):
+        if output_format == 'pstats':
+            return self.pstats()
+        return self.collapsed()
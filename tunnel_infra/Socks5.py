@@ -0,0 +1,79 @@
+import ipaddress
+import socket
+import struct
+
+VERSION = 5
+NO_AUTHENTICATION = 0
+NO_ACCEPTABLE_METHODS = 0xff
+CONNECT = 1
+IPV4, DOMAIN_NAME, IPV6 = 1, 3, 4
+
+SUCCEEDED = 0
+GENERAL_FAILURE = 1
+NOT_ALLOWED = 2
+HOST_UNREACHABLE = 4
+CONNECTION_REFUSED = 5
+COMMAND_NOT_SUPPORTED = 7
+ADDRESS_TYPE_NOT_SUPPORTED = 8
+
+# Seconds a client has to send its greeting and request once the channel is open
+HANDSHAKE_TIMEOUT = 10
+
+
+class Socks5Error(Exception):
+    """reply is the code to answer the CONNECT request with, None if the handshake failed before it"""
+
+    def __init__(self, message, reply=None):
+        super().__init__(message)
+        self.reply = reply
+
+
+def negotiate(chan):
+    """Reads the SOCKS5 greeting and CONNECT request (RFC 1928, no authentication) and returns (host, port)"""
+    version, method_count = struct.unpack("!BB", recv_exactly(chan, 2))
+    if version != VERSION:
+        raise Socks5Error("Unsupported SOCKS version %d" % (version,))
+    methods = recv_exactly(chan, method_count)
+    if NO_AUTHENTICATION not in methods:
+        chan.sendall(struct.pack("!BB", VERSION, NO_ACCEPTABLE_METHODS))
+        raise Socks5Error("Client requires authentication")
+    chan.sendall(struct.pack("!BB", VERSION, NO_AUTHENTICATION))
+    version, command, _, address_type = struct.unpack("!BBBB", recv_exactly(chan, 4))
+    if address_type == IPV4:
+        host = socket.inet_ntop(socket.AF_INET, recv_exactly(chan, 4))
+    elif address_type == IPV6:
+        host = socket.inet_ntop(socket.AF_INET6, recv_exactly(chan, 16))
+    elif address_type == DOMAIN_NAME:
+        host = recv_exactly(chan, recv_exactly(chan, 1)[0]).decode('idna')
+    else:
+        raise Socks5Error("Unsupported address type %d" % (address_type,), ADDRESS_TYPE_NOT_SUPPORTED)
+    port = struct.unpack("!H", recv_exactly(chan, 2))[0]
+    if command != CONNECT:
+        raise Socks5Error("Unsupported command %d" % (command,), COMMAND_NOT_SUPPORTED)
+    return host, port
+
+
+def send_reply(chan, reply, bound=None):
+    """Answers the CONNECT request. bound is the (address, port) of the upstream socket on success"""
+    address, port = bound[:2] if bound else ('0.0.0.0', 0)
+    packed = ipaddress.ip_address(address).packed
+    address_type = IPV4 if len(packed) == 4 else IPV6
+    chan.sendall(struct.pack("!BBBB", VERSION, reply, 0, address_type) + packed + struct.pack("!H", port))
+
+
+def connect_error_reply(error):
+    if isinstance(error, ConnectionRefusedError):
+        return CONNECTION_REFUSED
+    if isinstance(error, OSError):
+        return HOST_UNREACHABLE
+    return GENERAL_FAILURE
+
+
+def recv_exactly(chan, size):
+    data = b''
+    while len(data) < size:
+        chunk = chan.recv(size - len(data))
+        if not chunk:
+            raise Socks5Error("Client closed during the SOCKS handshake")
+        data += chunk
+    return data
@@ -0,0 +1,104 @@
+import queue
+import threading
+import time
+from collections import deque
+
+from .TokenBucket import TokenBucket
+
+DEFAULT_MAX_CONCURRENT = 8
+DEFAULT_START_RATE = 4
+DEFAULT_HANDSHAKE_TIMEOUT = 30
+POLL_INTERVAL = 0.05
+
+
+class StartupScheduler(object):
+    """Starts TunnelProcess children with a bound on the handshakes in flight and on the starts per second"""
+
+    def __init__(self, logger, max_concurrent=DEFAULT_MAX_CONCURRENT, start_rate=DEFAULT_START_RATE,
+                 handshake_timeout=DEFAULT_HANDSHAKE_TIMEOUT):
+        self.logger = logger
+        self.max_concurrent = max(1, int(max_concurrent))
+        self.handshake_timeout = handshake_timeout
+        self.rate_limiter = TokenBucket(start_rate, capacity=max(1, start_rate))
+        self.submitted = queue.Queue()
+        self.thread = None
+        self.stopped = False
+
+    def start(self, processes, keys=None, on_started=None, on_result=None):
+        """Starts the children of keys, all of them by default, and waits for their results"""
+        keys = list(processes.keys()) if keys is None else list(keys)
+        pending = deque((key, processes[key], on_started, on_result) for key in keys)
+        in_flight = {}
+        report = {'connectors': {}, 'forwarding': 0, 'failed': 0, 'timed_out': 0}
+        begin = time.monotonic()
+        while (pending and not self.stopped) or in_flight:
+            self._step(processes, pending, in_flight, report)
+            if in_flight:
+                time.sleep(POLL_INTERVAL)
+        report['time_to_all_forwarding'] = time.monotonic() - begin
+        self.logger.info("%d of %d connectors forwarding after %.2f seconds (%d failed, %d timed out)",
+                         report['forwarding'], len(keys), report['time_to_all_forwarding'], report['failed'],
+                         report['timed_out'])
+        return report
+
+    def submit(self, processes, keys, on_started=None, on_result=None):
+        """Starts the children of keys like start() from a background thread, without waiting for them"""
+        for key in keys:
+            self.submitted.put((key, processes[key], on_started, on_result))
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, args=(processes,), name="startup-scheduler")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        """No child is started from then on"""
+        self.stopped = True
+
+    def _run(self, processes):
+        pending = deque()
+        in_flight = {}
+        report = {'connectors': {}, 'forwarding': 0, 'failed': 0, 'timed_out': 0}
+        while True:
+            try:
+                # Blocks only while there is nothing to start or to watch
+                pending.append(self.submitted.get(timeout=POLL_INTERVAL if pending or in_flight else None))
+                while True:
+                    pending.append(self.submitted.get_nowait())
+            except queue.Empty:
+                pass
+            self._step(processes, pending, in_flight, report)
+
+    def _step(self, processes, pending, in_flight, report):
+        self._reap(in_flight, report)
+        while pending and len(in_flight) < self.max_concurrent and not self.stopped:
+            key, tunnel_process, on_started, on_result = pending.popleft()
+            if processes.get(key) is not tunnel_process:
+                # Replaced or removed while it waited for its turn
+                continue
+            self.rate_limiter.consume()
+            tunnel_process.start()
+            in_flight[tunnel_process] = (time.monotonic(), key, on_result)
+            if on_started:
+                on_started(key, tunnel_process)
+
+    def _reap(self, in_flight, report):
+        now = time.monotonic()
+        for tunnel_process, (started_at, key, on_result) in list(in_flight.items()):
+            if tunnel_process.forwarding_event.is_set():
+                result = 'forwarding'
+            elif tunnel_process.exitcode is not None:
+                result = 'failed'
+            elif now - started_at > self.handshake_timeout:
+                result = 'timed_out'
+            else:
+                continue
+            del in_flight[tunnel_process]
+            report[result] += 1
+            report['connectors'][tunnel_process.tunnel_name] = {
+                'result': result,
+                'time_to_forward': now - started_at if result == 'forwarding' else None
+            }
+            if result != 'forwarding':
+                self.logger.warning("Connector %s did not start forwarding: %s", tunnel_process.tunnel_name, result)
+            if on_result:
+                on_result(key, tunnel_process, result)
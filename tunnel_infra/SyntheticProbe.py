@@ -0,0 +1,201 @@
+import socket
+import threading
+import time
+from collections import deque
+
+# 0 disables the probes: each one is a connection to the service, it shows in its logs
+DEFAULT_PROBE_INTERVAL = 0
+DEFAULT_PROBE_TIMEOUT = 5
+DEFAULT_PROBE_FAILURE_THRESHOLD = 3
+# Seconds of p90 round trip over which the connector is degraded, 0 disables it
+DEFAULT_PROBE_LATENCY_THRESHOLD = 0
+PROBE_SETTINGS = ('probe_interval', 'probe_timeout', 'probe_failure_threshold', 'probe_latency_threshold')
+# Latencies of the last probes the percentiles are computed from
+PROBE_WINDOW = 100
+# Latest probes whose round trips decide whether the connector is degraded, fewer than the reported percentiles so
+# it recovers soon after the latency does
+DEGRADED_WINDOW = 10
+# Probes needed before the latency can mark the connector degraded
+MIN_LATENCY_SAMPLES = 5
+# Where the SSH server connects to reach the port it forwards, a server with GatewayPorts=no only binds loopback
+PROBE_HOST = 'localhost'
+# Origins of the channels the SSH server opens for a probe, it connects to PROBE_HOST from loopback
+PROBE_ORIGINS = ('127.0.0.1', '::1', 'localhost')
+IDLE_CHECK_INTERVAL = 10
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {'p50': None, 'p90': None, 'p99': None}
+    return {name: values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+            for name, fraction in (('p50', 0.50), ('p90', 0.90), ('p99', 0.99))}
+
+
+class ProbeError(Exception):
+    pass
+
+
+class SyntheticProbe(object):
+    """Checks end to end that the forwarded port of a connector works, the way its users reach it"""
+
+    def __init__(self, tunnel, logger, probe_interval=DEFAULT_PROBE_INTERVAL, probe_timeout=DEFAULT_PROBE_TIMEOUT,
+                 probe_failure_threshold=DEFAULT_PROBE_FAILURE_THRESHOLD,
+                 probe_latency_threshold=DEFAULT_PROBE_LATENCY_THRESHOLD, on_transition=None):
+        self.tunnel = tunnel
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.probe_failure_threshold = probe_failure_threshold
+        self.probe_latency_threshold = probe_latency_threshold
+        self.on_transition = on_transition
+        self.connect_latencies = deque(maxlen=PROBE_WINDOW)
+        self.round_trips = deque(maxlen=PROBE_WINDOW)
+        self.probes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.last_error = None
+        self.last_probe_at = None
+        self.degraded = False
+        self.degraded_reason = None
+        self.degraded_since = None
+        self.stopped = False
+        self.thread = None
+        # Set while a probe waits for its channel, and the error of a connection to the service it caused
+        self.in_flight = False
+        self.own_failure = None
+
+    def set_settings(self, probe_interval=None, probe_timeout=None, probe_failure_threshold=None,
+                     probe_latency_threshold=None):
+        with self.lock:
+            for key, value in (('probe_interval', probe_interval), ('probe_timeout', probe_timeout),
+                               ('probe_failure_threshold', probe_failure_threshold),
+                               ('probe_latency_threshold', probe_latency_threshold)):
+                if value is not None:
+                    setattr(self, key, value)
+            self.wakeup.notify()
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="synthetic-probe")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            self.wakeup.notify()
+
+    def run(self):
+        while True:
+            with self.lock:
+                self.wakeup.wait(self.probe_interval if self.probe_interval > 0 else IDLE_CHECK_INTERVAL)
+                if self.stopped:
+                    return
+                if self.probe_interval <= 0:
+                    continue
+            if self.tunnel.draining:
+                # The server no longer forwards the port to this connector
+                continue
+            self.probe()
+
+    def probe(self):
+        started = time.monotonic()
+        with self.lock:
+            self.in_flight = True
+            self.own_failure = None
+        try:
+            connect_latency, round_trip = self.measure(started)
+            with self.lock:
+                own_failure = self.own_failure
+            if own_failure is not None:
+                raise ProbeError("the connector failed to reach the service: %r" % (own_failure,))
+        except Exception as e:
+            self.record(None, None, e)
+        else:
+            self.record(connect_latency, round_trip, None)
+        finally:
+            with self.lock:
+                self.in_flight = False
+
+    def upstream_failed(self, origin_addr, error):
+        """Called when the connector fails to reach the service for a channel, fails the probe if it is its channel"""
+        with self.lock:
+            if self.in_flight and origin_addr and origin_addr[0] in PROBE_ORIGINS:
+                self.own_failure = error
+
+    def measure(self, started):
+        transport = self.tunnel.transport
+        if transport is None or not transport.is_active():
+            raise ProbeError("the SSH session is down")
+        chan = transport.open_channel('direct-tcpip', (PROBE_HOST, self.tunnel.server_port), ('127.0.0.1', 0),
+                                      timeout=self.probe_timeout)
+        try:
+            connect_latency = time.monotonic() - started
+            chan.settimeout(max(0.0, self.probe_timeout - connect_latency))
+            chan.shutdown_write()
+            chan.recv(1)
+            return connect_latency, time.monotonic() - started
+        except socket.timeout:
+            raise ProbeError("no answer after %s seconds" % (self.probe_timeout,))
+        finally:
+            chan.close()
+
+    def record(self, connect_latency, round_trip, error):
+        with self.lock:
+            self.probes += 1
+            self.last_probe_at = time.time()
+            if error is None:
+                self.consecutive_failures = 0
+                self.connect_latencies.append(connect_latency)
+                self.round_trips.append(round_trip)
+            else:
+                self.failures += 1
+                self.consecutive_failures += 1
+                self.last_error = str(error) or repr(error)
+                self.logger.info("Synthetic probe failed: %s", self.last_error)
+            reason = self.degradation()
+            changed = (reason is not None) != self.degraded
+            self.degraded = reason is not None
+            self.degraded_reason = reason
+            if not changed:
+                return
+            self.degraded_since = time.time() if self.degraded else None
+        if reason:
+            self.logger.warning("Connector is degraded: %s", reason)
+        else:
+            self.logger.info("Connector is no longer degraded")
+        if self.on_transition:
+            try:
+                self.on_transition(reason is not None, reason)
+            except Exception as e:
+                self.logger.exception("Failed to handle probe transition: %r", e)
+
+    def degradation(self):
+        """The reason the connector is degraded, None when it is not"""
+        if 0 < self.probe_failure_threshold <= self.consecutive_failures:
+            return "%d consecutive probes failed, the last one with: %s" % (self.consecutive_failures,
+                                                                            self.last_error)
+        recent = list(self.round_trips)[-DEGRADED_WINDOW:]
+        if self.probe_latency_threshold > 0 and len(recent) >= MIN_LATENCY_SAMPLES:
+            p90 = percentiles(recent)['p90']
+            if p90 > self.probe_latency_threshold:
+                return "p90 probe round trip of %.3fs is over %ss" % (p90, self.probe_latency_threshold)
+        return None
+
+    def stats(self):
+        with self.lock:
+            return {'enabled': self.thread is not None and self.probe_interval > 0,
+                    'interval': self.probe_interval,
+                    'probes': self.probes,
+                    'failures': self.failures,
+                    'consecutive_failures': self.consecutive_failures,
+                    'last_error': self.last_error,
+                    'last_probe_at': self.last_probe_at,
+                    'degraded': self.degraded,
+                    'degraded_reason': self.degraded_reason,
+                    'degraded_since': self.degraded_since,
+                    'connect_latency': percentiles(self.connect_latencies),
+                    'round_trip': percentiles(self.round_trips)}
@@ -0,0 +1,45 @@
+import threading
+import time
+
+
+class TokenBucket(object):
+    """Thread safe token bucket. A rate <= 0 means unlimited."""
+
+    def __init__(self, rate, capacity=None):
+        self.lock = threading.Lock()
+        self.rate = 0.0
+        self.capacity = 0.0
+        self.tokens = 0.0
+        self.last = time.monotonic()
+        self.set_rate(rate, capacity)
+        self.tokens = self.capacity
+
+    def set_rate(self, rate, capacity=None):
+        with self.lock:
+            self._refill()
+            self.rate = float(rate or 0)
+            self.capacity = float(capacity if capacity is not None else max(self.rate, 1))
+            self.tokens = min(self.tokens, self.capacity)
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate > 0:
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def reserve(self, amount=1):
+        """Takes amount tokens, going into debt if needed, and returns how many seconds the caller must wait"""
+        with self.lock:
+            if self.rate <= 0:
+                return 0
+            self._refill()
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def consume(self, amount=1):
+        delay = self.reserve(amount)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
@@ -0,0 +1,133 @@
+import bisect
+import threading
+import time
+
+# paramiko.common.MSG_NEWKEYS, copied so that importing pytun does not load paramiko
+MSG_NEWKEYS = 21
+
+# Upper bounds in seconds of the histogram buckets, the last bucket takes everything above
+DEFAULT_BOUNDS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram(object):
+    """Counts of observations by bucket, with their sum and maximum. The caller serializes the calls"""
+
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def to_dict(self):
+        return {'count': self.count,
+                'sum': self.sum,
+                'max': self.max,
+                'bounds': list(self.bounds),
+                'counts': list(self.counts)}
+
+
+class TransportMetrics(object):
+    """Counters and histograms of what happens inside the paramiko transport of a connector"""
+
+    def __init__(self):
+        # Packets are counted under the packetizer write lock or on the transport thread, only histograms need this
+        self.lock = threading.Lock()
+        self.packets_sent = 0
+        self.packets_received = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.rekeys = 0
+        self.rekey_started = None
+        self.rekey_seconds = Histogram()
+        self.window_stalls = 0
+        self.stalled_channels = 0
+        self.window_stall_seconds = Histogram()
+        self.keepalive_rtt = Histogram()
+
+    def instrument(self, transport):
+        """Wraps transport once its first key exchange is done: any key exchange after that is a rekey"""
+        # paramiko has no hooks for these, the methods are wrapped on the instances
+        packetizer = transport.packetizer
+        write_all, read_all, read_message = packetizer.write_all, packetizer.read_all, packetizer.read_message
+        send_kex_init = transport._send_kex_init
+
+        def counted_write_all(out):
+            # Once per packet, send_message writes the whole encrypted packet at once
+            write_all(out)
+            self.packets_sent += 1
+            self.bytes_sent += len(out)
+
+        def counted_read_all(n, check_rekey=False):
+            out = read_all(n, check_rekey)
+            self.bytes_received += len(out)
+            return out
+
+        def counted_read_message():
+            ptype, m = read_message()
+            self.packets_received += 1
+            if ptype == MSG_NEWKEYS:
+                self.rekey_done()
+            return ptype, m
+
+        def timed_send_kex_init():
+            # Called whichever side starts the rekey
+            self.rekey_started = time.monotonic()
+            send_kex_init()
+
+        packetizer.write_all = counted_write_all
+        packetizer.read_all = counted_read_all
+        packetizer.read_message = counted_read_message
+        transport._send_kex_init = timed_send_kex_init
+
+    def rekey_done(self):
+        started, self.rekey_started = self.rekey_started, None
+        if started is None:
+            return
+        with self.lock:
+            self.rekeys += 1
+            self.rekey_seconds.observe(time.monotonic() - started)
+
+    def watch_channel(self, chan):
+        """Times the sends of chan that wait for the server to open the window of the channel again"""
+        wait_for_send_window = chan._wait_for_send_window
+
+        def timed_wait_for_send_window(size):
+            if chan.out_window_size > 0:
+                return wait_for_send_window(size)
+            started = time.monotonic()
+            with self.lock:
+                self.window_stalls += 1
+                self.stalled_channels += 1
+            try:
+                return wait_for_send_window(size)
+            finally:
+                with self.lock:
+                    self.stalled_channels -= 1
+                    self.window_stall_seconds.observe(time.monotonic() - started)
+
+        chan._wait_for_send_window = timed_wait_for_send_window
+
+    def keepalive(self, seconds):
+        with self.lock:
+            self.keepalive_rtt.observe(seconds)
+
+    def stats(self):
+        with self.lock:
+            return {'packets_sent': self.packets_sent,
+                    'packets_received': self.packets_received,
+                    'bytes_sent': self.bytes_sent,
+                    'bytes_received': self.bytes_received,
+                    'rekeys': self.rekeys,
+                    'rekeying': self.rekey_started is not None,
+                    'rekey_seconds': self.rekey_seconds.to_dict(),
+                    'window_stalls': self.window_stalls,
+                    'stalled_channels': self.stalled_channels,
+                    'window_stall_seconds': self.window_stall_seconds.to_dict(),
+                    'keepalive_rtt': self.keepalive_rtt.to_dict()}
@@ -1,65 +1,252 @@
 import select
 import socket
 import threading
+import time
 
-from paramiko import SSHException
+from .BandwidthShaper import BandwidthShaper
+from .ConnectionReaper import ConnectionReaper
+from .ConnectionTrace import ConnectionTrace, ERROR_REASONS
+from .SyntheticProbe import SyntheticProbe
+from .TransportMetrics import TransportMetrics
+from .CircuitBreaker import CLOSED, OPEN
+from .UpstreamPool import UpstreamPool, CircuitOpenError, CONNECT_TIMEOUT, DEFAULT_BALANCE, \
+    DEFAULT_HEALTH_CHECK_INTERVAL
+from . import Socks5
+
+# Seconds between checks of failed and draining while no connection arrives
+ACCEPT_TIMEOUT = 1
+# Short, new connections are refused until the replacement of a connector binds the port
+BIND_RETRY_INTERVAL = 0.05
+# Bytes read at once from either side, the default maximum packet size of an SSH channel
+RELAY_BUFFER_SIZE = 32768
+# Seconds between checks that the client did not close a channel it already sent EOF on
+HALF_CLOSED_CHECK_INTERVAL = 1
 
 
 class Tunnel(object):
 
     def __init__(self, name, server_port, remote_host, remote_port, client, logger, keep_alive_time=30,
-                 alert_senders=None):
+                 alert_senders=None, on_forwarding=None, connection_trace=None, on_transport_ready=None,
+                 bind_retry_time=0, timeouts=None, allowlist=None, upstreams=None, balance=DEFAULT_BALANCE,
+                 health_check_interval=DEFAULT_HEALTH_CHECK_INTERVAL, breaker=None, shaping=None, probes=None):
         self.name = name
         self.timer = None
         self.server_port = server_port
-        self.remote_host = remote_host
-        self.remote_port = remote_port
+        if upstreams is None:
+            upstreams = [(remote_host, remote_port)]
+        self.upstreams = UpstreamPool(upstreams, logger, balance=balance, health_check_interval=health_check_interval,
+                                      on_transition=self.circuit_transition, **(breaker or {}))
         self.client = client
         self.transport = None
         self.logger = logger
         self.keep_alive_time = keep_alive_time
         self.alert_senders = alert_senders
         self.failed = False
+        self.on_forwarding = on_forwarding
+        self.on_transport_ready = on_transport_ready
+        self.bind_retry_time = bind_retry_time
+        self.connection_trace = connection_trace or ConnectionTrace()
+        self.stats_lock = threading.Lock()
+        self.started_at = time.time()
+        self.active_connections = 0
+        self.connections_total = 0
+        self.bytes_up = 0
+        self.bytes_down = 0
+        self.connection_errors = 0
+        self.active_records = set()
+        self.draining = False
+        self.drain_deadline = None
+        self.stopped = False
+        # Native ids of the threads of this connector and the CPU seconds of the ones that ended, for the usage
+        # accounting of a connector that shares its process with others
+        self.thread_ids = set()
+        self.finished_cpu = 0.0
+        self.reaper = ConnectionReaper(logger, **(timeouts or {}))
+        self.shaper = BandwidthShaper(**(shaping or {}))
+        self.transport_metrics = TransportMetrics()
+        self.prober = SyntheticProbe(self, logger, on_transition=self.probe_transition, **(probes or {}))
+        # Set in dynamic mode: channels speak SOCKS5 and name their destination instead of going to the upstreams
+        self.allowlist = allowlist
 
-    def handler(self, chan, host, port):
-        with socket.socket() as sock:
+    def handler(self, chan):
+        started = time.monotonic()
+        record = self.connection_trace.begin()
+        thread_id = threading.get_native_id()
+        with self.stats_lock:
+            self.active_connections += 1
+            self.connections_total += 1
+            self.active_records.add(record)
+            self.thread_ids.add(thread_id)
+        self.transport_metrics.watch_channel(chan)
+        try:
+            destination = None
+            if self.allowlist is not None:
+                destination = self.socks_handshake(chan, record)
+                if destination is None:
+                    return
+            self.relay(chan, destination, record, started)
+        finally:
+            with self.stats_lock:
+                self.active_connections -= 1
+                self.active_records.discard(record)
+                self.bytes_up += record.bytes_up
+                self.bytes_down += record.bytes_down
+                if record.reason in ERROR_REASONS:
+                    self.connection_errors += 1
+                self.thread_ids.discard(thread_id)
+                self.finished_cpu += time.thread_time()
+
+    def socks_handshake(self, chan, record):
+        """Returns the (address, port) an allowed SOCKS5 request asks for. Otherwise rejects it and returns None"""
+        chan.settimeout(Socks5.HANDSHAKE_TIMEOUT)
+        try:
+            host, port = Socks5.negotiate(chan)
+            address = self.allowlist.resolve(host, port)
+            if address is None:
+                raise Socks5.Socks5Error("%s:%d is not allowed" % (host, port), Socks5.NOT_ALLOWED)
+        except Exception as e:
+            reply = e.reply if isinstance(e, Socks5.Socks5Error) else Socks5.GENERAL_FAILURE
+            record.close('not_allowed' if reply == Socks5.NOT_ALLOWED else 'socks_error')
+            self.logger.info("Rejected SOCKS request from %r: %s", chan.origin_addr, e)
             try:
-                sock.settimeout(2)
-                sock.connect((host, port))
+                if reply is not None:
+                    Socks5.send_reply(chan, reply)
             except Exception as e:
-                self.logger.exception("Forwarding request to %s:%d failed: %r" % (host, port, e))
-                if self.alert_senders:
-                    message = "Failed to Establish connection to %s:%d with error: %r" % (host, port, e)
-                    for each in self.alert_senders:
-                        try:
-                            each.send_alert(self.name, message=message)
-                        except Exception as e:
-                            self.logger.exception("Failed to send alert: %r", e)
+                self.logger.debug("Failed to answer SOCKS request: %r", e)
+            chan.close()
+            return None
+        chan.settimeout(None)
+        self.logger.debug("SOCKS request from %r to %s:%d", chan.origin_addr, host, port)
+        return address, port
+
+    def relay(self, chan, destination, record, started):
+        """Connects to destination, or to one of the upstreams without it, and relays until both sides are done"""
+        upstream = None
+        try:
+            if destination is not None:
+                sock = socket.create_connection(destination, CONNECT_TIMEOUT)
+            else:
+                sock, upstream = self.upstreams.connect()
+        except Exception as e:
+            record.close('circuit_open' if isinstance(e, CircuitOpenError) else 'upstream_connect_failed')
+            if destination is None:
+                self.prober.upstream_failed(chan.origin_addr, e)
+            if destination is not None:
+                # The client picked the destination, it is not an outage of the connector
+                self.logger.info("SOCKS connection to %s:%d failed: %r", destination[0], destination[1], e)
+                try:
+                    Socks5.send_reply(chan, Socks5.connect_error_reply(e))
+                except Exception as e:
+                    self.logger.debug("Failed to answer SOCKS request: %r", e)
+                chan.close()
                 return
+            if isinstance(e, CircuitOpenError):
+                self.logger.debug("Rejected connection from %r, the upstream circuits are open", chan.origin_addr)
+                chan.close()
+                return
+            self.logger.warning("Failed to forward a connection to %s" % (e,))
+            if self.upstreams.failure_threshold <= 0:
+                # Without circuit breaker every failure alerts, with it circuit_transition alerts on opening
+                self.send_alerts("Failed to Establish connection to %s" % (e,))
+            chan.close()
+            return
+        with sock:
+            try:
+                self.relay_connected(chan, sock, record, started)
+            finally:
+                if upstream is not None:
+                    self.upstreams.release(upstream)
+
+    def circuit_transition(self, upstream, previous, state, error):
+        if state == OPEN and previous == CLOSED:
+            self.send_alerts("Upstream %s is unreachable after %d failed connections, rejecting connections to it: %r"
+                             % (upstream, upstream.breaker.consecutive_failures, error))
+        elif state == CLOSED:
+            self.send_alerts("Upstream %s is reachable again" % (upstream,))
 
+    def probe_transition(self, degraded, reason):
+        if degraded:
+            self.send_alerts("Connector is degraded, %s" % (reason,))
+        else:
+            self.send_alerts("Connector is no longer degraded, probes go through again")
+
+    def send_alerts(self, message):
+        for each in self.alert_senders or ():
+            try:
+                each.send_alert(self.name, message=message)
+            except Exception as e:
+                self.logger.exception("Failed to send alert: %r", e)
+
+    def relay_connected(self, chan, sock, record, started):
+        record.upstream_connected()
+        # Blocked writes are bounded by upstream_write_timeout, enforced by the reaper
+        sock.settimeout(None)
+        watched = self.reaper.watch(chan, sock, record, started)
+        shaped = self.shaper.open()
+        try:
             self.logger.debug(
                 "Connected!  Connector open %r -> %r -> %r"
-                , chan.origin_addr, chan.getpeername(), (host, port)
+                , chan.origin_addr, chan.getpeername(), sock.getpeername()
             )
-            try:
-                while True:
-                    r, w, x = select.select([sock, chan], [], [])
-                    if sock in r:
-                        data = sock.recv(1024)
-                        if len(data) == 0:
-                            break
-                        chan.send(data)
-                    if chan in r:
-                        data = chan.recv(1024)
-                        if len(data) == 0:
-                            break
-                        sock.send(data)
-                chan.close()
-                self.logger.debug("Connector closed from %r", chan.origin_addr)
-            except ConnectionResetError as e:
+            if self.allowlist is not None:
+                Socks5.send_reply(chan, Socks5.SUCCEEDED, sock.getsockname())
+            # Each direction ends on its own: EOF from one side is passed on to the other one, which can still
+            # answer, and the connection closes once both sides finished sending
+            reading = [sock, chan]
+            first_eof = None
+            while reading:
+                if chan not in reading and chan.closed:
+                    # The client closed the channel, nobody is left to read what the upstream still sends
+                    break
+                r, w, x = select.select(reading, [], [], None if chan in reading else HALF_CLOSED_CHECK_INTERVAL)
+                if sock in r:
+                    data = sock.recv(RELAY_BUFFER_SIZE)
+                    if len(data) == 0:
+                        reading.remove(sock)
+                        first_eof = first_eof or 'upstream_eof'
+                        watched.upstream_finished()
+                        chan.shutdown_write()
+                    else:
+                        watched.received_down()
+                        self.shaper.throttle(shaped, 'down', len(data))
+                        chan.sendall(data)
+                        record.sent_down(len(data))
+                if chan in r:
+                    data = chan.recv(RELAY_BUFFER_SIZE)
+                    if len(data) == 0:
+                        reading.remove(chan)
+                        first_eof = first_eof or 'client_eof'
+                        try:
+                            sock.shutdown(socket.SHUT_WR)
+                        except OSError:
+                            # The upstream is already gone, its EOF or reset comes with the next read
+                            pass
+                    else:
+                        self.shaper.throttle(shaped, 'up', len(data))
+                        watched.writing_up()
+                        sock.sendall(data)
+                        watched.sent_up()
+                        record.sent_up(len(data))
+            record.close(first_eof or 'client_eof')
+            chan.close()
+            self.logger.debug("Connector closed from %r", chan.origin_addr)
+        except Exception as e:
+            if watched.reaped:
+                # The reaper shut the socket down under a pending send
+                self.logger.debug("Reaped connection ended with %r", e)
+            elif isinstance(e, (ConnectionResetError, BrokenPipeError)):
+                record.close('reset')
                 self.logger.debug(e)
-            except Exception as e:
+            elif chan.closed:
+                # The client went away while the upstream was still answering
+                record.close('client_eof')
+                self.logger.debug("Channel closed by the client while relaying: %r", e)
+            else:
+                record.close('error')
                 self.logger.exception(e)
+        finally:
+            self.shaper.close(shaped)
+            self.reaper.forget(watched)
 
     def validate_tunnel_up(self):
         self.logger.debug("Going to check if connector is up")
@@ -74,7 +261,9 @@ class Tunnel(object):
             self.failed = True
             return
         try:
+            started = time.monotonic()
             chn = self.transport.open_session(timeout=30)
+            self.transport_metrics.keepalive(time.monotonic() - started)
             chn.close()
         except Exception as e:
             self.logger.exception("Connector down! Failed to start a check session %s with timeout 30 seconds", e)
@@ -86,23 +275,84 @@ class Tunnel(object):
     def reverse_forward_tunnel(self):
         try:
             self.transport = self.client.get_transport()
-            self.transport.request_port_forward("", self.server_port)
-            self.timer = threading.Timer(30, self.validate_tunnel_up)
+            self.transport_metrics.instrument(self.transport)
+            with self.stats_lock:
+                self.thread_ids.update((threading.get_native_id(), self.transport.native_id))
+            if self.on_transport_ready:
+                self.on_transport_ready()
+            self.request_port_forward()
+            if self.on_forwarding:
+                self.on_forwarding()
+            if self.allowlist is None:
+                # A SOCKS5 connector has no destination of its own to check or probe
+                self.upstreams.start()
+                self.prober.start()
+            self.timer = threading.Timer(self.keep_alive_time, self.validate_tunnel_up)
             self.timer.start()
             while True:
-                chan = self.transport.accept(10)
-                if self.failed:
+                chan = self.transport.accept(ACCEPT_TIMEOUT)
+                if self.failed or self.stopped:
+                    return
+                if self.draining and self.drained():
+                    self.logger.info("Drained, %d connections left", self.active_connections)
                     return
                 if chan is None:
                     continue
-                thr = threading.Thread(
-                    target=self.handler, args=(chan, self.remote_host, self.remote_port)
-                )
+                thr = threading.Thread(target=self.handler, args=(chan,), name="connection-handler")
                 thr.setDaemon(True)
                 thr.start()
         except Exception as e:
             self.logger.exception("Failed to forward")
 
+    def request_port_forward(self):
+        # During a handoff the process being replaced may still hold the port for a moment
+        deadline = time.monotonic() + self.bind_retry_time
+        while True:
+            try:
+                self.transport.request_port_forward("", self.server_port)
+                return
+            except Exception as e:
+                if time.monotonic() >= deadline:
+                    raise e
+                self.logger.debug("Port %d not available yet: %r", self.server_port, e)
+                time.sleep(BIND_RETRY_INTERVAL)
+
+    def stats(self):
+        with self.stats_lock:
+            return {'started_at': self.started_at,
+                    'active_connections': self.active_connections,
+                    'connections_total': self.connections_total,
+                    'bytes_up': self.bytes_up + sum(each.bytes_up for each in self.active_records),
+                    'bytes_down': self.bytes_down + sum(each.bytes_down for each in self.active_records),
+                    'connection_errors': self.connection_errors,
+                    'draining': self.draining,
+                    'reaped': self.reaper.counts(),
+                    'shaping': self.shaper.stats(),
+                    'transport': self.transport_metrics.stats(),
+                    'probes': self.prober.stats(),
+                    'upstreams': self.upstreams.stats()}
+
+    def drain(self, timeout):
+        """Stops accepting connections. reverse_forward_tunnel returns once the active ones end or after timeout"""
+        self.logger.info("Draining %d connections for up to %s seconds", self.active_connections, timeout)
+        self.drain_deadline = time.monotonic() + timeout
+        self.draining = True
+        # Not transport.cancel_port_forward(), it would also reject the channels the server opened before the cancel
+        self.transport.global_request("cancel-tcpip-forward", ("", self.server_port), wait=True)
+        return {'active_connections': self.active_connections}
+
+    def drained(self):
+        return self.active_connections == 0 or time.monotonic() > self.drain_deadline
+
+    def cpu_seconds(self, thread_times):
+        """CPU seconds of the threads of this tunnel, thread_times maps native thread ids to their CPU seconds"""
+        with self.stats_lock:
+            return self.finished_cpu + sum(thread_times.get(each, 0) for each in self.thread_ids)
+
     def stop(self):
+        self.stopped = True
+        self.upstreams.stop()
+        self.reaper.stop()
+        self.prober.stop()
         if self.timer:
             self.timer.cancel()
@@ -1,12 +1,23 @@
 import configparser
+import logging
 import multiprocessing
 import os
 import signal
 import sys
+import threading
 
-import paramiko
-
+from .Allowlist import Allowlist
+from .BandwidthShaper import SHAPING_SETTINGS, parse_limits
+from .CircuitBreaker import DEFAULT_FAILURE_THRESHOLD, DEFAULT_RESET_TIMEOUT
+from .ConnectionReaper import DEFAULT_IDLE_TIMEOUT, DEFAULT_MAX_CONNECTION_LIFETIME, DEFAULT_UPSTREAM_READ_TIMEOUT, \
+    DEFAULT_UPSTREAM_WRITE_TIMEOUT
+from .ConnectionTrace import ConnectionTrace, DEFAULT_CAPACITY
+from .ControlChannel import ControlChannel, ControlError, DEFAULT_TIMEOUT as DEFAULT_CONTROL_TIMEOUT
+from .SamplingProfiler import SamplingProfiler
+from .SyntheticProbe import PROBE_SETTINGS, DEFAULT_PROBE_INTERVAL, DEFAULT_PROBE_TIMEOUT, \
+    DEFAULT_PROBE_FAILURE_THRESHOLD, DEFAULT_PROBE_LATENCY_THRESHOLD
 from .Tunnel import Tunnel
+from .UpstreamPool import BALANCE_POLICIES, DEFAULT_BALANCE, DEFAULT_HEALTH_CHECK_INTERVAL, parse_targets
 from configure_logger import LogManager
 from os.path import isabs, dirname, realpath, join
 
@@ -14,6 +25,22 @@ DEFAULT_KEEP_ALIVE_TIME = 30
 
 SSH_PORT = 22
 DEFAULT_PORT = 4000
+DEFAULT_DRAIN_TIMEOUT = 10
+# forward relays every channel to remote_host:remote_port, socks5 to the destination each channel asks for
+MODES = ('forward', 'socks5')
+# Seconds a replacement process waits for the one it replaces to release the forwarded port
+HANDOFF_TIMEOUT = 30
+HANDOFF_BIND_RETRY = 10
+# Extra seconds the supervisor waits for a profile on top of the profiled window
+PROFILE_REPLY_MARGIN = 10
+
+TIMEOUT_SETTINGS = ('idle_timeout', 'max_connection_lifetime', 'upstream_read_timeout', 'upstream_write_timeout')
+# Settings reload-config applies to the running connector, the rest only change with a new process
+RELOADABLE_SETTINGS = ('log_level', 'keep_alive_time', 'remote_host', 'remote_port', 'upstreams', 'balance',
+                       'health_check_interval', 'circuit_failure_threshold', 'circuit_reset_timeout', 'drain_timeout',
+                       'allow') + TIMEOUT_SETTINGS + SHAPING_SETTINGS + PROBE_SETTINGS
+RESTART_SETTINGS = ('server_host', 'server_port', 'server_key', 'user_to_login', 'key_file',
+                    'remote_port_to_forward', 'tunnel_name', 'mode')
 
 
 class TunnelProcess(multiprocessing.Process):
@@ -21,7 +48,17 @@ class TunnelProcess(multiprocessing.Process):
 
     def __init__(self, tunnel_name, server_host, server_port, server_key, user_to_login, key_file, remote_port_to_forward,
                  remote_host, remote_port, keep_alive_time, log_level, log_to_console, alert_senders=None,
-                 log_filename=None, log_path=None):
+                 log_filename=None, log_path=None, trace_capacity=DEFAULT_CAPACITY, config_file=None,
+                 drain_timeout=DEFAULT_DRAIN_TIMEOUT, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 max_connection_lifetime=DEFAULT_MAX_CONNECTION_LIFETIME,
+                 upstream_read_timeout=DEFAULT_UPSTREAM_READ_TIMEOUT,
+                 upstream_write_timeout=DEFAULT_UPSTREAM_WRITE_TIMEOUT, mode='forward', allow='', upstreams=None,
+                 balance=DEFAULT_BALANCE, health_check_interval=DEFAULT_HEALTH_CHECK_INTERVAL,
+                 circuit_failure_threshold=DEFAULT_FAILURE_THRESHOLD, circuit_reset_timeout=DEFAULT_RESET_TIMEOUT,
+                 rate_limit_up=0, rate_limit_down=0, connection_rate_limit_up=0, connection_rate_limit_down=0,
+                 fair_share=False, probe_interval=DEFAULT_PROBE_INTERVAL, probe_timeout=DEFAULT_PROBE_TIMEOUT,
+                 probe_failure_threshold=DEFAULT_PROBE_FAILURE_THRESHOLD,
+                 probe_latency_threshold=DEFAULT_PROBE_LATENCY_THRESHOLD):
         if log_filename is None:
             log_filename = os.path.splitext(os.path.basename(tunnel_name))[0] + ".log"
         self.log_filename = log_filename
@@ -44,15 +81,170 @@ class TunnelProcess(multiprocessing.Process):
         self.log_level = log_level
         self.log_to_console = log_to_console
         self.alert_senders = alert_senders
+        self.forwarding_event = multiprocessing.Event()
+        self.connection_trace = ConnectionTrace(trace_capacity)
+        self.control = ControlChannel()
+        self.config_file = config_file
+        self.drain_requested = False
+        self.drain_timeout = drain_timeout
+        self.idle_timeout = idle_timeout
+        self.max_connection_lifetime = max_connection_lifetime
+        self.upstream_read_timeout = upstream_read_timeout
+        self.upstream_write_timeout = upstream_write_timeout
+        self.mode = mode
+        self.allow = allow
+        if upstreams is None:
+            upstreams = [(remote_host, remote_port)] if mode == 'forward' else []
+        self.upstreams = upstreams
+        self.balance = balance
+        self.health_check_interval = health_check_interval
+        self.circuit_failure_threshold = circuit_failure_threshold
+        self.circuit_reset_timeout = circuit_reset_timeout
+        self.rate_limit_up = rate_limit_up
+        self.rate_limit_down = rate_limit_down
+        self.connection_rate_limit_up = connection_rate_limit_up
+        self.connection_rate_limit_down = connection_rate_limit_down
+        self.fair_share = fair_share
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.probe_failure_threshold = probe_failure_threshold
+        self.probe_latency_threshold = probe_latency_threshold
+        self.handoff = False
+        # Set when a WorkerProcess runs this connector on its threads instead of in a process of its own
+        self.hosted = False
+        self.stop_requested = False
+        self.transport_ready_event = multiprocessing.Event()
+        self.bind_event = multiprocessing.Event()
 
         super().__init__()
 
+    def call(self, command, timeout=DEFAULT_CONTROL_TIMEOUT, **kwargs):
+        """Sends a control command to the child. Called from the supervisor"""
+        if not self.is_alive():
+            raise ControlError("Connector %s is not running" % (self.tunnel_name,))
+        return self.control.call(command, timeout=timeout, **kwargs)
+
+    def profile(self, seconds, output_format='collapsed'):
+        return self.call('profile', timeout=seconds + PROFILE_REPLY_MARGIN, seconds=seconds,
+                         output_format=output_format)
+
+    def drain(self, timeout=None):
+        self.drain_requested = True
+        return self.call('drain', timeout_seconds=self.drain_timeout if timeout is None else timeout)
+
+    def start_control_thread(self):
+        control_thread = threading.Thread(target=self.serve_control_requests, name="control-requests")
+        control_thread.daemon = True
+        control_thread.start()
+
+    def serve_control_requests(self):
+        self.control.supervisor_end.close()
+        self.control.serve({'get-stats': self.get_stats,
+                            'set-log-level': self.set_log_level,
+                            'drain': self.start_drain,
+                            'reload-config': self.reload_config,
+                            'set-rate-limits': self.set_rate_limits,
+                            'dump-connections': self.connection_trace.snapshot,
+                            'profile': self.run_profiler}, self.logger)
+
+    def get_stats(self):
+        stats = {'pid': os.getpid(),
+                 'tunnel_name': self.tunnel_name,
+                 'mode': self.mode,
+                 'log_level': logging.getLevelName(self.logger.getEffectiveLevel()),
+                 'forwarding': self.forwarding_event.is_set(),
+                 'threads': threading.active_count()}
+        if self.tunnel:
+            stats.update(self.tunnel.stats())
+        return stats
+
+    def set_log_level(self, level):
+        # The paramiko logger of a worker is shared by all its connectors
+        LogManager.set_level(level.upper(), [self.logger.name] if self.hosted else [self.logger.name, "paramiko"])
+        self.logger.info("Log level set to %s", level)
+        return level.upper()
+
+    def wait_for_handoff(self):
+        """Runs once the SSH transport is up. A replacement waits here until the supervisor has drained the old process"""
+        if not self.handoff:
+            return
+        self.transport_ready_event.set()
+        if not self.bind_event.wait(HANDOFF_TIMEOUT):
+            self.logger.warning("No handoff signal after %s seconds, forwarding anyway", HANDOFF_TIMEOUT)
+
+    def start_drain(self, timeout_seconds=DEFAULT_DRAIN_TIMEOUT):
+        if not self.tunnel:
+            raise RuntimeError("Connector is not forwarding yet")
+        return self.tunnel.drain(float(timeout_seconds))
+
+    def reload_config(self):
+        """Applies the settings that can change without a new SSH session and lists the ones that need a restart"""
+        config = TunnelProcess.read_config(self.config_file)
+        applied = {}
+        for key in RELOADABLE_SETTINGS:
+            if config[key] != getattr(self, key):
+                setattr(self, key, config[key])
+                applied[key] = config[key]
+        if 'log_level' in applied:
+            self.set_log_level(applied['log_level'])
+        if self.tunnel:
+            if self.tunnel.allowlist is not None:
+                self.tunnel.allowlist = self.socks_allowlist()
+            self.tunnel.upstreams.set_targets(self.upstreams, self.balance, self.health_check_interval)
+            self.tunnel.upstreams.set_breaker(self.circuit_failure_threshold, self.circuit_reset_timeout)
+            self.tunnel.keep_alive_time = self.keep_alive_time
+            self.tunnel.reaper.set_timeouts(**self.timeouts())
+            self.tunnel.shaper.set_limits(**self.shaping())
+            self.tunnel.prober.set_settings(**self.probe_settings())
+        requires_restart = [key for key in RESTART_SETTINGS if config[key] != getattr(self, key)]
+        self.logger.info("Configuration reloaded. Applied %s, need a restart %s", applied, requires_restart)
+        return {'applied': applied, 'requires_restart': requires_restart}
+
+    def socks_allowlist(self):
+        allowlist = Allowlist(self.allow)
+        if not allowlist:
+            self.logger.warning("SOCKS5 connector with an empty allow setting, every request will be rejected")
+        return allowlist
+
+    def timeouts(self):
+        return {key: getattr(self, key) for key in TIMEOUT_SETTINGS}
+
+    def shaping(self):
+        return {key: getattr(self, key) for key in SHAPING_SETTINGS}
+
+    def probe_settings(self):
+        return {key: getattr(self, key) for key in PROBE_SETTINGS}
+
+    def set_rate_limits(self, **limits):
+        """Changes the given rate limits of the running connector until the next reload-config or restart"""
+        limits = parse_limits(limits)
+        for key, value in limits.items():
+            setattr(self, key, value)
+        if self.tunnel:
+            self.tunnel.shaper.set_limits(**self.shaping())
+        self.logger.info("Rate limits set to %s", self.shaping())
+        return self.shaping()
+
+    def run_profiler(self, seconds, output_format='collapsed'):
+        self.logger.info("Profiling for %s seconds", seconds)
+        return SamplingProfiler().run(seconds).output(output_format)
+
     def exit_gracefully(self, *args):
-        self.logger.info("Exit gracefully called for %s", self.pid)
+        self.logger.info("Exit gracefully called for %s", os.getpid())
+        self.stop_requested = True
+        tunnel = self.tunnel
+        if tunnel and tunnel.transport and not tunnel.draining and self.drain_timeout > 0:
+            # reverse_forward_tunnel returns once drained, a second signal exits right away
+            try:
+                tunnel.drain(self.drain_timeout)
+                return
+            except Exception as e:
+                self.logger.exception("Failed to drain: %r", e)
         if self.tunnel:
             self.tunnel.stop()
             self.tunnel = None
-        sys.exit(0)
+        if not self.hosted:
+            sys.exit(0)
 
     def run(self):
         self.logger = LogManager.configure_logger(self.log_filename, self.log_level, self.log_to_console,
@@ -60,16 +252,48 @@ class TunnelProcess(multiprocessing.Process):
         self.logger.info("Starting TunnelProcess with the process id: %s", self.pid)
         signal.signal(signal.SIGINT, self.exit_gracefully)
         signal.signal(signal.SIGTERM, self.exit_gracefully)
+        self.start_control_thread()
+        self.serve()
+
+    def serve(self):
+        """Connects and forwards until the connector fails or is stopped, then exits with sys.exit"""
         client = self.ssh_connect()
-        self.logger.info(
-            "Now forwarding remote port %d to %s:%d ..."
-            % (self.remote_port_to_forward, self.remote_host, self.remote_port)
-        )
+        try:
+            self.forward(client)
+        finally:
+            if self.hosted:
+                # A process closes its session on exit, a hosted connector has to
+                client.close()
+
+    def forward(self, client):
+        if self.stop_requested:
+            sys.exit(0)
+        if self.mode == 'socks5':
+            allowlist = self.socks_allowlist()
+            self.logger.info("Now serving SOCKS5 on remote port %d ...", self.remote_port_to_forward)
+        else:
+            allowlist = None
+            self.logger.info(
+                "Now forwarding remote port %d to %s ..."
+                % (self.remote_port_to_forward, ", ".join("%s:%d" % each for each in self.upstreams))
+            )
         try:
             tunnel = Tunnel(self.tunnel_name, self.remote_port_to_forward, self.remote_host, self.remote_port, client,
-                            self.logger, keep_alive_time=self.keep_alive_time, alert_senders=self.alert_senders)
+                            self.logger, keep_alive_time=self.keep_alive_time, alert_senders=self.alert_senders,
+                            on_forwarding=self.forwarding_event.set, connection_trace=self.connection_trace,
+                            on_transport_ready=self.wait_for_handoff,
+                            bind_retry_time=HANDOFF_BIND_RETRY if self.handoff else 0, timeouts=self.timeouts(),
+                            allowlist=allowlist, upstreams=self.upstreams, balance=self.balance,
+                            health_check_interval=self.health_check_interval,
+                            breaker={'failure_threshold': self.circuit_failure_threshold,
+                                     'reset_timeout': self.circuit_reset_timeout},
+                            shaping=self.shaping(), probes=self.probe_settings())
             self.tunnel = tunnel
+            if self.stop_requested:
+                # Stopped while the tunnel was being created
+                tunnel.stop()
             tunnel.reverse_forward_tunnel()
+            tunnel.stop()
             sys.exit(0)
         except KeyboardInterrupt:
             if tunnel.timer:
@@ -83,6 +307,7 @@ class TunnelProcess(multiprocessing.Process):
             sys.exit(1)
 
     def ssh_connect(self, exit_on_failure=True):
+        import paramiko
         try:
             client = paramiko.SSHClient()
             if self.server_key:
@@ -108,7 +333,8 @@ class TunnelProcess(multiprocessing.Process):
         return client
 
     @staticmethod
-    def from_config_file(ini_file, alert_senders=None):
+    def read_config(ini_file):
+        """Returns the TunnelProcess arguments defined in ini_file"""
         config = configparser.ConfigParser()
         config.read(ini_file)
         directory = dirname(realpath(ini_file))
@@ -120,9 +346,32 @@ class TunnelProcess(multiprocessing.Process):
         log_to_console = defaults.get('log_to_console', False)
         server_host = defaults['server_host']
         server_port = int(defaults.get('server_port', SSH_PORT))
-        remote_host = defaults['remote_host']
+        mode = defaults.get('mode', 'forward')
+        if mode not in MODES:
+            raise Exception("Invalid mode %s, expected one of %s" % (mode, ", ".join(MODES)))
         remote_port = int(defaults.get('remote_port', SSH_PORT))
+        if mode == 'socks5':
+            # A socks5 connector has no fixed destination
+            remote_host = defaults.get('remote_host')
+            upstreams = []
+        elif 'upstreams' in defaults:
+            upstreams = parse_targets(defaults['upstreams'], remote_port)
+            if not upstreams:
+                raise Exception("upstreams lists no target")
+            remote_host, remote_port = defaults.get('remote_host', upstreams[0][0]), upstreams[0][1]
+        else:
+            remote_host = defaults['remote_host']
+            upstreams = [(remote_host, remote_port)]
+        balance = defaults.get('balance', DEFAULT_BALANCE)
+        if balance not in BALANCE_POLICIES:
+            raise Exception("Invalid balance %s, expected one of %s" % (balance, ", ".join(BALANCE_POLICIES)))
+        health_check_interval = float(defaults.get('health_check_interval', DEFAULT_HEALTH_CHECK_INTERVAL))
+        circuit_failure_threshold = int(defaults.get('circuit_failure_threshold', DEFAULT_FAILURE_THRESHOLD))
+        circuit_reset_timeout = float(defaults.get('circuit_reset_timeout', DEFAULT_RESET_TIMEOUT))
         remote_port_to_forward = int(defaults.get('port', DEFAULT_PORT))
+        allow = defaults.get('allow', '')
+        # Raises on invalid entries, so a bad allowlist fails here and not in the connector
+        Allowlist(allow)
         if 'connector_name' in defaults:
             tunnel_name = defaults.get('connector_name', realpath(ini_file))
         else:
@@ -139,8 +388,38 @@ class TunnelProcess(multiprocessing.Process):
         if server_key is not None and not isabs(server_key):
             server_key = join(directory, server_key)
         keep_alive_time = int(defaults.get("keep_alive_time", DEFAULT_KEEP_ALIVE_TIME))
-        tunnel_process = TunnelProcess(tunnel_name, server_host, server_port, server_key, user_to_login, key_file,
-                                       remote_port_to_forward, remote_host, remote_port, keep_alive_time, log_level,
-                                       log_to_console, alert_senders=alert_senders, log_filename=log_filename,
-                                       log_path=TunnelProcess.default_log_path)
+        if keep_alive_time <= 0:
+            # The checks of the SSH session would run back to back
+            raise Exception("Invalid keep_alive_time %d, expected a positive number of seconds" % (keep_alive_time,))
+        trace_capacity = int(defaults.get("trace_capacity", DEFAULT_CAPACITY))
+        drain_timeout = float(defaults.get("drain_timeout", DEFAULT_DRAIN_TIMEOUT))
+        idle_timeout = float(defaults.get("idle_timeout", DEFAULT_IDLE_TIMEOUT))
+        max_connection_lifetime = float(defaults.get("max_connection_lifetime", DEFAULT_MAX_CONNECTION_LIFETIME))
+        upstream_read_timeout = float(defaults.get("upstream_read_timeout", DEFAULT_UPSTREAM_READ_TIMEOUT))
+        upstream_write_timeout = float(defaults.get("upstream_write_timeout", DEFAULT_UPSTREAM_WRITE_TIMEOUT))
+        shaping = parse_limits({key: defaults[key] for key in SHAPING_SETTINGS if key in defaults})
+        probe_interval = float(defaults.get("probe_interval", DEFAULT_PROBE_INTERVAL))
+        probe_timeout = float(defaults.get("probe_timeout", DEFAULT_PROBE_TIMEOUT))
+        probe_failure_threshold = int(defaults.get("probe_failure_threshold", DEFAULT_PROBE_FAILURE_THRESHOLD))
+        probe_latency_threshold = float(defaults.get("probe_latency_threshold", DEFAULT_PROBE_LATENCY_THRESHOLD))
+        return dict(tunnel_name=tunnel_name, server_host=server_host, server_port=server_port, server_key=server_key,
+                    user_to_login=user_to_login, key_file=key_file, remote_port_to_forward=remote_port_to_forward,
+                    remote_host=remote_host, remote_port=remote_port, keep_alive_time=keep_alive_time,
+                    log_level=log_level, log_to_console=log_to_console, log_filename=log_filename,
+                    trace_capacity=trace_capacity, drain_timeout=drain_timeout, idle_timeout=idle_timeout,
+                    max_connection_lifetime=max_connection_lifetime, upstream_read_timeout=upstream_read_timeout,
+                    upstream_write_timeout=upstream_write_timeout, mode=mode, allow=allow, upstreams=upstreams,
+                    balance=balance, health_check_interval=health_check_interval,
+                    circuit_failure_threshold=circuit_failure_threshold, circuit_reset_timeout=circuit_reset_timeout,
+                    rate_limit_up=shaping.get('rate_limit_up', 0), rate_limit_down=shaping.get('rate_limit_down', 0),
+                    connection_rate_limit_up=shaping.get('connection_rate_limit_up', 0),
+                    connection_rate_limit_down=shaping.get('connection_rate_limit_down', 0),
+                    fair_share=shaping.get('fair_share', False), probe_interval=probe_interval,
+                    probe_timeout=probe_timeout, probe_failure_threshold=probe_failure_threshold,
+                    probe_latency_threshold=probe_latency_threshold)
+
+    @staticmethod
+    def from_config_file(ini_file, alert_senders=None):
+        tunnel_process = TunnelProcess(alert_senders=alert_senders, log_path=TunnelProcess.default_log_path,
+                                       config_file=ini_file, **TunnelProcess.read_config(ini_file))
         return tunnel_process
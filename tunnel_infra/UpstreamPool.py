@@ -0,0 +1,219 @@
+import itertools
+import random
+import socket
+import threading
+import time
+
+from .CircuitBreaker import CircuitBreaker, CLOSED, OPEN, DEFAULT_FAILURE_THRESHOLD, DEFAULT_RESET_TIMEOUT
+
+BALANCE_POLICIES = ('round_robin', 'least_connections', 'latency')
+DEFAULT_BALANCE = 'round_robin'
+DEFAULT_HEALTH_CHECK_INTERVAL = 10
+CONNECT_TIMEOUT = 2
+# Weight of the newest connect time in the latency moving average
+LATENCY_SMOOTHING = 0.3
+
+
+class UpstreamConnectError(Exception):
+    def __init__(self, tried, error):
+        super().__init__("%s with error: %r" % (", ".join(str(each) for each in tried), error))
+        self.tried = tried
+        self.error = error
+
+
+class CircuitOpenError(UpstreamConnectError):
+    """No target was tried, the breakers of all of them are open"""
+
+
+class Upstream(object):
+    def __init__(self, host, port, breaker):
+        self.host = host
+        self.port = port
+        self.breaker = breaker
+        self.healthy = True
+        self.active = 0
+        self.connections = 0
+        self.failures = 0
+        self.latency = None
+        self.last_error = None
+
+    def __str__(self):
+        return "[%s]:%d" % (self.host, self.port) if ':' in self.host else "%s:%d" % (self.host, self.port)
+
+    def to_dict(self):
+        return {'target': str(self), 'healthy': self.healthy, 'active_connections': self.active,
+                'connections_total': self.connections, 'connect_failures': self.failures, 'latency': self.latency,
+                'last_error': self.last_error, 'circuit': self.breaker.to_dict()}
+
+
+class UpstreamPool(object):
+    """The upstream targets of a forward connector and the policy that spreads the connections over them"""
+
+    def __init__(self, targets, logger, balance=DEFAULT_BALANCE, health_check_interval=DEFAULT_HEALTH_CHECK_INTERVAL,
+                 failure_threshold=DEFAULT_FAILURE_THRESHOLD, reset_timeout=DEFAULT_RESET_TIMEOUT, on_transition=None):
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.upstreams = []
+        self.balance = balance
+        self.health_check_interval = health_check_interval
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.on_transition = on_transition
+        self.counter = itertools.count()
+        self.stopped = threading.Event()
+        self.checker = None
+        self.set_targets(targets)
+
+    def set_targets(self, targets, balance=None, health_check_interval=None):
+        """Replaces the targets, keeping the state of the ones that stay"""
+        with self.lock:
+            current = {(each.host, each.port): each for each in self.upstreams}
+            self.upstreams = [current.get((host, port)) or Upstream(host, port, self.new_breaker())
+                              for host, port in targets]
+            if balance is not None:
+                self.balance = balance
+            if health_check_interval is not None:
+                self.health_check_interval = health_check_interval
+
+    def set_breaker(self, failure_threshold, reset_timeout):
+        with self.lock:
+            self.failure_threshold = failure_threshold
+            self.reset_timeout = reset_timeout
+            for each in self.upstreams:
+                each.breaker.failure_threshold = failure_threshold
+                each.breaker.reset_timeout = reset_timeout
+
+    def new_breaker(self):
+        return CircuitBreaker(self.failure_threshold, self.reset_timeout)
+
+    def start(self):
+        if self.checker is None:
+            self.checker = threading.Thread(target=self.check_health, name="upstream-health")
+            self.checker.daemon = True
+            self.checker.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def pick(self, exclude=()):
+        with self.lock:
+            candidates = [each for each in self.upstreams if each not in exclude and each.breaker.available()]
+            healthy = [each for each in candidates if each.healthy]
+            candidates = healthy or candidates
+            if not candidates:
+                return None
+            if self.balance == 'least_connections':
+                fewest = min(each.active for each in candidates)
+                candidates = [each for each in candidates if each.active == fewest]
+            if self.balance == 'latency' and len(candidates) > 1:
+                measured = [each.latency for each in candidates if each.latency is not None]
+                # Targets without a measure yet are weighted as the fastest one, so they get traffic
+                best = min(measured) if measured else 1
+                weights = [1 / max(each.latency if each.latency is not None else best, 0.0001)
+                           for each in candidates]
+                upstream = random.choices(candidates, weights)[0]
+            else:
+                upstream = candidates[next(self.counter) % len(candidates)]
+            upstream.active += 1
+            upstream.breaker.acquire()
+            return upstream
+
+    def connect(self, timeout=CONNECT_TIMEOUT):
+        """Returns a socket connected to one of the targets and its Upstream, to release once the connection ends"""
+        tried = []
+        error = None
+        while True:
+            upstream = self.pick(tried)
+            if upstream is None and not tried:
+                with self.lock:
+                    for each in self.upstreams:
+                        each.breaker.reject()
+                raise CircuitOpenError(self.upstreams, "circuit open")
+            if upstream is None:
+                raise UpstreamConnectError(tried, error)
+            tried.append(upstream)
+            started = time.monotonic()
+            try:
+                sock = socket.create_connection((upstream.host, upstream.port), timeout)
+            except Exception as e:
+                error = e
+                self.failed(upstream, e)
+                self.release(upstream)
+                continue
+            self.succeeded(upstream, time.monotonic() - started)
+            with self.lock:
+                upstream.connections += 1
+            return sock, upstream
+
+    def release(self, upstream):
+        with self.lock:
+            upstream.active -= 1
+
+    def succeeded(self, upstream, latency):
+        with self.lock:
+            if not upstream.healthy:
+                self.logger.info("Upstream %s is up", upstream)
+            upstream.healthy = True
+            if upstream.latency is None:
+                upstream.latency = latency
+            else:
+                upstream.latency += LATENCY_SMOOTHING * (latency - upstream.latency)
+            previous = upstream.breaker.success()
+        if previous is not None:
+            self.transitioned(upstream, previous, CLOSED, None)
+
+    def failed(self, upstream, error):
+        with self.lock:
+            if upstream.healthy and len(self.upstreams) > 1:
+                self.logger.warning("Upstream %s is down: %r", upstream, error)
+            upstream.healthy = False
+            upstream.failures += 1
+            upstream.last_error = repr(error)
+            previous = upstream.breaker.failure()
+        if previous is not None:
+            self.transitioned(upstream, previous, OPEN, error)
+
+    def transitioned(self, upstream, previous, state, error):
+        self.logger.info("Circuit of upstream %s went from %s to %s", upstream, previous, state)
+        if self.on_transition:
+            try:
+                self.on_transition(upstream, previous, state, error)
+            except Exception as e:
+                self.logger.exception("Failed to handle circuit transition: %r", e)
+
+    def check_health(self):
+        while not self.stopped.wait(self.health_check_interval or DEFAULT_HEALTH_CHECK_INTERVAL):
+            with self.lock:
+                upstreams = list(self.upstreams)
+            if self.health_check_interval <= 0:
+                continue
+            for upstream in upstreams:
+                started = time.monotonic()
+                try:
+                    socket.create_connection((upstream.host, upstream.port), CONNECT_TIMEOUT).close()
+                except Exception as e:
+                    self.failed(upstream, e)
+                else:
+                    self.succeeded(upstream, time.monotonic() - started)
+
+    def stats(self):
+        with self.lock:
+            return {'balance': self.balance, 'upstreams': [each.to_dict() for each in self.upstreams]}
+
+
+def parse_targets(spec, default_port):
+    """Parses "host:port, host, [v6 address]:port" into (host, port) tuples"""
+    targets = []
+    for entry in spec.replace('\n', ',').split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        if entry.startswith('['):
+            host, _, port = entry[1:].partition(']')
+            port = port[1:]
+        elif entry.count(':') == 1:
+            host, _, port = entry.partition(':')
+        else:
+            host, port = entry, ''
+        targets.append((host, int(port) if port else default_port))
+    return targets
@@ -0,0 +1,152 @@
+import bisect
+import hashlib
+import os
+import time
+
+from .ControlChannel import ControlError, DEFAULT_TIMEOUT as DEFAULT_CONTROL_TIMEOUT
+from .TunnelProcess import TunnelProcess
+from .WorkerProcess import WorkerProcess, LANES, RUNNING, NOT_STARTED
+
+# Points of each worker on the hash ring, more spread the connectors more evenly
+HASH_REPLICAS = 64
+# Seconds to wait for a worker that is still starting to answer
+WORKER_START_TIMEOUT = 30
+JOIN_INTERVAL = 0.1
+
+
+def hash_key(value):
+    return int.from_bytes(hashlib.md5(value.encode('utf_8')).digest()[:8], 'big')
+
+
+class HashRing(object):
+    """Consistent hashing: adding or removing a worker only moves the connectors of the ring arcs it takes or frees"""
+
+    def __init__(self, nodes, replicas=HASH_REPLICAS):
+        self.points = sorted((hash_key("%s#%d" % (node, replica)), node) for node in nodes
+                             for replica in range(replicas))
+        self.hashes = [each[0] for each in self.points]
+
+    def node(self, key):
+        index = bisect.bisect(self.hashes, hash_key(key)) % len(self.points)
+        return self.points[index][1]
+
+
+class WorkerPool(object):
+    """Runs the connectors in count WorkerProcess children instead of a process each"""
+
+    def __init__(self, count, config_files, log_level='INFO'):
+        self.count = count
+        self.log_level = log_level
+        ring = HashRing(range(count))
+        self.assignment = {}
+        for config_file in config_files:
+            self.assignment.setdefault(ring.node(os.path.basename(config_file)), []).append(config_file)
+        self.workers = {}
+        # Lane of the last HostedConnector of each ini file
+        self.last_lanes = {}
+
+    def worker_index(self, config_file):
+        for index, config_files in self.assignment.items():
+            if config_file in config_files:
+                return index
+        raise ValueError("%s is not assigned to a worker" % (config_file,))
+
+    def from_config_file(self, config_file, alert_senders=None):
+        index = self.worker_index(config_file)
+        worker = self.workers.get(index)
+        if worker is None or worker.exitcode is not None:
+            worker = WorkerProcess(index, self.assignment[index], alert_senders, self.log_level)
+            self.workers[index] = worker
+        last = self.last_lanes.get(config_file, LANES - 1)
+        for lane in [(last + offset) % LANES for offset in range(1, LANES + 1)]:
+            if worker.lane_state(config_file, lane) != RUNNING:
+                self.last_lanes[config_file] = lane
+                return HostedConnector(worker, config_file, lane)
+        raise RuntimeError("All the lanes of %s are running" % (config_file,))
+
+    def live_workers(self):
+        return [each for each in self.workers.values() if each.is_alive()]
+
+    def stop(self):
+        workers = self.live_workers()
+        for each in workers:
+            each.terminate()
+        for each in workers:
+            each.join()
+
+
+class HostedConnector(object):
+    """A connector running in a lane of a WorkerProcess, with the TunnelProcess interface the supervisor uses"""
+
+    def __init__(self, worker, config_file, lane):
+        self.worker = worker
+        self.config_file = config_file
+        self.lane = lane
+        # Supervisor side of the lane: control channel, events and connection trace shared with the worker
+        self.connector = worker.lanes[config_file][lane]
+        vars(self.connector).update(TunnelProcess.read_config(config_file))
+        self.tunnel_name = self.connector.tunnel_name
+        self.drain_timeout = self.connector.drain_timeout
+        self.control = self.connector.control
+        self.connection_trace = self.connector.connection_trace
+        self.forwarding_event = self.connector.forwarding_event
+        self.transport_ready_event = self.connector.transport_ready_event
+        self.bind_event = self.connector.bind_event
+        for event in (self.forwarding_event, self.transport_ready_event, self.bind_event):
+            event.clear()
+        self.handoff = False
+        self.drain_requested = False
+        self.started = False
+        self.start_error = None
+
+    @property
+    def pid(self):
+        return self.worker.pid
+
+    @property
+    def exitcode(self):
+        if self.worker.exitcode is not None:
+            return self.worker.exitcode
+        if self.start_error is not None:
+            return 1
+        state = self.worker.lane_state(self.config_file, self.lane)
+        if not self.started or state in (RUNNING, NOT_STARTED):
+            return None
+        return state
+
+    def start(self):
+        if self.worker.pid is None:
+            self.worker.start()
+        self.started = True
+        try:
+            self.worker.call('start-connector', timeout=WORKER_START_TIMEOUT, config_file=self.config_file,
+                             lane=self.lane, handoff=self.handoff)
+        except Exception as e:
+            # Reported as an exit, the supervisor restarts it like a connector process that died
+            self.start_error = e
+
+    def is_alive(self):
+        return self.started and self.worker.is_alive() and \
+               self.worker.lane_state(self.config_file, self.lane) == RUNNING
+
+    def terminate(self):
+        if self.is_alive():
+            try:
+                self.worker.call('stop-connector', timeout=DEFAULT_CONTROL_TIMEOUT, config_file=self.config_file,
+                                 lane=self.lane)
+            except Exception:
+                # The worker is going away, its connectors with it
+                pass
+
+    def join(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.is_alive() and (deadline is None or time.monotonic() < deadline):
+            time.sleep(JOIN_INTERVAL)
+
+    def call(self, command, timeout=DEFAULT_CONTROL_TIMEOUT, **kwargs):
+        if not self.is_alive():
+            raise ControlError("Connector %s is not running" % (self.tunnel_name,))
+        return self.control.call(command, timeout=timeout, **kwargs)
+
+    profile = TunnelProcess.profile
+    drain = TunnelProcess.drain
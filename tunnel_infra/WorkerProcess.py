@@ -0,0 +1,152 @@
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+
+from .ControlChannel import ControlChannel
+from .TunnelProcess import TunnelProcess
+from configure_logger import LogManager
+
+# Each connector has two lanes, so a make-before-break replacement can run next to the connector it replaces
+LANES = 2
+# State of a lane in WorkerProcess.lane_states, any other value is the exit code of its last run
+NOT_STARTED = -1000
+RUNNING = -1001
+STOP_CHECK_INTERVAL = 0.5
+
+
+class WorkerProcess(multiprocessing.Process):
+    """Runs the connectors of several ini files in one process, each one on its own threads"""
+
+    def __init__(self, index, config_files, alert_senders=None, log_level='INFO', log_path=None):
+        self.index = index
+        self.config_files = list(config_files)
+        # Never started as processes, they carry the channels and events shared with the supervisor
+        self.lanes = {}
+        for config_file in self.config_files:
+            self.lanes[config_file] = [TunnelProcess.from_config_file(config_file, alert_senders) for _ in range(LANES)]
+            for tunnel_process in self.lanes[config_file]:
+                tunnel_process.hosted = True
+        self.lane_states = multiprocessing.RawArray('i', [NOT_STARTED] * (LANES * len(self.config_files)))
+        self.control = ControlChannel()
+        self.log_level = log_level
+        self.log_path = log_path or TunnelProcess.default_log_path
+        self.logger = None
+        self.stopping = False
+        self.loggers = {}
+        self.served_lanes = set()
+        super().__init__(name="worker-%d" % (index,))
+
+    def slot(self, config_file, lane):
+        return self.config_files.index(config_file) * LANES + lane
+
+    def lane_state(self, config_file, lane):
+        return self.lane_states[self.slot(config_file, lane)]
+
+    def call(self, command, timeout, **kwargs):
+        """Sends a control command to the worker. Called from the supervisor"""
+        return self.control.call(command, timeout=timeout, **kwargs)
+
+    def run(self):
+        self.logger = LogManager.configure_logger(self.name + ".log", self.log_level, name="pyconn-worker",
+                                                  path=self.log_path)
+        self.logger.info("Starting %s with the process id %s for %d connectors", self.name, os.getpid(),
+                         len(self.config_files))
+        signal.signal(signal.SIGINT, self.exit_gracefully)
+        signal.signal(signal.SIGTERM, self.exit_gracefully)
+        control_thread = threading.Thread(target=self.serve_control_requests, name="worker-control-requests")
+        control_thread.daemon = True
+        control_thread.start()
+        while not self.stopping or RUNNING in self.lane_states[:]:
+            time.sleep(STOP_CHECK_INTERVAL)
+        self.logger.info("All connectors stopped, exiting")
+        sys.exit(0)
+
+    def serve_control_requests(self):
+        self.control.supervisor_end.close()
+        self.control.serve({'start-connector': self.start_connector,
+                            'stop-connector': self.stop_connector,
+                            'get-usage': self.get_usage}, self.logger)
+
+    def start_connector(self, config_file, lane, handoff=False):
+        if self.stopping:
+            raise RuntimeError("%s is stopping" % (self.name,))
+        slot = self.slot(config_file, lane)
+        if self.lane_states[slot] == RUNNING:
+            raise RuntimeError("Lane %d of %s is running" % (lane, config_file))
+        tunnel_process = self.lanes[config_file][lane]
+        # The ini file may have changed since the worker started
+        vars(tunnel_process).update(TunnelProcess.read_config(config_file))
+        tunnel_process.handoff = handoff
+        tunnel_process.stop_requested = False
+        tunnel_process.tunnel = None
+        tunnel_process.logger = self.connector_logger(config_file, tunnel_process)
+        if slot not in self.served_lanes:
+            self.served_lanes.add(slot)
+            tunnel_process.start_control_thread()
+        self.lane_states[slot] = RUNNING
+        thread = threading.Thread(target=self.host, args=(tunnel_process, slot),
+                                  name="connector-" + tunnel_process.log_filename)
+        thread.daemon = True
+        thread.start()
+        return {'worker': self.name, 'pid': os.getpid()}
+
+    def connector_logger(self, config_file, tunnel_process):
+        """One logger and log file per connector, shared by its lanes. paramiko logs to the worker log"""
+        if config_file not in self.loggers:
+            name = "pyconn-connector." + os.path.splitext(tunnel_process.log_filename)[0]
+            self.loggers[config_file] = LogManager.configure_logger(tunnel_process.log_filename,
+                                                                    tunnel_process.log_level,
+                                                                    tunnel_process.log_to_console, name=name,
+                                                                    path=tunnel_process.log_path, with_paramiko=False)
+        logger = self.loggers[config_file]
+        logger.setLevel(tunnel_process.log_level)
+        return logger
+
+    def host(self, tunnel_process, slot):
+        code = 1
+        try:
+            tunnel_process.serve()
+            code = 0
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else int(e.code is not None)
+        except Exception as e:
+            self.logger.exception("Connector %s failed: %r", tunnel_process.tunnel_name, e)
+        finally:
+            tunnel_process.tunnel = None
+            self.lane_states[slot] = code
+            self.logger.info("Connector %s exited with code %s", tunnel_process.tunnel_name, code)
+
+    def stop_connector(self, config_file, lane):
+        """Same as SIGTERM for a connector process: drains it the first time and stops it the second"""
+        if self.lane_state(config_file, lane) == RUNNING:
+            self.lanes[config_file][lane].exit_gracefully()
+
+    def get_usage(self):
+        """CPU seconds used by the threads of each connector"""
+        import psutil
+        thread_times = {each.id: each.user_time + each.system_time for each in psutil.Process().threads()}
+        connectors = {}
+        for lanes in self.lanes.values():
+            for tunnel_process in lanes:
+                tunnel = tunnel_process.tunnel
+                if tunnel is not None:
+                    connectors[tunnel_process.tunnel_name] = connectors.get(tunnel_process.tunnel_name, 0) + \
+                                                             tunnel.cpu_seconds(thread_times)
+        return {'pid': os.getpid(), 'connectors': connectors}
+
+    def exit_gracefully(self, *args):
+        if self.stopping:
+            self.logger.info("Stopping %s right away", self.name)
+            sys.exit(0)
+        self.logger.info("Stopping %s, draining its connectors", self.name)
+        self.stopping = True
+        for config_file, lanes in self.lanes.items():
+            for lane, tunnel_process in enumerate(lanes):
+                if self.lane_state(config_file, lane) == RUNNING:
+                    try:
+                        tunnel_process.exit_gracefully()
+                    except Exception as e:
+                        self.logger.exception("Failed to stop %s: %r", tunnel_process.tunnel_name, e)